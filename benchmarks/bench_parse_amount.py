@@ -0,0 +1,40 @@
+"""Micro-benchmark for parse_amount: python benchmarks/bench_parse_amount.py
+
+Compares bot.parse_amount and utils.parse_amount against the regex-stripping
+parser they replaced, on a mix of typical inputs.
+"""
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import bot  # noqa: E402
+import utils  # noqa: E402
+
+INPUTS = ["500000", "100 USD", "1 500 000 so'm", "$250", "1.5 mln", "300k", "1.500.000", "abc"]
+NUMBER = 20000
+
+
+def strip_parse_amount(text):
+    """The old parser: strip everything but digits and dots"""
+    text = text.strip().upper()
+    currency = 'USD' if '$' in text or 'USD' in text else 'UZS'
+    amount = re.sub(r'[^\d.]', '', text.replace('USD', ''))
+    try:
+        return float(amount), currency
+    except ValueError:
+        return None, None
+
+
+def bench(func):
+    best = min(timeit.repeat(lambda: [func(text) for text in INPUTS], number=NUMBER, repeat=5))
+    return best / (NUMBER * len(INPUTS)) * 1e6
+
+
+if __name__ == "__main__":
+    for name, func in [("old strip parser", strip_parse_amount),
+                       ("bot.parse_amount", bot.parse_amount),
+                       ("utils.parse_amount", utils.parse_amount)]:
+        print(f"{name:20} {bench(func):6.2f} us/input")
@@ -0,0 +1,47 @@
+"""Micro-benchmark for parse_date: python benchmarks/bench_parse_date.py
+
+Compares bot.parse_date and utils.parse_date against the strptime loop they
+replaced, overall and per input (the loop is slowest on later formats and misses).
+"""
+import os
+import sys
+import timeit
+from datetime import date, datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import bot  # noqa: E402
+import utils  # noqa: E402
+
+TODAY = date(2026, 1, 30)
+INPUTS = ["25.02.2026", "1.03.2026", "25/02/2026", "15-04-2026", "2026-05-01", "25.02.26", "31.02.2026", "ertaga"]
+NUMBER = 20000
+
+
+def strptime_parse_date(text, today=None):
+    """The old parser: try each format in turn"""
+    for fmt in ['%d.%m.%Y', '%d/%m/%Y', '%d-%m-%Y', '%Y-%m-%d', '%d.%m.%y']:
+        try:
+            return datetime.strptime(text.strip(), fmt).date()
+        except ValueError:
+            continue
+    return None
+
+
+PARSERS = [("old strptime loop", strptime_parse_date),
+           ("bot.parse_date", bot.parse_date),
+           ("utils.parse_date", utils.parse_date)]
+
+
+def bench(func, inputs):
+    best = min(timeit.repeat(lambda: [func(text, TODAY) for text in inputs], number=NUMBER, repeat=5))
+    return best / (NUMBER * len(inputs)) * 1e6
+
+
+if __name__ == "__main__":
+    for name, func in PARSERS:
+        print(f"{name:20} {bench(func, INPUTS):6.2f} us/input")
+    print()
+    print(f"{'input':14}", *(f"{name:>18}" for name, _ in PARSERS))
+    for text in INPUTS:
+        print(f"{text!r:14}", *(f"{bench(func, [text]):18.2f}" for _, func in PARSERS))
@@ -4,23 +4,146 @@ Barcha kodlar bitta faylda - Railway deploy uchun
 """
 import os
 import asyncio
+import contextvars
+import hashlib
+import html
+import heapq
+import itertools
+import json
 import logging
+import multiprocessing
+import pickle
 import re
+import sqlite3
+import sys
 import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from functools import partial
 from datetime import datetime, date, timedelta
+from typing import NamedTuple, Optional
 
 import aiosqlite
+import httpx
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
 from telegram.ext import (
-    Application, CommandHandler, MessageHandler, CallbackQueryHandler,
-    ConversationHandler, ContextTypes, filters
+    Application, BasePersistence, BaseRateLimiter, BaseUpdateProcessor, CommandHandler, MessageHandler,
+    CallbackQueryHandler, ConversationHandler, ContextTypes, PersistenceInput, filters
 )
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font
+from openpyxl.utils import get_column_letter
+from apscheduler.job import Job
+from apscheduler.jobstores.memory import MemoryJobStore
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.triggers.cron import CronTrigger
+from apscheduler.util import datetime_to_utc_timestamp
 
 # ============== CONFIG ==============
 BOT_TOKEN = os.getenv("BOT_TOKEN", "8450831935:AAGhmhvWFmQH-4AOrOUFyDfiv_ufJYvXztw")
 REMINDER_DAYS = [3, 1, 0]
 DB_PATH = "hisobchi.db"
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+
+# Outbound Bot API limits (Telegram allows ~30 msg/s overall, ~1/s per chat, 20/min per group)
+API_RATE = float(os.getenv("API_RATE", "30"))
+API_CHAT_RATE = float(os.getenv("API_CHAT_RATE", "1"))
+API_CHAT_BURST = int(os.getenv("API_CHAT_BURST", "3"))
+API_GROUP_RATE = float(os.getenv("API_GROUP_RATE", str(20 / 60)))
+API_MAX_RETRIES = int(os.getenv("API_MAX_RETRIES", "3"))
+# RetryAfter on this many different chats at once is taken as the global limit
+API_GLOBAL_FLOOD_CHATS = int(os.getenv("API_GLOBAL_FLOOD_CHATS", "3"))
+# rate_limit_args priorities, lower is served first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 10
+
+# Updates processed at once; updates from one chat still run one after another
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "32"))
+# Updates admitted at once, including those waiting behind an earlier update of their chat
+UPDATE_BACKLOG = int(os.getenv("UPDATE_BACKLOG", "1024"))
+
+# Updates the handlers consume; everything else is filtered out by Telegram
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
+# Webhook mode: set WEBHOOK_URL (public https base URL) to receive updates instead of long polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("PORT", "8443"))
+# Unguessable path segment; derived from the token unless set
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH") or hashlib.sha256(BOT_TOKEN.encode()).hexdigest()[:32]
+# Sent back by Telegram in X-Telegram-Bot-Api-Secret-Token and checked on every request
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+
+# SQLite storage profile
+DB_JOURNAL_MODE = os.getenv("DB_JOURNAL_MODE", "WAL")
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "16384"))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(64 * 1024 * 1024)))
+DB_TEMP_STORE = os.getenv("DB_TEMP_STORE", "MEMORY")
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_CHECKPOINT_MINUTES = int(os.getenv("DB_CHECKPOINT_MINUTES", "10"))
+
+# telegram_id -> users row cache
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "600"))
+
+# Optional write-behind mode: debt/expense inserts are group-committed by one writer task
+WRITE_BEHIND = os.getenv("WRITE_BEHIND", "0") == "1"
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", "100"))
+WRITE_BATCH_MS = int(os.getenv("WRITE_BATCH_MS", "50"))
+WRITE_QUEUE_SIZE = int(os.getenv("WRITE_QUEUE_SIZE", "1000"))
+
+# Reminder dispatch
+REMINDER_HOUR = int(os.getenv("REMINDER_HOUR", "9"))
+REMINDER_WORKERS = int(os.getenv("REMINDER_WORKERS", "16"))
+REMINDER_FETCH_SIZE = int(os.getenv("REMINDER_FETCH_SIZE", "1000"))
+# First retry of a sweep that left reminders unsent; doubles up to an hour
+REMINDER_RETRY_SECONDS = int(os.getenv("REMINDER_RETRY_SECONDS", "300"))
+# Overdue digest: APScheduler cron day expression and hour
+OVERDUE_DIGEST_DAY = os.getenv("OVERDUE_DIGEST_DAY", "*/3")
+OVERDUE_DIGEST_HOUR = int(os.getenv("OVERDUE_DIGEST_HOUR", "10"))
+# Durable jobs: how late a missed run may still start, and when a crashed run may be taken over
+JOB_MISFIRE_GRACE = int(os.getenv("JOB_MISFIRE_GRACE", "21600"))
+JOB_LEASE_MINUTES = int(os.getenv("JOB_LEASE_MINUTES", "60"))
+
+# Conversation persistence: seconds between batched flushes of user_data/conversation state
+PERSISTENCE_INTERVAL = float(os.getenv("PERSISTENCE_INTERVAL", "30"))
+# Users whose user_data stays in memory; idle ones beyond this are reloaded on their next update
+USER_DATA_CACHE_SIZE = int(os.getenv("USER_DATA_CACHE_SIZE", "10000"))
+
+# Button payload tokens: in-memory entries, and how long a token stays valid
+CALLBACK_STORE_SIZE = int(os.getenv("CALLBACK_STORE_SIZE", "5000"))
+CALLBACK_TOKEN_DAYS = int(os.getenv("CALLBACK_TOKEN_DAYS", "30"))
+
+# Excel export: rows pulled from the cursor per fetchmany()
+EXPORT_FETCH_SIZE = int(os.getenv("EXPORT_FETCH_SIZE", "2000"))
+
+# Report workers: threads for I/O-bound jobs, processes for CPU-bound builds (0 runs those on threads)
+REPORT_THREADS = int(os.getenv("REPORT_THREADS", "2"))
+REPORT_PROCESSES = int(os.getenv("REPORT_PROCESSES", "1"))
+REPORT_QUEUE_SIZE = int(os.getenv("REPORT_QUEUE_SIZE", "20"))
+REPORT_USER_LIMIT = int(os.getenv("REPORT_USER_LIMIT", "1"))
+REPORT_PROGRESS_SECONDS = float(os.getenv("REPORT_PROGRESS_SECONDS", "3"))
+
+# Currency rates, in UZS per unit: RATE_PROVIDER is "fixed" (USD_TO_UZS_RATE), "file" (JSON at
+# RATES_FILE) or "http" (JSON at RATES_URL); either JSON is {"USD": 12700} or the CBU feed's list
+RATE_PROVIDER = os.getenv("RATE_PROVIDER", "fixed")
+USD_TO_UZS_RATE = float(os.getenv("USD_TO_UZS_RATE", "12700"))
+RATES_FILE = os.getenv("RATES_FILE", "rates.json")
+RATES_URL = os.getenv("RATES_URL", "https://cbu.uz/uz/arkhiv-kursov-valyut/json/")
+RATE_TTL = int(os.getenv("RATE_TTL", "3600"))
+CURRENCIES = ('UZS', 'USD')
+
+# List paging
+DEBT_PAGE_SIZE = int(os.getenv("DEBT_PAGE_SIZE", "10"))
+EXPENSE_PAGE_SIZE = int(os.getenv("EXPENSE_PAGE_SIZE", "15"))
 
 # Logging
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
@@ -37,6 +160,7 @@ def main_menu_keyboard():
         [KeyboardButton("💰 Qarz berdim"), KeyboardButton("💸 Qarz oldim")],
         [KeyboardButton("📝 Kunlik harajat"), KeyboardButton("📋 Harajatlar tarixi")],
         [KeyboardButton("📊 Statistika"), KeyboardButton("📋 Mening qarzlarim")],
+        [KeyboardButton("📤 Excel eksport")],
     ]
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
@@ -54,6 +178,12 @@ def date_keyboard():
     ]
     return InlineKeyboardMarkup(keyboard)
 
+def amount_choice_keyboard(amounts, currency):
+    # One button per reading of an ambiguous amount; the index picks it from user_data
+    buttons = [InlineKeyboardButton(format_money(amount, currency), callback_data=f"rpamt_{i}")
+               for i, amount in enumerate(amounts)]
+    return InlineKeyboardMarkup([buttons])
+
 def confirm_keyboard():
     keyboard = [
         [InlineKeyboardButton("✅ Tasdiqlash", callback_data="confirm_yes"),
@@ -89,57 +219,79 @@ def installment_count_keyboard():
     ]
     return InlineKeyboardMarkup(keyboard)
 
-def debt_list_keyboard(debts, page=0):
+def base_currency_keyboard(current):
+    # Offers the currencies the statistics totals are not shown in yet
+    buttons = [InlineKeyboardButton(f"💱 {c} da ko'rsatish", callback_data=f"base_{c}") for c in CURRENCIES if c != current]
+    return InlineKeyboardMarkup([buttons])
+
+def page_nav_row(prev_data=None, next_data=None):
+    row = []
+    if prev_data:
+        row.append(InlineKeyboardButton("⬅️ Oldingi", callback_data=prev_data))
+    if next_data:
+        row.append(InlineKeyboardButton("Keyingi ➡️", callback_data=next_data))
+    return row
+
+def debt_list_keyboard(debts, prev_data=None, next_data=None):
     keyboard = []
-    for debt in debts[:10]:
+    for debt in debts:
         status = "✅" if debt['is_paid'] else "⏳"
         text = f"{status} {debt['person_name']} - {debt['amount']:,.0f} {debt['currency']}"
-        keyboard.append([InlineKeyboardButton(text, callback_data=f"debt_{debt['id']}")])
+        keyboard.append([InlineKeyboardButton(text, callback_data=f"debt_{debt_token(debt)}")])
+    nav = page_nav_row(prev_data, next_data)
+    if nav:
+        keyboard.append(nav)
     keyboard.append([InlineKeyboardButton("🔙 Orqaga", callback_data="back_main")])
     return InlineKeyboardMarkup(keyboard)
 
-def debt_action_keyboard(debt_id, debt_type, is_paid=False):
+def debt_action_keyboard(token, debt_type, is_paid=False):
+    # `token` is a callback_store token for the debt (see debt_token)
     keyboard = []
     if not is_paid:
         # Repayment buttons based on debt type
         if debt_type == 'given':
-            keyboard.append([InlineKeyboardButton("💵 Qarzini berdi", callback_data=f"repay_{debt_id}")])
+            keyboard.append([InlineKeyboardButton("💵 Qarzini berdi", callback_data=f"repay_{token}")])
         else:
-            keyboard.append([InlineKeyboardButton("💵 Qarzimni berdim", callback_data=f"repay_{debt_id}")])
-        keyboard.append([InlineKeyboardButton("✅ To'liq to'landi", callback_data=f"mark_paid_{debt_id}")])
-    keyboard.append([InlineKeyboardButton("✏️ Tahrirlash", callback_data=f"edit_debt_{debt_id}")])
-    keyboard.append([InlineKeyboardButton("🗑 O'chirish", callback_data=f"delete_debt_{debt_id}")])
+            keyboard.append([InlineKeyboardButton("💵 Qarzimni berdim", callback_data=f"repay_{token}")])
+        keyboard.append([InlineKeyboardButton("✅ To'liq to'landi", callback_data=f"mark_paid_{token}")])
+    keyboard.append([InlineKeyboardButton("✏️ Tahrirlash", callback_data=f"edit_debt_{token}")])
+    keyboard.append([InlineKeyboardButton("🗑 O'chirish", callback_data=f"delete_debt_{token}")])
     keyboard.append([InlineKeyboardButton("🔙 Orqaga", callback_data="back_debts")])
     return InlineKeyboardMarkup(keyboard)
 
-def debt_edit_keyboard(debt_id):
+def debt_edit_keyboard(token):
     keyboard = [
-        [InlineKeyboardButton("👤 Ismni o'zgartirish", callback_data=f"editfield_name_{debt_id}")],
-        [InlineKeyboardButton("📱 Telefonni o'zgartirish", callback_data=f"editfield_phone_{debt_id}")],
-        [InlineKeyboardButton("💵 Summani o'zgartirish", callback_data=f"editfield_amount_{debt_id}")],
-        [InlineKeyboardButton("⏰ Muddatni o'zgartirish", callback_data=f"editfield_due_{debt_id}")],
-        [InlineKeyboardButton("🔙 Orqaga", callback_data=f"debt_{debt_id}")]
+        [InlineKeyboardButton("👤 Ismni o'zgartirish", callback_data=f"editfield_name_{token}")],
+        [InlineKeyboardButton("📱 Telefonni o'zgartirish", callback_data=f"editfield_phone_{token}")],
+        [InlineKeyboardButton("💵 Summani o'zgartirish", callback_data=f"editfield_amount_{token}")],
+        [InlineKeyboardButton("⏰ Muddatni o'zgartirish", callback_data=f"editfield_due_{token}")],
+        [InlineKeyboardButton("🔙 Orqaga", callback_data=f"debt_{token}")]
     ]
     return InlineKeyboardMarkup(keyboard)
 
-def delete_confirm_keyboard(debt_id):
+def delete_confirm_keyboard(token):
     keyboard = [
-        [InlineKeyboardButton("✅ Ha, o'chirish", callback_data=f"confirm_delete_{debt_id}"),
-         InlineKeyboardButton("❌ Yo'q", callback_data=f"debt_{debt_id}")]
+        [InlineKeyboardButton("✅ Ha, o'chirish", callback_data=f"confirm_delete_{token}"),
+         InlineKeyboardButton("❌ Yo'q", callback_data=f"debt_{token}")]
     ]
     return InlineKeyboardMarkup(keyboard)
 
-def expense_list_keyboard(expenses):
+def expense_list_keyboard(expenses, prev_data=None, next_data=None):
     keyboard = []
     category_emojis = {'food': '🍔', 'transport': '🚗', 'home': '🏠', 'clothes': '👕', 'health': '💊', 'other': '📦'}
-    for exp in expenses[:15]:
-        emoji = category_emojis.get(exp.get('category', 'other'), '📦')
-        exp_date = exp['expense_date'][:10] if exp.get('expense_date') else ""
+    for exp in expenses:
+        emoji = category_emojis.get(exp['category'], '📦')
         text = f"{emoji} {exp['description'][:15]} - {exp['amount']:,.0f}"
         keyboard.append([InlineKeyboardButton(text, callback_data=f"expense_{exp['id']}")])
+    nav = page_nav_row(prev_data, next_data)
+    if nav:
+        keyboard.append(nav)
     keyboard.append([InlineKeyboardButton("🔙 Orqaga", callback_data="back_main")])
     return InlineKeyboardMarkup(keyboard)
 
+def report_cancel_keyboard():
+    return InlineKeyboardMarkup([[InlineKeyboardButton("❌ Bekor qilish", callback_data="report_cancel")]])
+
 def expense_action_keyboard(expense_id):
     keyboard = [
         [InlineKeyboardButton("🗑 O'chirish", callback_data=f"delete_expense_{expense_id}")],
@@ -160,28 +312,139 @@ def format_money(amount, currency):
         return f"{amount:,.0f} so'm"
     return f"${amount:,.2f}"
 
-def parse_amount(text):
-    text = text.strip().upper()
-    if '$' in text:
-        amount = re.sub(r'[^\d.]', '', text)
-        return float(amount) if amount else None, 'USD'
-    if 'USD' in text:
-        amount = re.sub(r'[^\d.]', '', text.replace('USD', ''))
-        return float(amount) if amount else None, 'USD'
-    if 'UZS' in text or "SO'M" in text or "SOM" in text:
-        amount = re.sub(r'[^\d.]', '', text)
-        return float(amount) if amount else None, 'UZS'
-    amount = re.sub(r'[^\d.]', '', text)
-    return (float(amount), 'UZS') if amount else (None, None)
-
-def parse_date(text):
-    formats = ['%d.%m.%Y', '%d/%m/%Y', '%d-%m-%Y', '%Y-%m-%d', '%d.%m.%y']
-    for fmt in formats:
-        try:
-            return datetime.strptime(text.strip(), fmt).date()
-        except ValueError:
-            continue
-    return None
+# Words accepted around an amount, lower-case; currency may come before or after the number
+CURRENCY_WORDS = {
+    '$': 'USD', 'usd': 'USD', 'dollar': 'USD', 'dollor': 'USD',
+    'uzs': 'UZS', "so'm": 'UZS', 'soʻm': 'UZS', 'so’m': 'UZS', 'so‘m': 'UZS', 'so`m': 'UZS',
+    'som': 'UZS', 'sum': 'UZS', 'сўм': 'UZS', 'сум': 'UZS',
+}
+AMOUNT_MULTIPLIERS = {'k': 1e3, 'ming': 1e3, 'mln': 1e6, 'million': 1e6, 'mlrd': 1e9, 'milliard': 1e9}
+
+def _word_pattern(words):
+    # Longest first so "so'm" is not cut short by "som"-like prefixes
+    return '|'.join(re.escape(w) for w in sorted(words, key=len, reverse=True))
+
+# One anchored match over the lower-cased text does the whole parse:
+# [currency] number [multiplier] [currency].
+# A number is either digits grouped by threes with one separator (1.500.000, 1 500 000,
+# 1,500,000) plus an optional decimal part using the other separator, or plain digits
+# with an optional decimal part (1500, 1.5, 100,50).
+AMOUNT_RE = re.compile(rf"""
+    \s*(?P<pre>{_word_pattern(CURRENCY_WORDS)})?\s*
+    (?:
+        (?P<head>\d{{1,3}})(?P<sep>[ .,'\u00a0\u202f])(?P<groups>\d{{3}}(?:(?P=sep)\d{{3}})*)
+            (?:(?!(?P=sep))[.,](?P<gfrac>\d+))?
+      | (?P<int>\d+)(?:[.,](?P<frac>\d+))?
+    )
+    \s*(?P<mult>{_word_pattern(AMOUNT_MULTIPLIERS)})?
+    \s*(?P<post>{_word_pattern(CURRENCY_WORDS)})?\s*
+""", re.VERBOSE)
+
+def parse_amount(text, default='UZS'):
+    """(amount, currency) from text like "1.500.000", "100$", "usd 20,5", "1.5 mln so'm", "300k"; (None, None) if invalid.
+    Amounts without a currency word are in `default`."""
+    if text.isdigit() and text.isascii():
+        return float(text), default  # the common case: a bare number
+    m = AMOUNT_RE.fullmatch(text.lower())
+    if not m:
+        return None, None
+    pre, head, sep, groups, gfrac, whole, frac, mult, post = m.groups()
+    currency = CURRENCY_WORDS[pre or post] if pre or post else default
+    if pre and post and CURRENCY_WORDS[post] != currency:
+        return None, None
+    if whole is not None:
+        amount = float(f"{whole}.{frac}") if frac else float(whole)
+    elif mult and sep in '.,' and len(groups) == 3 and gfrac is None:
+        # "1.500 mln" reads as 1.5 million, not 1500 million
+        amount = float(f"{head}.{groups}")
+    else:
+        amount = float(f"{head}{groups.replace(sep, '')}.{gfrac or 0}")
+    if mult:
+        amount = round(amount * AMOUNT_MULTIPLIERS[mult], 2)
+    return amount, currency
+
+def ambiguous_usd_amount(text, currency):
+    """The decimal reading of a "1.500"-style amount in `currency` USD, else None.
+
+    parse_amount reads one dot-separated group of three digits as thousands, which
+    is right for so'm but often meant as a decimal point in dollars; the caller asks.
+    """
+    if currency != 'USD':
+        return None
+    m = AMOUNT_RE.fullmatch(text.lower())
+    if not m or m['sep'] != '.' or m['mult'] or m['gfrac'] is not None or len(m['groups']) != 3:
+        return None
+    return float(f"{m['head']}.{m['groups']}")
+
+# Set by PerChatUpdateProcessor so every date in one update is resolved against the same day
+request_date = contextvars.ContextVar('request_date', default=None)
+
+def current_date():
+    return request_date.get() or date.today()
+
+def add_months(d, months):
+    """Same day `months` later (or earlier), clamped to the end of shorter months"""
+    month = d.month - 1 + months
+    year, month = d.year + month // 12, month % 12 + 1
+    last = (date(year + month // 12, month % 12 + 1, 1) - timedelta(days=1)).day
+    return date(year, month, min(d.day, last))
+
+WEEKDAYS = {'dushanba': 0, 'seshanba': 1, 'chorshanba': 2, 'payshanba': 3, 'juma': 4, 'shanba': 5, 'yakshanba': 6}
+DAY_WORDS = {'kecha': -1, 'bugun': 0, 'ertaga': 1, 'indinga': 2}
+_WEEKDAY_PATTERN = '|'.join(sorted(WEEKDAYS, key=len, reverse=True))
+
+# One match picks the form; the group that matched says which one
+DATE_RE = re.compile(rf"""
+    \s*(?:
+        (?P<d>\d{{1,2}})(?P<sep>[./-])(?P<m>\d{{1,2}})(?:(?P=sep)(?P<y>\d{{4}}|\d{{2}}))?   # 25.02.2026, 25/02/26, 25.02
+      | (?P<iy>\d{{4}})-(?P<im>\d{{1,2}})-(?P<id>\d{{1,2}})                                  # 2026-02-25
+      | (?P<word>{'|'.join(DAY_WORDS)})                                                   # bugun, ertaga
+      | (?P<n>\d{{1,3}})\s*(?P<unit>kun|hafta|oy|yil)(?:dan)?\s+(?P<dir>keyin|so'ng|song|oldin)  # 3 kundan keyin
+      | keyingi\s+(?P<next>hafta|oy|yil|{_WEEKDAY_PATTERN})                                # keyingi oy
+      | (?P<weekday>{_WEEKDAY_PATTERN})                                                   # juma
+    )\s*
+""", re.VERBOSE)
+
+def _shift(d, n, unit):
+    if unit == 'kun':
+        return d + timedelta(days=n)
+    if unit == 'hafta':
+        return d + timedelta(weeks=n)
+    return add_months(d, n * 12 if unit == 'yil' else n)
+
+def _next_weekday(d, name):
+    # Always ahead: "juma" said on a Friday is the next Friday
+    return d + timedelta(days=(WEEKDAYS[name] - d.weekday() - 1) % 7 + 1)
+
+def parse_date(text, today=None):
+    """Date from 25.02.2026 / 25/02/26 / 2026-02-25 / 25.02 or a relative form
+    ("ertaga", "3 kundan keyin", "keyingi oy", "juma"); None if invalid"""
+    m = DATE_RE.fullmatch(text.lower())
+    if not m:
+        return None
+    today = today or current_date()
+    try:
+        if m['d']:
+            year = m['y']
+            if year is None:
+                year = today.year
+            elif len(year) == 2:
+                year = (1900 if int(year) >= 69 else 2000) + int(year)  # strptime's %y pivot
+            return date(int(year), int(m['m']), int(m['d']))
+        if m['iy']:
+            return date(int(m['iy']), int(m['im']), int(m['id']))
+    except ValueError:
+        return None
+    if m['word']:
+        return today + timedelta(days=DAY_WORDS[m['word']])
+    if m['n']:
+        n = int(m['n'])
+        return _shift(today, -n if m['dir'] == 'oldin' else n, m['unit'])
+    if m['next'] in WEEKDAYS:
+        return _next_weekday(today, m['next'])
+    if m['next']:
+        return _shift(today, 1, m['next'])
+    return _next_weekday(today, m['weekday'])
 
 def format_date(d):
     if d is None:
@@ -190,84 +453,1244 @@ def format_date(d):
         d = datetime.fromisoformat(d).date()
     return d.strftime('%d.%m.%Y')
 
-def days_until(target_date):
+def days_until(target_date, today=None):
+    """Days from today to target_date; None for a debt with no due date"""
+    if target_date is None:
+        return None
     if isinstance(target_date, str):
         target_date = datetime.fromisoformat(target_date).date()
-    return (target_date - date.today()).days
+    return (target_date - (today or current_date())).days
+
+def month_range(d):
+    """Half-open [first day of month, first day of next month) range for index-friendly filters"""
+    start = d.replace(day=1)
+    return start, date(start.year + start.month // 12, start.month % 12 + 1, 1)
+
+def installment_schedule(total, count, first_due):
+    """[(due_date, amount)] for `count` monthly installments of `total`, the first on first_due.
+
+    Every date is counted from first_due, not from the previous installment, so a
+    schedule started on the 31st returns to month ends after February. The total is
+    split in whole tiyin/cents and the leftover ones go to the earliest installments,
+    so the parts always add up to `total` exactly.
+    """
+    units, extra = divmod(round(total * 100), count)
+    return [(add_months(first_due, i), (units + (i < extra)) / 100) for i in range(count)]
+
+class LRUCache:
+    """Bounded LRU mapping whose entries expire ttl seconds after being stored"""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        self._data.pop(key, None)
+
+    def items(self):
+        """Snapshot of the unexpired (key, value) pairs; does not touch recency or stats"""
+        now = time.monotonic()
+        return [(key, value) for key, (expires, value) in self._data.items() if expires >= now]
+
+    def __len__(self):
+        return len(self._data)
+
+class TokenBucket:
+    """Async token bucket: `rate` tokens per second, bursts of up to `capacity`.
+
+    Waiters are served lowest `priority` first, FIFO within a priority, from a
+    heap drained by a single loop timer.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = max(1, capacity or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._waiters = []
+        self._seq = itertools.count()
+        self._timer = None
+
+    @property
+    def idle(self):
+        """Nobody waiting and fully refilled, so the bucket can be dropped"""
+        return not self._waiters and self._wait_time() == 0 and self.tokens >= self.capacity
+
+    def pause(self, seconds):
+        """Hold every caller back, e.g. after Telegram answered with RetryAfter"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self, priority=0):
+        if not self._waiters and self._wait_time() == 0:
+            self.tokens -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        self._drain()
+        await future
+
+    def _wait_time(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.paused_until:
+            return self.paused_until - now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def _drain(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self._waiters:
+            future = self._waiters[0][2]
+            if future.done():
+                # Cancelled while waiting
+                heapq.heappop(self._waiters)
+                continue
+            wait = self._wait_time()
+            if wait > 0:
+                self._timer = asyncio.get_running_loop().call_later(wait, self._drain)
+                return
+            heapq.heappop(self._waiters)
+            self.tokens -= 1
+            future.set_result(None)
+
+def reminder_dates(due_date, today=None):
+    """Days on which a debt due on due_date should be reminded about (REMINDER_DAYS before it), past ones dropped"""
+    if isinstance(due_date, str):
+        due_date = datetime.fromisoformat(due_date).date()
+    today = today or current_date()
+    return sorted({due_date - timedelta(days=n) for n in REMINDER_DAYS if due_date - timedelta(days=n) >= today})
 
 # ============== DATABASE ==============
-async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                telegram_id INTEGER UNIQUE NOT NULL,
-                full_name TEXT,
-                username TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS debts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                person_name TEXT NOT NULL,
-                phone_number TEXT,
-                amount REAL NOT NULL,
-                currency TEXT DEFAULT 'UZS',
-                debt_type TEXT NOT NULL,
-                payment_type TEXT DEFAULT 'one_time',
-                given_date DATE,
-                due_date DATE,
-                is_paid INTEGER DEFAULT 0,
-                notes TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        # Add phone_number column if not exists (for existing databases)
+# Dates go in as ISO text and DATE/TIMESTAMP columns come back as date/datetime
+# (connections use PARSE_DECLTYPES), so rows are parsed once, in the driver.
+# Values that are not ISO are returned as text rather than failing the query.
+def _convert_date(value):
+    try:
+        return date.fromisoformat(value[:10].decode())
+    except ValueError:
+        return value.decode()
+
+def _convert_timestamp(value):
+    try:
+        return datetime.fromisoformat(value.decode())
+    except ValueError:
+        return value.decode()
+
+sqlite3.register_adapter(date, date.isoformat)
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(" "))
+sqlite3.register_converter("DATE", _convert_date)
+sqlite3.register_converter("TIMESTAMP", _convert_timestamp)
+
+def _field(self, key):
+    return getattr(self, key) if isinstance(key, str) else tuple.__getitem__(self, key)
+
+def _get(self, key, default=None):
+    return getattr(self, key, default)
+
+class Debt(NamedTuple):
+    """Typed debts row; row['field'] and row.get() work as on the dicts handlers grew up with"""
+    id: int
+    user_id: int
+    person_name: str
+    phone_number: Optional[str]
+    amount: float
+    currency: str
+    debt_type: str
+    payment_type: str
+    given_date: Optional[date]
+    due_date: Optional[date]
+    is_paid: int
+    __getitem__ = _field
+    get = _get
+
+class Expense(NamedTuple):
+    """Typed daily_expenses row"""
+    id: int
+    user_id: int
+    description: str
+    amount: float
+    currency: str
+    category: Optional[str]
+    expense_date: Optional[date]
+    __getitem__ = _field
+    get = _get
+
+def columns(record):
+    return ', '.join(record._fields)
+
+# Applied once to every pooled connection when it is opened
+CONNECTION_PRAGMAS = [
+    f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}",
+    f"PRAGMA synchronous = {DB_SYNCHRONOUS}",
+    f"PRAGMA cache_size = -{DB_CACHE_SIZE_KB}",
+    f"PRAGMA mmap_size = {DB_MMAP_SIZE}",
+    f"PRAGMA temp_store = {DB_TEMP_STORE}",
+]
+
+class ConnectionPool:
+    """Application-scoped aiosqlite pool: one writer connection and DB_POOL_SIZE readers.
+
+    Opened in post_init and closed in post_shutdown, so handlers reuse the same
+    worker threads and file handles instead of reconnecting on every update.
+    """
+
+    def __init__(self, path, size=DB_POOL_SIZE):
+        self.path = path
+        self.size = max(1, size)
+        self._writer = None
+        self._readers = None
+        self._write_lock = asyncio.Lock()
+        self._open_lock = asyncio.Lock()
+
+    async def _connect(self, readonly=False):
+        connector = aiosqlite.connect(self.path, detect_types=sqlite3.PARSE_DECLTYPES)
+        # Pooled threads must not keep the process alive if shutdown is skipped
+        connector.daemon = True
+        db = await connector
+        db.row_factory = aiosqlite.Row
+        for pragma in CONNECTION_PRAGMAS:
+            await db.execute(pragma)
+        if readonly:
+            await db.execute("PRAGMA query_only = ON")
+        return db
+
+    async def open(self):
+        async with self._open_lock:
+            if self._writer is not None:
+                return
+            self._writer = await self._connect()
+            # journal_mode is persistent in the file, so set it before any reader attaches
+            cursor = await self._writer.execute(f"PRAGMA journal_mode = {DB_JOURNAL_MODE}")
+            journal_mode = (await cursor.fetchone())[0]
+            self._readers = asyncio.Queue()
+            for _ in range(self.size):
+                self._readers.put_nowait(await self._connect(readonly=True))
+            logger.info(f"DB pool opened: 1 writer, {self.size} readers, journal_mode={journal_mode}")
+
+    async def close(self):
+        async with self._open_lock:
+            if self._writer is None:
+                return
+            while not self._readers.empty():
+                await self._readers.get_nowait().close()
+            await self._writer.close()
+            self._writer = None
+            self._readers = None
+
+    @asynccontextmanager
+    async def reader(self):
+        """Borrow a read-only connection"""
+        if self._writer is None:
+            await self.open()
+        db = await self._readers.get()
         try:
-            await db.execute("ALTER TABLE debts ADD COLUMN phone_number TEXT")
-        except:
-            pass
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS daily_expenses (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                description TEXT,
-                amount REAL NOT NULL,
-                currency TEXT DEFAULT 'UZS',
-                category TEXT,
-                expense_date DATE DEFAULT CURRENT_DATE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
+            yield db
+        finally:
+            self._readers.put_nowait(db)
+
+    @asynccontextmanager
+    async def writer(self):
+        """Exclusive access to the writer connection; rolls back if the block fails"""
+        if self._writer is None:
+            await self.open()
+        async with self._write_lock:
+            try:
+                yield self._writer
+            except BaseException:
+                await self._writer.rollback()
+                raise
+
+db_pool = ConnectionPool(DB_PATH)
+
+async def wal_checkpoint():
+    """Fold the WAL back into the main database file and truncate it"""
+    async with db_pool.writer() as db:
+        cursor = await db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        busy, log_pages, checkpointed = await cursor.fetchone()
+    if busy:
+        logger.warning(f"WAL checkpoint incomplete: {checkpointed}/{log_pages} pages (readers busy)")
+    else:
+        logger.debug(f"WAL checkpoint: {checkpointed} pages")
+
+async def _add_column_if_missing(db, table, column, decl):
+    cursor = await db.execute(f"PRAGMA table_info({table})")
+    if column not in [row['name'] for row in await cursor.fetchall()]:
+        await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+# (version, description, steps). A step is SQL or an async callable taking the connection.
+# Append new migrations at the end; never edit one that has shipped.
+MIGRATIONS = [
+    (1, "base schema", [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id INTEGER UNIQUE NOT NULL,
+            full_name TEXT,
+            username TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS debts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            person_name TEXT NOT NULL,
+            phone_number TEXT,
+            amount REAL NOT NULL,
+            currency TEXT DEFAULT 'UZS',
+            debt_type TEXT NOT NULL,
+            payment_type TEXT DEFAULT 'one_time',
+            given_date DATE,
+            due_date DATE,
+            is_paid INTEGER DEFAULT 0,
+            notes TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS daily_expenses (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            description TEXT,
+            amount REAL NOT NULL,
+            currency TEXT DEFAULT 'UZS',
+            category TEXT,
+            expense_date DATE DEFAULT CURRENT_DATE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ]),
+    # Databases created before phone numbers were collected
+    (2, "debts.phone_number", [
+        lambda db: _add_column_if_missing(db, 'debts', 'phone_number', 'TEXT'),
+    ]),
+    (3, "indexes for hot queries", [
+        # get_debts_page, get_statistics: user_id = ? AND debt_type = ? AND is_paid = 0 ORDER BY due_date
+        "CREATE INDEX IF NOT EXISTS idx_debts_active_by_type ON debts (user_id, debt_type, due_date) WHERE is_paid = 0",
+        # get_previous_contacts: user_id = ? ORDER BY created_at DESC
+        "CREATE INDEX IF NOT EXISTS idx_debts_user_created ON debts (user_id, created_at)",
+        # reminder/overdue sweeps: due_date range over unpaid debts
+        "CREATE INDEX IF NOT EXISTS idx_debts_active_due ON debts (due_date) WHERE is_paid = 0",
+        # get_expenses_page, get_statistics: user_id = ? ORDER BY expense_date DESC, id DESC
+        "CREATE INDEX IF NOT EXISTS idx_expenses_user_date ON daily_expenses (user_id, expense_date)",
+    ]),
+    (4, "user_rollups", [
+        """
+        CREATE TABLE IF NOT EXISTS user_rollups (
+            user_id INTEGER NOT NULL,
+            currency TEXT NOT NULL,
+            given_total REAL NOT NULL DEFAULT 0,
+            given_count INTEGER NOT NULL DEFAULT 0,
+            taken_total REAL NOT NULL DEFAULT 0,
+            taken_count INTEGER NOT NULL DEFAULT 0,
+            day_key DATE,
+            day_total REAL NOT NULL DEFAULT 0,
+            day_count INTEGER NOT NULL DEFAULT 0,
+            month_key DATE,
+            month_total REAL NOT NULL DEFAULT 0,
+            month_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, currency)
+        ) WITHOUT ROWID
+        """,
+        lambda db: rebuild_rollups(db),
+    ]),
+    (5, "reminders", [
+        """
+        CREATE TABLE IF NOT EXISTS reminders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            debt_id INTEGER NOT NULL,
+            remind_date DATE NOT NULL,
+            is_sent INTEGER DEFAULT 0,
+            FOREIGN KEY (debt_id) REFERENCES debts (id)
+        )
+        """,
+        # daily sweep: remind_date <= today AND is_sent = 0
+        "CREATE INDEX IF NOT EXISTS idx_reminders_pending ON reminders (remind_date) WHERE is_sent = 0",
+        "CREATE INDEX IF NOT EXISTS idx_reminders_debt ON reminders (debt_id)",
+        lambda db: backfill_reminders(db),
+    ]),
+    (6, "durable scheduler jobs", [
+        """
+        CREATE TABLE IF NOT EXISTS apscheduler_jobs (
+            id TEXT PRIMARY KEY,
+            next_run_time REAL,
+            job_state BLOB NOT NULL
+        )
+        """,
+        # One row per job run (e.g. per day); the primary key makes claiming a run atomic
+        """
+        CREATE TABLE IF NOT EXISTS job_runs (
+            job_id TEXT NOT NULL,
+            run_key TEXT NOT NULL,
+            started_at TIMESTAMP NOT NULL,
+            finished_at TIMESTAMP,
+            PRIMARY KEY (job_id, run_key)
+        )
+        """,
+    ]),
+    (7, "conversation persistence", [
+        """
+        CREATE TABLE IF NOT EXISTS persisted_user_data (
+            user_id INTEGER PRIMARY KEY,
+            data BLOB NOT NULL,
+            updated_at TIMESTAMP NOT NULL
+        )
+        """,
+        # Only live conversations are stored; ended ones are deleted
+        """
+        CREATE TABLE IF NOT EXISTS persisted_conversations (
+            name TEXT NOT NULL,
+            key TEXT NOT NULL,
+            state BLOB NOT NULL,
+            PRIMARY KEY (name, key)
+        ) WITHOUT ROWID
+        """,
+    ]),
+    (8, "callback payload tokens", [
+        """
+        CREATE TABLE IF NOT EXISTS callback_tokens (
+            token TEXT PRIMARY KEY,
+            payload BLOB NOT NULL,
+            debt_id INTEGER,
+            snapshot BLOB,
+            expires_at REAL NOT NULL
+        ) WITHOUT ROWID
+        """,
+        # forget_debt: snapshots of one debt; purge: expired tokens
+        "CREATE INDEX IF NOT EXISTS idx_callback_tokens_debt ON callback_tokens (debt_id) WHERE snapshot IS NOT NULL",
+        "CREATE INDEX IF NOT EXISTS idx_callback_tokens_expires ON callback_tokens (expires_at)",
+    ]),
+    # Same table as the modular version's; debts that chose installments before this
+    # have no stored month count and stay one-time.
+    (9, "installment schedules", [
+        """
+        CREATE TABLE IF NOT EXISTS installments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            debt_id INTEGER NOT NULL,
+            amount REAL NOT NULL,
+            due_date DATE,
+            is_paid INTEGER DEFAULT 0,
+            paid_date DATE,
+            FOREIGN KEY (debt_id) REFERENCES debts (id)
+        )
+        """,
+        # next installment: debt_id = ? AND is_paid = 0 ORDER BY due_date; delete_debt: debt_id = ?
+        "CREATE INDEX IF NOT EXISTS idx_installments_debt_next ON installments (debt_id, is_paid, due_date)",
+        # Installment reminders carry the installment they are for; NULL for the debt's own
+        "ALTER TABLE reminders ADD COLUMN installment_id INTEGER REFERENCES installments (id)",
+    ]),
+    (10, "currency rates", [
+        "ALTER TABLE users ADD COLUMN base_currency TEXT NOT NULL DEFAULT 'UZS'",
+        # One row per currency per day (the day's last fetch); the latest is a primary-key seek
+        """
+        CREATE TABLE IF NOT EXISTS currency_rates (
+            currency TEXT NOT NULL,
+            rate_date DATE NOT NULL,
+            rate REAL NOT NULL,
+            fetched_at TIMESTAMP NOT NULL,
+            PRIMARY KEY (currency, rate_date)
+        ) WITHOUT ROWID
+        """,
+    ]),
+]
+
+async def run_migrations(db, migrations):
+    """Apply pending migrations in order, each in its own transaction.
+
+    database.py now records its own migrations in schema_version_modular, but used
+    to write its different versions 1-3 here. Rows whose description is not ours
+    are such leftovers: they are dropped and our steps (1-3 are idempotent) run.
+    """
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    ours = {version: description for version, description, _ in migrations}
+    cursor = await db.execute("SELECT version, description FROM schema_version")
+    applied = {version: description for version, description in await cursor.fetchall()}
+    foreign = [version for version, description in applied.items() if ours.get(version, description) != description]
+    if foreign:
+        await db.executemany("DELETE FROM schema_version WHERE version = ?", [(version,) for version in foreign])
+        await db.commit()
+        logger.warning(f"Dropped schema_version rows written by database.py: {foreign}")
+    for version, description, steps in migrations:
+        if version in applied and version not in foreign:
+            continue
+        await db.execute("BEGIN")
+        for step in steps:
+            if callable(step):
+                await step(db)
+            else:
+                await db.execute(step)
+        await db.execute("INSERT INTO schema_version (version, description) VALUES (?, ?)", (version, description))
         await db.commit()
+        logger.info(f"Migration {version} applied: {description}")
 
-async def get_or_create_user(telegram_id, full_name, username=None):
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute("SELECT * FROM users WHERE telegram_id = ?", (telegram_id,))
-        user = await cursor.fetchone()
-        if user:
-            return dict(user)
-        await db.execute("INSERT INTO users (telegram_id, full_name, username) VALUES (?, ?, ?)",
-                        (telegram_id, full_name, username))
+async def init_db():
+    async with db_pool.writer() as db:
+        await run_migrations(db, MIGRATIONS)
+
+# ---- Durable scheduler jobs ----
+class SQLiteJobStore(MemoryJobStore):
+    """APScheduler job store persisted to the apscheduler_jobs table.
+
+    Jobs are served from memory; every change is queued as a write on the pool's
+    writer connection, so the scheduler never blocks the event loop on SQLite and
+    writes land in the order they were made. Call load() before the scheduler
+    starts and flush() before the pool closes.
+    """
+
+    def __init__(self, pool):
+        super().__init__()
+        self.pool = pool
+        self._stored = []
+        self._pending = set()
+
+    async def load(self):
+        async with self.pool.reader() as db:
+            cursor = await db.execute("SELECT id, job_state FROM apscheduler_jobs")
+            self._stored = await cursor.fetchall()
+
+    def start(self, scheduler, alias):
+        super().start(scheduler, alias)
+        for job_id, job_state in self._stored:
+            try:
+                job = Job.__new__(Job)
+                job.__setstate__(pickle.loads(job_state))
+                job._scheduler = scheduler
+                job._jobstore_alias = alias
+            except Exception as e:
+                logger.warning(f"Dropping stored job {job_id} that can no longer be restored: {e}")
+                self._write("DELETE FROM apscheduler_jobs WHERE id = ?", (job_id,))
+                continue
+            super().add_job(job)
+        self._stored = []
+
+    def add_job(self, job):
+        super().add_job(job)
+        self._save(job)
+
+    def update_job(self, job):
+        super().update_job(job)
+        self._save(job)
+
+    def remove_job(self, job_id):
+        super().remove_job(job_id)
+        self._write("DELETE FROM apscheduler_jobs WHERE id = ?", (job_id,))
+
+    def remove_all_jobs(self):
+        super().remove_all_jobs()
+        self._write("DELETE FROM apscheduler_jobs", ())
+
+    def shutdown(self):
+        # MemoryJobStore.shutdown() goes through remove_all_jobs(); only drop the in-memory copy
+        super().remove_all_jobs()
+
+    async def flush(self):
+        """Wait until every queued write has reached the database"""
+        while self._pending:
+            await asyncio.gather(*self._pending)
+
+    def _save(self, job):
+        self._write("""
+            INSERT INTO apscheduler_jobs (id, next_run_time, job_state) VALUES (?, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET next_run_time = excluded.next_run_time, job_state = excluded.job_state
+        """, (job.id, datetime_to_utc_timestamp(job.next_run_time),
+              pickle.dumps(job.__getstate__(), pickle.HIGHEST_PROTOCOL)))
+
+    def _write(self, sql, params):
+        task = asyncio.get_running_loop().create_task(self._execute(sql, params))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    async def _execute(self, sql, params):
+        try:
+            async with self.pool.writer() as db:
+                await db.execute(sql, params)
+                await db.commit()
+        except Exception as e:
+            logger.error(f"Job store write failed: {e}")
+
+job_store = SQLiteJobStore(db_pool)
+
+def ensure_job(scheduler, func, trigger, job_id):
+    """Add a durable job unless it is already stored with the same trigger.
+
+    Re-adding on every start would reset next_run_time and lose a run missed while
+    the bot was down; keeping the stored job lets misfire handling catch it up.
+    """
+    job = scheduler.get_job(job_id, jobstore='durable')
+    if job and str(job.trigger) == str(trigger):
+        return job
+    return scheduler.add_job(func, trigger, id=job_id, jobstore='durable', replace_existing=True)
+
+async def claim_run(job_id, run_key):
+    """Claim one run of a job in the job_runs ledger; False if it already ran or is running.
+
+    A run that crashed never gets finished_at, so it is taken over once its
+    JOB_LEASE_MINUTES lease has expired.
+    """
+    now = datetime.now()
+    async with db_pool.writer() as db:
+        cursor = await db.execute(
+            "INSERT OR IGNORE INTO job_runs (job_id, run_key, started_at) VALUES (?, ?, ?)", (job_id, run_key, now))
+        if cursor.rowcount == 0:
+            cursor = await db.execute("""
+                UPDATE job_runs SET started_at = ?
+                WHERE job_id = ? AND run_key = ? AND finished_at IS NULL AND started_at < ?
+            """, (now, job_id, run_key, now - timedelta(minutes=JOB_LEASE_MINUTES)))
         await db.commit()
-        cursor = await db.execute("SELECT * FROM users WHERE telegram_id = ?", (telegram_id,))
-        return dict(await cursor.fetchone())
+        return cursor.rowcount == 1
 
-async def add_debt(user_id, person_name, phone_number, amount, currency, debt_type, payment_type, given_date, due_date):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("""
-            INSERT INTO debts (user_id, person_name, phone_number, amount, currency, debt_type, payment_type, given_date, due_date)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (user_id, person_name, phone_number, amount, currency, debt_type, payment_type, given_date, due_date))
+async def finish_run(job_id, run_key):
+    async with db_pool.writer() as db:
+        await db.execute("UPDATE job_runs SET finished_at = ? WHERE job_id = ? AND run_key = ?",
+                         (datetime.now(), job_id, run_key))
         await db.commit()
-        return cursor.lastrowid
+
+async def run_once_per_day(job_id, job):
+    """Run `job()` unless today's run of job_id already happened; failures leave the claim to expire"""
+    run_key = date.today().isoformat()
+    if not await claim_run(job_id, run_key):
+        logger.info(f"Job {job_id} already ran for {run_key}, skipping")
+        return
+    try:
+        await job()
+    except Exception as e:
+        logger.error(f"Job {job_id} failed: {e}")
+        return
+    await finish_run(job_id, run_key)
+
+# ---- Conversation persistence ----
+class SQLitePersistence(BasePersistence):
+    """PTB persistence for user_data and ConversationHandler states in the bot's SQLite file.
+
+    The Application hands over changed entries every PERSISTENCE_INTERVAL seconds;
+    they are pickled straight away and written together in one transaction. user_data
+    is not loaded at startup but per user, the first time an update from that user
+    arrives, so startup cost does not grow with the number of users. Beyond
+    `max_users` loaded users, the least recently seen idle ones have their user_data
+    emptied and marked unloaded. Only live conversations are stored, so loading them
+    all at startup stays cheap. A failed flush keeps its entries and is retried after
+    one update interval.
+    """
+
+    def __init__(self, pool, update_interval=PERSISTENCE_INTERVAL, max_users=USER_DATA_CACHE_SIZE):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.pool = pool
+        self.max_users = max_users
+        self._loaded_users = OrderedDict()  # user_id -> (last seen, the Application's user_data dict)
+        self._dirty = {}
+        self._flush_task = None
+        self._retry_handle = None
+        self._ready = False
+
+    async def _ensure_schema(self):
+        # Application.initialize() loads persistence before post_init runs the migrations
+        if not self._ready:
+            await self.pool.open()
+            await init_db()
+            self._ready = True
+
+    # -- user_data --
+    async def get_user_data(self):
+        await self._ensure_schema()
+        return {}
+
+    async def refresh_user_data(self, user_id, user_data):
+        # Called for every update of the user, so this is also the recency order
+        loaded = user_id in self._loaded_users
+        self._loaded_users[user_id] = (time.monotonic(), user_data)
+        self._loaded_users.move_to_end(user_id)
+        if loaded:
+            return
+        self._evict_users()
+        pending = self._dirty.get(('user', user_id))
+        if pending is not None:
+            # Not written yet, so newer than the stored row; a DELETE has no data
+            blob = pending[1][1] if len(pending[1]) > 1 else None
+        else:
+            async with self.pool.reader() as db:
+                cursor = await db.execute("SELECT data FROM persisted_user_data WHERE user_id = ?", (user_id,))
+                row = await cursor.fetchone()
+            blob = row[0] if row is not None else None
+        if blob is None:
+            return
+        try:
+            stored = pickle.loads(blob)
+        except Exception as e:
+            logger.warning(f"Dropping unreadable user_data of {user_id}: {e}")
+            return
+        # Keys set before the first load (i.e. by this update) win over stored ones
+        for key, value in stored.items():
+            user_data.setdefault(key, value)
+
+    def _evict_users(self):
+        # The Application hands over the user_data of users seen since its last
+        # update_persistence run; emptying one of those would be persisted as a drop,
+        # so only users idle for two intervals are evicted.
+        idle_before = time.monotonic() - 2 * self.update_interval
+        while len(self._loaded_users) > self.max_users:
+            user_id, (seen, user_data) = next(iter(self._loaded_users.items()))
+            if seen > idle_before:
+                break
+            del self._loaded_users[user_id]
+            user_data.clear()
+
+    async def update_user_data(self, user_id, data):
+        if not data:
+            await self.drop_user_data(user_id)
+            return
+        self._queue(('user', user_id), """
+            INSERT INTO persisted_user_data (user_id, data, updated_at) VALUES (?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at
+        """, (user_id, pickle.dumps(data, pickle.HIGHEST_PROTOCOL), datetime.now()))
+
+    async def drop_user_data(self, user_id):
+        self._queue(('user', user_id), "DELETE FROM persisted_user_data WHERE user_id = ?", (user_id,))
+
+    # -- conversations --
+    async def get_conversations(self, name):
+        await self._ensure_schema()
+        async with self.pool.reader() as db:
+            cursor = await db.execute("SELECT key, state FROM persisted_conversations WHERE name = ?", (name,))
+            rows = await cursor.fetchall()
+        return {tuple(json.loads(key)): pickle.loads(state) for key, state in rows}
+
+    async def update_conversation(self, name, key, new_state):
+        key_text = json.dumps(list(key))
+        if new_state is None:
+            self._queue(('conv', name, key_text),
+                        "DELETE FROM persisted_conversations WHERE name = ? AND key = ?", (name, key_text))
+        else:
+            self._queue(('conv', name, key_text), """
+                INSERT INTO persisted_conversations (name, key, state) VALUES (?, ?, ?)
+                ON CONFLICT(name, key) DO UPDATE SET state = excluded.state
+            """, (name, key_text, pickle.dumps(new_state, pickle.HIGHEST_PROTOCOL)))
+
+    # -- not stored --
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    # -- batching --
+    def _queue(self, entry, sql, params):
+        # Later changes to the same entry replace earlier ones that were not written yet
+        self._dirty[entry] = (sql, params)
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._retry_handle is not None:
+            self._retry_handle.cancel()
+            self._retry_handle = None
+        if self._flush_task is None:
+            self._flush_task = asyncio.get_running_loop().create_task(self._write_dirty())
+
+    async def _write_dirty(self):
+        # One update_persistence run hands over all its entries before this task gets to run
+        await asyncio.sleep(0)
+        self._flush_task = None
+        batch, self._dirty = self._dirty, {}
+        if not batch:
+            return
+        by_sql = {}
+        for sql, params in batch.values():
+            by_sql.setdefault(sql, []).append(params)
+        try:
+            async with self.pool.writer() as db:
+                for sql, rows in by_sql.items():
+                    await db.executemany(sql, rows)
+                await db.commit()
+        except Exception as e:
+            logger.error(f"Persistence flush of {len(batch)} entries failed: {e}")
+            # Keep the entries for the next flush unless newer changes replaced them
+            for entry, change in batch.items():
+                self._dirty.setdefault(entry, change)
+            if self._retry_handle is None:
+                self._retry_handle = asyncio.get_running_loop().call_later(self.update_interval, self._schedule_flush)
+
+    async def flush(self):
+        """Write everything still pending; called by the Application on shutdown"""
+        if self._flush_task is not None:
+            await self._flush_task
+        if self._retry_handle is not None:
+            self._retry_handle.cancel()
+            self._retry_handle = None
+        if self._dirty:
+            await self._write_dirty()
+
+persistence = SQLitePersistence(db_pool)
+
+# ---- Callback payload tokens ----
+class CallbackStore:
+    """Maps short opaque tokens used in callback_data to full button payloads.
+
+    Telegram caps callback_data at 64 bytes, so buttons carry only a token. A token
+    may also hold a snapshot of the debt row the button was rendered from, which lets
+    handlers skip reloading it; writes to that debt drop the snapshot (forget_debt)
+    and the handler falls back to a fresh lookup. Tokens are derived from their
+    content, so re-rendering the same rows gives the same buttons. Recent tokens are
+    served from an LRU cache; every token is also written to SQLite in batches so
+    buttons keep working after eviction and restarts.
+    """
+
+    def __init__(self, pool, maxsize=CALLBACK_STORE_SIZE, ttl_days=CALLBACK_TOKEN_DAYS):
+        self.pool = pool
+        self.ttl = ttl_days * 86400
+        self._cache = LRUCache(maxsize, self.ttl)
+        self._ops = []
+        self._flush_task = None
+
+    def put(self, payload, snapshot=None):
+        """Token for `payload` (and an optional row snapshot); safe to call while building keyboards"""
+        blob = pickle.dumps((payload, snapshot), pickle.HIGHEST_PROTOCOL)
+        token = hashlib.blake2b(blob, digest_size=8).hexdigest()
+        cached = self._cache.get(token)
+        if cached is None or (snapshot is not None and cached[1] is None):
+            self._cache.set(token, (payload, snapshot))
+            self._queue("""
+                INSERT INTO callback_tokens (token, payload, debt_id, snapshot, expires_at) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(token) DO UPDATE SET snapshot = excluded.snapshot, expires_at = excluded.expires_at
+            """, (token, pickle.dumps(payload, pickle.HIGHEST_PROTOCOL), payload.get('debt_id'),
+                  pickle.dumps(snapshot, pickle.HIGHEST_PROTOCOL) if snapshot is not None else None,
+                  time.time() + self.ttl))
+        return token
+
+    async def get(self, token):
+        """(payload, snapshot) for a token, or None if it is unknown or expired"""
+        cached = self._cache.get(token)
+        if cached is not None:
+            return cached
+        async with self.pool.reader() as db:
+            cursor = await db.execute(
+                "SELECT payload, snapshot FROM callback_tokens WHERE token = ? AND expires_at > ?", (token, time.time()))
+            row = await cursor.fetchone()
+        if row is None:
+            return None
+        entry = (pickle.loads(row[0]), pickle.loads(row[1]) if row[1] is not None else None)
+        self._cache.set(token, entry)
+        return entry
+
+    def forget_debt(self, debt_id):
+        """Drop stored snapshots of a debt after it changed"""
+        for token, (payload, snapshot) in self._cache.items():
+            if snapshot is not None and payload.get('debt_id') == debt_id:
+                self._cache.set(token, (payload, None))
+        self._queue("UPDATE callback_tokens SET snapshot = NULL WHERE debt_id = ? AND snapshot IS NOT NULL",
+                    (debt_id,))
+
+    async def purge(self):
+        async with self.pool.writer() as db:
+            cursor = await db.execute("DELETE FROM callback_tokens WHERE expires_at <= ?", (time.time(),))
+            await db.commit()
+        if cursor.rowcount:
+            logger.info(f"Purged {cursor.rowcount} expired callback tokens")
+
+    def _queue(self, sql, params):
+        self._ops.append((sql, params))
+        if self._flush_task is None:
+            self._flush_task = asyncio.get_running_loop().create_task(self._write())
+
+    async def _write(self):
+        # Let the rest of this update queue its tokens, then write them in one transaction
+        await asyncio.sleep(0)
+        self._flush_task = None
+        ops, self._ops = self._ops, []
+        try:
+            async with self.pool.writer() as db:
+                # Order matters (a forget must not hit a newer snapshot), so only runs of one statement are batched
+                for sql, group in itertools.groupby(ops, key=lambda op: op[0]):
+                    await db.executemany(sql, [params for _, params in group])
+                await db.commit()
+        except Exception as e:
+            logger.error(f"Callback token write of {len(ops)} changes failed: {e}")
+
+    async def flush(self):
+        """Wait until queued writes have reached the database"""
+        while self._flush_task is not None:
+            await self._flush_task
+
+callback_store = CallbackStore(db_pool)
+
+def debt_token(debt):
+    """callback_store token for a debt row that was just loaded"""
+    return callback_store.put({'debt_id': debt['id']}, debt)
+
+async def debt_from_token(token):
+    """Debt row behind a debt button: the stored snapshot, or a fresh lookup once it went stale"""
+    entry = await callback_store.get(token)
+    if entry is None:
+        return None
+    payload, snapshot = entry
+    return snapshot or await get_debt_by_id(payload['debt_id'])
+
+# ---- Per-user rollups ----
+# user_rollups holds one row per (user_id, currency) and is updated in the same
+# transaction as every debt/expense write, so statistics are a primary-key lookup.
+# day_*/month_* columns belong to the bucket named by day_key/month_key and are
+# ignored once that day or month is over.
+
+async def _bump_debt_rollup(db, user_id, currency, debt_type, amount_delta, count_delta):
+    if debt_type not in ('given', 'taken'):
+        return
+    await db.execute(f"""
+        INSERT INTO user_rollups (user_id, currency, {debt_type}_total, {debt_type}_count) VALUES (?, ?, ?, ?)
+        ON CONFLICT (user_id, currency) DO UPDATE SET
+            {debt_type}_total = {debt_type}_total + excluded.{debt_type}_total,
+            {debt_type}_count = {debt_type}_count + excluded.{debt_type}_count
+    """, (user_id, currency, amount_delta, count_delta))
+
+async def _bump_expense_rollup(db, user_id, currency, expense_date, amount_delta, count_delta):
+    month_key = expense_date.replace(day=1)
+    # Same bucket: accumulate. Newer bucket (insert only): start it over. Older bucket: untouched.
+    await db.execute("""
+        INSERT INTO user_rollups (user_id, currency, day_key, day_total, day_count, month_key, month_total, month_count)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (user_id, currency) DO UPDATE SET
+            day_total = CASE WHEN day_key = excluded.day_key THEN day_total + excluded.day_total
+                             WHEN (day_key IS NULL OR day_key < excluded.day_key) AND excluded.day_count > 0 THEN excluded.day_total
+                             ELSE day_total END,
+            day_count = CASE WHEN day_key = excluded.day_key THEN day_count + excluded.day_count
+                             WHEN (day_key IS NULL OR day_key < excluded.day_key) AND excluded.day_count > 0 THEN excluded.day_count
+                             ELSE day_count END,
+            day_key = CASE WHEN (day_key IS NULL OR day_key < excluded.day_key) AND excluded.day_count > 0 THEN excluded.day_key
+                           ELSE day_key END,
+            month_total = CASE WHEN month_key = excluded.month_key THEN month_total + excluded.month_total
+                               WHEN (month_key IS NULL OR month_key < excluded.month_key) AND excluded.month_count > 0 THEN excluded.month_total
+                               ELSE month_total END,
+            month_count = CASE WHEN month_key = excluded.month_key THEN month_count + excluded.month_count
+                               WHEN (month_key IS NULL OR month_key < excluded.month_key) AND excluded.month_count > 0 THEN excluded.month_count
+                               ELSE month_count END,
+            month_key = CASE WHEN (month_key IS NULL OR month_key < excluded.month_key) AND excluded.month_count > 0 THEN excluded.month_key
+                             ELSE month_key END
+    """, (user_id, currency, expense_date, amount_delta, count_delta, month_key, amount_delta, count_delta))
+
+# Rollup values recomputed from the base tables, relative to :today
+ROLLUP_SOURCE_SQL = """
+    SELECT user_id, currency,
+           SUM(given_total), SUM(given_count), SUM(taken_total), SUM(taken_count),
+           SUM(day_total), SUM(day_count), SUM(month_total), SUM(month_count)
+    FROM (
+        SELECT user_id, currency,
+               SUM(CASE WHEN debt_type = 'given' THEN amount ELSE 0 END) AS given_total,
+               SUM(debt_type = 'given') AS given_count,
+               SUM(CASE WHEN debt_type = 'taken' THEN amount ELSE 0 END) AS taken_total,
+               SUM(debt_type = 'taken') AS taken_count,
+               0 AS day_total, 0 AS day_count, 0 AS month_total, 0 AS month_count
+        FROM debts WHERE is_paid = 0 GROUP BY user_id, currency
+        UNION ALL
+        SELECT user_id, currency, 0, 0, 0, 0,
+               SUM(CASE WHEN expense_date >= :today AND expense_date < :tomorrow THEN amount ELSE 0 END),
+               SUM(expense_date >= :today AND expense_date < :tomorrow),
+               SUM(amount), COUNT(*)
+        FROM daily_expenses
+        WHERE expense_date >= :month_start AND expense_date < :next_month
+        GROUP BY user_id, currency
+    )
+    GROUP BY user_id, currency
+"""
+
+ROLLUP_FIELDS = ('given_total', 'given_count', 'taken_total', 'taken_count',
+                 'day_total', 'day_count', 'month_total', 'month_count')
+
+def _rollup_params(today):
+    month_start, next_month = month_range(today)
+    return {'today': today, 'tomorrow': today + timedelta(days=1),
+            'month_start': month_start, 'next_month': next_month}
+
+async def rebuild_rollups(db, today=None):
+    """Recompute user_rollups from scratch inside the caller's transaction"""
+    today = today or date.today()
+    await db.execute("DELETE FROM user_rollups")
+    await db.execute(f"""
+        INSERT INTO user_rollups (user_id, currency, {', '.join(ROLLUP_FIELDS)}, day_key, month_key)
+        SELECT *, :today, :month_start FROM ({ROLLUP_SOURCE_SQL})
+    """, _rollup_params(today))
+
+async def verify_rollups(today=None):
+    """Compare stored rollups with a fresh aggregation; returns a list of drift rows"""
+    today = today or date.today()
+    params = _rollup_params(today)
+    async with db_pool.reader() as db:
+        cursor = await db.execute(ROLLUP_SOURCE_SQL, params)
+        expected = {(row[0], row[1]): dict(zip(ROLLUP_FIELDS, row[2:])) for row in await cursor.fetchall()}
+        cursor = await db.execute("SELECT * FROM user_rollups")
+        stored = {}
+        for row in await cursor.fetchall():
+            values = {field: row[field] for field in ROLLUP_FIELDS}
+            if row['day_key'] != today:
+                values.update(day_total=0, day_count=0)
+            if row['month_key'] != params['month_start']:
+                values.update(month_total=0, month_count=0)
+            stored[(row['user_id'], row['currency'])] = values
+    
+    drift = []
+    zero = dict.fromkeys(ROLLUP_FIELDS, 0)
+    for key in expected.keys() | stored.keys():
+        want, have = expected.get(key, zero), stored.get(key, zero)
+        for field in ROLLUP_FIELDS:
+            if abs((want[field] or 0) - (have[field] or 0)) > 0.005:
+                drift.append((key[0], key[1], field, have[field], want[field]))
+    return drift
+
+async def rollups_command(rebuild=False):
+    """CLI: report rollup drift and optionally rebuild (python bot.py --verify-rollups | --rebuild-rollups)"""
+    await init_db()
+    drift = await verify_rollups()
+    for user_id, currency, field, stored, actual in drift:
+        logger.warning(f"Rollup drift user={user_id} {currency} {field}: stored={stored} actual={actual}")
+    logger.info(f"Rollup check: {len(drift)} drifted values")
+    if rebuild:
+        async with db_pool.writer() as db:
+            await rebuild_rollups(db)
+            await db.commit()
+        logger.info("Rollups rebuilt")
+    await db_pool.close()
+    return drift
+
+# ---- Write-behind queue ----
+DEBT_INSERT_SQL = """
+    INSERT INTO debts (user_id, person_name, phone_number, amount, currency, debt_type, payment_type, given_date, due_date)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+EXPENSE_INSERT_SQL = """
+    INSERT INTO daily_expenses (user_id, description, amount, currency, category, expense_date)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+async def _after_debt_insert(db, rows, ids):
+    await _schedule_reminders(db, [(debt_id, row[8]) for debt_id, row in zip(ids, rows)])
+    deltas = {}
+    for user_id, _, _, amount, currency, debt_type, *_ in rows:
+        total, count = deltas.get((user_id, currency, debt_type), (0, 0))
+        deltas[(user_id, currency, debt_type)] = (total + amount, count + 1)
+    for (user_id, currency, debt_type), (total, count) in deltas.items():
+        await _bump_debt_rollup(db, user_id, currency, debt_type, total, count)
+
+async def _after_expense_insert(db, rows, ids):
+    deltas = {}
+    for user_id, _, amount, currency, _, expense_date in rows:
+        total, count = deltas.get((user_id, currency, expense_date), (0, 0))
+        deltas[(user_id, currency, expense_date)] = (total + amount, count + 1)
+    for (user_id, currency, expense_date), (total, count) in deltas.items():
+        await _bump_expense_rollup(db, user_id, currency, expense_date, total, count)
+
+# kind -> (insert statement, follow-up writes for the inserted parameter rows and their ids)
+WRITE_BEHIND_KINDS = {
+    'debt': (DEBT_INSERT_SQL, _after_debt_insert),
+    'expense': (EXPENSE_INSERT_SQL, _after_expense_insert),
+}
+
+class WriteBehindQueue:
+    """Single writer task that group-commits queued inserts.
+
+    submit() waits for a free slot (the queue is bounded, so bursts push back on
+    handlers instead of growing memory) and resolves with the new row id once the
+    batch holding it is committed. A batch closes at WRITE_BATCH_SIZE rows or
+    WRITE_BATCH_MS after its first row, whichever comes first.
+    """
+
+    def __init__(self, pool, batch_size=WRITE_BATCH_SIZE, batch_ms=WRITE_BATCH_MS, maxsize=WRITE_QUEUE_SIZE):
+        self.pool = pool
+        self.batch_size = max(1, batch_size)
+        self.batch_delay = batch_ms / 1000
+        self.maxsize = maxsize
+        self._queue = None
+        self._wakeup = None
+        self._task = None
+
+    @property
+    def running(self):
+        return self._task is not None
+
+    def start(self):
+        self._queue = asyncio.Queue(self.maxsize)
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Write-behind enabled: batch {self.batch_size} rows / {self.batch_delay * 1000:.0f} ms")
+
+    async def submit(self, kind, params):
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((kind, params, future))
+        self._wakeup.set()
+        return await future
+
+    async def close(self):
+        """Flush everything already queued, then stop the writer task"""
+        if self._task is None:
+            return
+        await self._queue.join()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _collect(self):
+        batch = [await self._queue.get()]
+        deadline = asyncio.get_running_loop().time() + self.batch_delay
+        while True:
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            remaining = deadline - asyncio.get_running_loop().time()
+            if len(batch) >= self.batch_size or remaining <= 0:
+                return batch
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+            try:
+                await self._flush(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _flush(self, batch):
+        by_kind = {}
+        for kind, params, future in batch:
+            by_kind.setdefault(kind, []).append((params, future))
+        try:
+            ids = {}
+            async with self.pool.writer() as db:
+                for kind, items in by_kind.items():
+                    sql, after_insert = WRITE_BEHIND_KINDS[kind]
+                    rows = [params for params, _ in items]
+                    await db.executemany(sql, rows)
+                    # AUTOINCREMENT ids from one executemany on the only writer are consecutive
+                    cursor = await db.execute("SELECT last_insert_rowid()")
+                    last_id = (await cursor.fetchone())[0]
+                    ids[kind] = range(last_id - len(rows) + 1, last_id + 1)
+                    await after_insert(db, rows, ids[kind])
+                await db.commit()
+        except Exception as e:
+            if len(batch) == 1:
+                future = batch[0][2]
+                if not future.done():
+                    future.set_exception(e)
+                return
+            # Retry row by row so one bad row does not fail its neighbours
+            logger.warning(f"Write-behind batch of {len(batch)} failed ({e}), retrying rows individually")
+            for item in batch:
+                await self._flush([item])
+            return
+        for kind, items in by_kind.items():
+            for (_, future), row_id in zip(items, ids[kind]):
+                if not future.done():
+                    future.set_result(row_id)
+
+write_behind = WriteBehindQueue(db_pool)
+
+user_cache = LRUCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+async def get_or_create_user(telegram_id, full_name, username=None):
+    user = user_cache.get(telegram_id)
+    if user and user['full_name'] == full_name and user['username'] == username:
+        return user
+    
+    async with db_pool.reader() as db:
+        cursor = await db.execute("SELECT * FROM users WHERE telegram_id = ?", (telegram_id,))
+        row = await cursor.fetchone()
+    if row:
+        user = dict(row)
+        if user['full_name'] != full_name or user['username'] != username:
+            async with db_pool.writer() as db:
+                await db.execute("UPDATE users SET full_name = ?, username = ? WHERE id = ?",
+                                (full_name, username, user['id']))
+                await db.commit()
+            user.update(full_name=full_name, username=username)
+    else:
+        async with db_pool.writer() as db:
+            await db.execute("INSERT OR IGNORE INTO users (telegram_id, full_name, username) VALUES (?, ?, ?)",
+                            (telegram_id, full_name, username))
+            await db.commit()
+            cursor = await db.execute("SELECT * FROM users WHERE telegram_id = ?", (telegram_id,))
+            user = dict(await cursor.fetchone())
+    
+    user_cache.set(telegram_id, user)
+    return user
+
+async def add_debt(user_id, person_name, phone_number, amount, currency, debt_type, payment_type, given_date, due_date,
+                   installment_months=None):
+    """Insert a debt; with installment_months, due_date is the first of that many monthly installments"""
+    params = (user_id, person_name, phone_number, amount, currency, debt_type, payment_type, given_date, due_date)
+    schedule = installment_schedule(amount, installment_months, due_date) if installment_months else None
+    # Installment debts skip the write-behind queue: their schedule goes in the same transaction
+    if write_behind.running and not schedule:
+        debt_id = await write_behind.submit('debt', params)
+    else:
+        async with db_pool.writer() as db:
+            cursor = await db.execute(DEBT_INSERT_SQL, params)
+            debt_id = cursor.lastrowid
+            await _bump_debt_rollup(db, user_id, currency, debt_type, amount, 1)
+            if schedule:
+                await _add_installments(db, debt_id, schedule)
+            else:
+                await _schedule_reminders(db, [(debt_id, due_date)])
+            await db.commit()
+    due_scheduler.schedule(debt_id, *([day for day, _ in schedule] if schedule else [due_date]))
+    return debt_id
 
 async def get_previous_contacts(user_id):
     """Get list of previous contacts (people user has given/taken debts from)"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.reader() as db:
         cursor = await db.execute("""
             SELECT DISTINCT person_name, phone_number FROM debts 
             WHERE user_id = ? 
@@ -276,112 +1699,836 @@ async def get_previous_contacts(user_id):
         """, (user_id,))
         return await cursor.fetchall()
 
-async def get_debts_by_type(user_id, debt_type):
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute("""
-            SELECT * FROM debts WHERE user_id = ? AND debt_type = ? AND is_paid = 0
-            ORDER BY due_date ASC
-        """, (user_id, debt_type))
-        return [dict(row) for row in await cursor.fetchall()]
+async def _keyset_page(table, record, where, params, key, seek, before, descending, page_size):
+    """One page of `table` as `record` rows, ordered by (`key`, id), seeking from `seek` instead of OFFSET.
+
+    `seek` is the (key, id) of the last row shown (first row when `before`, i.e. walking
+    back toward page one). Fetches page_size + 1 rows; the returned flag says whether
+    more rows exist in the direction of travel. NULL keys sort first, as SQLite orders them.
+    """
+    ascending = descending == before
+    order = "ASC" if ascending else "DESC"
+    if seek:
+        op = '>' if ascending else '<'
+        if seek[0] is None:
+            # A row-value comparison with NULL matches nothing: seek within the NULL run instead
+            cond = f"{key} IS NULL AND id {op} ?" + (f" OR {key} IS NOT NULL" if ascending else "")
+            seek = seek[1:]
+        else:
+            cond = f"({key}, id) {op} (?, ?)" + ("" if ascending else f" OR {key} IS NULL")
+        where += f" AND ({cond})"
+        params = (*params, *seek)
+    async with db_pool.reader() as db:
+        cursor = await db.execute(
+            f"SELECT {columns(record)} FROM {table} WHERE {where} ORDER BY {key} {order}, id {order} LIMIT ?",
+            (*params, page_size + 1))
+        rows = await cursor.fetchall()
+    has_more = len(rows) > page_size
+    rows = [record._make(row) for row in rows[:page_size]]
+    if before:
+        rows.reverse()
+    return rows, has_more
+
+async def get_debts_page(user_id, debt_type, seek=None, before=False, page_size=DEBT_PAGE_SIZE):
+    """Active debts of one type, soonest due first"""
+    return await _keyset_page("debts", Debt, "user_id = ? AND debt_type = ? AND is_paid = 0", (user_id, debt_type),
+                              "due_date", seek, before, False, page_size)
 
 async def get_debt_by_id(debt_id):
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute("SELECT * FROM debts WHERE id = ?", (debt_id,))
+    async with db_pool.reader() as db:
+        cursor = await db.execute(f"SELECT {columns(Debt)} FROM debts WHERE id = ?", (debt_id,))
         row = await cursor.fetchone()
-        return dict(row) if row else None
+        return Debt._make(row) if row else None
+
+async def _fetch_debt_for_update(db, debt_id):
+    # Runs on the writer connection, so nothing can change the row before our update
+    cursor = await db.execute("SELECT user_id, currency, debt_type, payment_type, amount, is_paid FROM debts WHERE id = ?",
+                              (debt_id,))
+    return await cursor.fetchone()
 
 async def mark_debt_paid(debt_id):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.writer() as db:
+        debt = await _fetch_debt_for_update(db, debt_id)
+        if not debt or debt['is_paid']:
+            return
         await db.execute("UPDATE debts SET is_paid = 1 WHERE id = ?", (debt_id,))
+        await db.execute("UPDATE installments SET is_paid = 1, paid_date = ? WHERE debt_id = ? AND is_paid = 0",
+                         (current_date(), debt_id))
+        await _bump_debt_rollup(db, debt['user_id'], debt['currency'], debt['debt_type'], -debt['amount'], -1)
+        await _cancel_reminders(db, debt_id)
         await db.commit()
+    due_scheduler.discard(debt_id)
+    callback_store.forget_debt(debt_id)
 
 async def delete_debt(debt_id):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.writer() as db:
+        debt = await _fetch_debt_for_update(db, debt_id)
+        if not debt:
+            return
+        await db.execute("DELETE FROM reminders WHERE debt_id = ?", (debt_id,))
+        await db.execute("DELETE FROM installments WHERE debt_id = ?", (debt_id,))
         await db.execute("DELETE FROM debts WHERE id = ?", (debt_id,))
+        if not debt['is_paid']:
+            await _bump_debt_rollup(db, debt['user_id'], debt['currency'], debt['debt_type'], -debt['amount'], -1)
         await db.commit()
+    due_scheduler.discard(debt_id)
+    callback_store.forget_debt(debt_id)
 
 async def update_debt_amount(debt_id, new_amount):
-    """Update debt amount after partial payment"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    """Update debt amount after partial payment; the paid part settles installments oldest first"""
+    async with db_pool.writer() as db:
+        debt = await _fetch_debt_for_update(db, debt_id)
+        if not debt:
+            return False
         await db.execute("UPDATE debts SET amount = ? WHERE id = ?", (new_amount, debt_id))
+        if not debt['is_paid']:
+            await _bump_debt_rollup(db, debt['user_id'], debt['currency'], debt['debt_type'], new_amount - debt['amount'], 0)
+        if debt['payment_type'] == 'installment':
+            await _pay_installments(db, debt_id, debt['amount'] - new_amount)
         await db.commit()
+    callback_store.forget_debt(debt_id)
+    return True
 
 async def update_debt_field(debt_id, field, value):
     """Update a specific field of a debt"""
     allowed_fields = ['person_name', 'phone_number', 'amount', 'due_date']
     if field not in allowed_fields:
         return False
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.writer() as db:
+        debt = await _fetch_debt_for_update(db, debt_id)
+        if not debt:
+            return False
         await db.execute(f"UPDATE debts SET {field} = ? WHERE id = ?", (value, debt_id))
+        installments = debt['payment_type'] == 'installment' and not debt['is_paid']
+        if field == 'amount' and not debt['is_paid']:
+            await _bump_debt_rollup(db, debt['user_id'], debt['currency'], debt['debt_type'], value - debt['amount'], 0)
+            if installments:
+                await _reschedule_installments(db, debt_id, amount=value)
+        if field == 'due_date' and not debt['is_paid']:
+            await _cancel_reminders(db, debt_id)
+            # On installment debts the new date is the next installment's; later ones follow it monthly
+            due_dates = installments and await _reschedule_installments(db, debt_id, first_due=value)
+            if due_dates:
+                await _schedule_installment_reminders(db, debt_id)
+            else:
+                due_dates = [value]
+                await _schedule_reminders(db, [(debt_id, value)])
         await db.commit()
-        return True
+    if field == 'due_date' and not debt['is_paid']:
+        due_scheduler.schedule(debt_id, *due_dates)
+    callback_store.forget_debt(debt_id)
+    return True
 
 async def add_expense(user_id, description, amount, currency, category):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-            INSERT INTO daily_expenses (user_id, description, amount, currency, category, expense_date)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (user_id, description, amount, currency, category, date.today()))
+    expense_date = current_date()
+    params = (user_id, description, amount, currency, category, expense_date)
+    if write_behind.running:
+        return await write_behind.submit('expense', params)
+    async with db_pool.writer() as db:
+        cursor = await db.execute(EXPENSE_INSERT_SQL, params)
+        await _bump_expense_rollup(db, user_id, currency, expense_date, amount, 1)
         await db.commit()
+        return cursor.lastrowid
 
-async def get_expenses(user_id, limit=20):
-    """Get recent expenses for a user"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
+async def get_expenses_page(user_id, seek=None, before=False, page_size=EXPENSE_PAGE_SIZE):
+    """Expenses, newest first"""
+    return await _keyset_page("daily_expenses", Expense, "user_id = ?", (user_id,),
+                              "expense_date", seek, before, True, page_size)
+
+async def get_expense_totals(user_id):
+    """All-time expense totals per currency and overall count"""
+    async with db_pool.reader() as db:
         cursor = await db.execute("""
-            SELECT * FROM daily_expenses WHERE user_id = ? 
-            ORDER BY expense_date DESC, id DESC LIMIT ?
-        """, (user_id, limit))
-        return [dict(row) for row in await cursor.fetchall()]
+            SELECT currency, SUM(amount), COUNT(*) FROM daily_expenses
+            WHERE user_id = ? GROUP BY currency
+        """, (user_id,))
+        rows = await cursor.fetchall()
+    return {row[0]: row[1] for row in rows}, sum(row[2] for row in rows)
 
 async def get_expense_by_id(expense_id):
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute("SELECT * FROM daily_expenses WHERE id = ?", (expense_id,))
+    async with db_pool.reader() as db:
+        cursor = await db.execute(f"SELECT {columns(Expense)} FROM daily_expenses WHERE id = ?", (expense_id,))
         row = await cursor.fetchone()
-        return dict(row) if row else None
+        return Expense._make(row) if row else None
 
 async def delete_expense(expense_id):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.writer() as db:
+        cursor = await db.execute("SELECT user_id, currency, amount, expense_date FROM daily_expenses WHERE id = ?", (expense_id,))
+        expense = await cursor.fetchone()
+        if not expense:
+            return
         await db.execute("DELETE FROM daily_expenses WHERE id = ?", (expense_id,))
+        await _bump_expense_rollup(db, expense['user_id'], expense['currency'], expense['expense_date'], -expense['amount'], -1)
         await db.commit()
 
 async def get_statistics(user_id):
-    async with aiosqlite.connect(DB_PATH) as db:
-        stats = {'given_active': {}, 'taken_active': {}, 'given_count': 0, 'taken_count': 0, 
-                 'monthly_expenses': {}, 'today_expenses': {}}
-        cursor = await db.execute("""
-            SELECT currency, SUM(amount) FROM debts WHERE user_id = ? AND debt_type = 'given' AND is_paid = 0 GROUP BY currency
-        """, (user_id,))
-        stats['given_active'] = {row[0]: row[1] for row in await cursor.fetchall()}
-        
-        cursor = await db.execute("""
-            SELECT currency, SUM(amount) FROM debts WHERE user_id = ? AND debt_type = 'taken' AND is_paid = 0 GROUP BY currency
-        """, (user_id,))
-        stats['taken_active'] = {row[0]: row[1] for row in await cursor.fetchall()}
-        
-        cursor = await db.execute("SELECT COUNT(*) FROM debts WHERE user_id = ? AND debt_type = 'given' AND is_paid = 0", (user_id,))
-        stats['given_count'] = (await cursor.fetchone())[0]
-        
-        cursor = await db.execute("SELECT COUNT(*) FROM debts WHERE user_id = ? AND debt_type = 'taken' AND is_paid = 0", (user_id,))
-        stats['taken_count'] = (await cursor.fetchone())[0]
-        
-        today = date.today()
+    """Statistics from the user's rollup rows (primary-key lookup)"""
+    stats = {'given_active': {}, 'taken_active': {}, 'given_count': 0, 'taken_count': 0, 
+             'monthly_expenses': {}, 'today_expenses': {}}
+    today = current_date()
+    async with db_pool.reader() as db:
+        cursor = await db.execute("SELECT * FROM user_rollups WHERE user_id = ?", (user_id,))
+        rows = await cursor.fetchall()
+    
+    for row in rows:
+        currency = row['currency']
+        for debt_type in ('given', 'taken'):
+            if row[f'{debt_type}_count'] > 0:
+                stats[f'{debt_type}_active'][currency] = row[f'{debt_type}_total']
+                stats[f'{debt_type}_count'] += row[f'{debt_type}_count']
+        if row['day_key'] == today and row['day_count'] > 0:
+            stats['today_expenses'][currency] = row['day_total']
+        if row['month_key'] == today.replace(day=1) and row['month_count'] > 0:
+            stats['monthly_expenses'][currency] = row['month_total']
+    
+    return stats
+
+async def _schedule_reminders(db, debts):
+    """Insert pending reminder rows for (debt_id, due_date) pairs"""
+    today = current_date()
+    rows = [(debt_id, day) for debt_id, due_date in debts if due_date for day in reminder_dates(due_date, today)]
+    if rows:
+        await db.executemany("INSERT INTO reminders (debt_id, remind_date) VALUES (?, ?)", rows)
+
+async def _cancel_reminders(db, debt_id):
+    await db.execute("DELETE FROM reminders WHERE debt_id = ? AND is_sent = 0", (debt_id,))
+
+async def backfill_reminders(db):
+    """Schedule reminders for active debts that were created before the reminders table existed"""
+    cursor = await db.execute("SELECT id, due_date FROM debts WHERE is_paid = 0 AND due_date >= ?", (current_date(),))
+    await _schedule_reminders(db, await cursor.fetchall())
+
+# ---- Installments ----
+# An installment debt keeps due_date on its next unpaid installment, so lists, the
+# overdue digest and the detail view follow the schedule without extra queries.
+UNPAID_INSTALLMENTS_SQL = "SELECT id, amount, due_date FROM installments WHERE debt_id = ? AND is_paid = 0 ORDER BY due_date, id"
+
+async def _add_installments(db, debt_id, schedule):
+    """Write a new debt's installment_schedule() with one executemany, plus reminders for each"""
+    await db.executemany("INSERT INTO installments (debt_id, amount, due_date) VALUES (?, ?, ?)",
+                         [(debt_id, amount, day) for day, amount in schedule])
+    await _schedule_installment_reminders(db, debt_id)
+
+async def _schedule_installment_reminders(db, debt_id):
+    """Insert pending reminder rows for every unpaid installment of a debt"""
+    cursor = await db.execute(UNPAID_INSTALLMENTS_SQL, (debt_id,))
+    today = current_date()
+    rows = [(debt_id, row['id'], day) for row in await cursor.fetchall() for day in reminder_dates(row['due_date'], today)]
+    if rows:
+        await db.executemany("INSERT INTO reminders (debt_id, installment_id, remind_date) VALUES (?, ?, ?)", rows)
+
+async def _pay_installments(db, debt_id, paid):
+    """Settle unpaid installments oldest first with `paid`; what is left reduces the next one"""
+    cursor = await db.execute(UNPAID_INSTALLMENTS_SQL, (debt_id,))
+    settled = []
+    for row in await cursor.fetchall():
+        if paid < row['amount'] - 0.005:
+            if paid > 0:
+                await db.execute("UPDATE installments SET amount = ? WHERE id = ?", (round(row['amount'] - paid, 2), row['id']))
+            break
+        paid -= row['amount']
+        settled.append(row['id'])
+    if not settled:
+        return
+    today = current_date()
+    await db.executemany("UPDATE installments SET is_paid = 1, paid_date = ? WHERE id = ?", [(today, i) for i in settled])
+    await db.executemany("DELETE FROM reminders WHERE debt_id = ? AND installment_id = ? AND is_sent = 0",
+                         [(debt_id, i) for i in settled])
+    cursor = await db.execute(UNPAID_INSTALLMENTS_SQL + " LIMIT 1", (debt_id,))
+    row = await cursor.fetchone()
+    if row:
+        await db.execute("UPDATE debts SET due_date = ? WHERE id = ?", (row['due_date'], debt_id))
+
+async def _reschedule_installments(db, debt_id, amount=None, first_due=None):
+    """Spread a new remaining `amount` over the unpaid installments, or move them to start on
+    `first_due`; returns their due dates (empty if the debt has no schedule)"""
+    cursor = await db.execute(UNPAID_INSTALLMENTS_SQL, (debt_id,))
+    rows = await cursor.fetchall()
+    if not rows:
+        return []
+    plan = installment_schedule(amount or 0, len(rows), first_due or rows[0]['due_date'])
+    updates = [(new_amount if amount is not None else row['amount'], day if first_due else row['due_date'], row['id'])
+               for row, (day, new_amount) in zip(rows, plan)]
+    await db.executemany("UPDATE installments SET amount = ?, due_date = ? WHERE id = ?", updates)
+    return [day for _, day, _ in updates]
+
+async def get_next_installment(debt_id):
+    """Next unpaid installment of a debt plus how many are left (`remaining`), or None"""
+    async with db_pool.reader() as db:
         cursor = await db.execute("""
-            SELECT currency, SUM(amount) FROM daily_expenses WHERE user_id = ? AND expense_date = ? GROUP BY currency
-        """, (user_id, today))
-        stats['today_expenses'] = {row[0]: row[1] for row in await cursor.fetchall()}
-        
+            SELECT id, amount, due_date,
+                   (SELECT COUNT(*) FROM installments WHERE debt_id = ?1 AND is_paid = 0) AS remaining
+            FROM installments WHERE debt_id = ?1 AND is_paid = 0
+            ORDER BY due_date, id LIMIT 1
+        """, (debt_id,))
+        return await cursor.fetchone()
+
+# Installment reminders name the installment's own amount and date
+# Reminders are the outer loop (CROSS JOIN), read through idx_reminders_pending, so
+# only reminders already due are visited. Keyset-paged on (telegram_id, reminder id):
+# each page sorts what is left of that reduced set.
+_DUE_REMINDERS_SQL = """
+    SELECT r.id, r.debt_id, u.telegram_id, d.person_name, d.amount, d.currency, d.debt_type, d.due_date,
+           i.amount AS installment_amount, i.due_date AS installment_due
+    FROM {reminders}
+    CROSS JOIN debts d ON d.id = r.debt_id AND d.is_paid = 0
+    CROSS JOIN users u ON u.id = d.user_id
+    LEFT JOIN installments i ON i.id = r.installment_id
+    WHERE r.remind_date <= :today AND r.is_sent = 0
+      AND (u.telegram_id, r.id) > (:after_key, :after_id)
+    ORDER BY u.telegram_id, r.id
+    LIMIT :limit
+"""
+DUE_REMINDERS_SQL = _DUE_REMINDERS_SQL.format(reminders="reminders r INDEXED BY idx_reminders_pending")
+# Only the reminders of the debts in the :debt_ids JSON array, looked up by debt
+DUE_DEBT_REMINDERS_SQL = _DUE_REMINDERS_SQL.format(
+    reminders="json_each(:debt_ids) j CROSS JOIN reminders r ON r.debt_id = j.value")
+
+def _by_due_date(rows):
+    # Stable, so rows due the same day keep their id order
+    return sorted(rows, key=lambda row: row['due_date'] or date.min)
+
+async def _iter_groups(sql, params, key, id_key, fetch_size):
+    """Yield (key, rows) groups from `sql`, which is ordered by (`key`, `id_key`) and pages
+    with :after_key, :after_id and :limit.
+
+    Reads in keyset chunks so no reader connection is held while the caller works on a
+    group. A group's rows are gathered across chunks and yielded once its key changes.
+    """
+    after_key, after_id = -2 ** 63, 0
+    current, group = None, []
+    while True:
+        async with db_pool.reader() as db:
+            cursor = await db.execute(sql, {**params, 'after_key': after_key, 'after_id': after_id, 'limit': fetch_size})
+            rows = await cursor.fetchall()
+        for row in rows:
+            if group and row[key] != current:
+                yield current, group
+                group = []
+            current = row[key]
+            group.append(row)
+        if len(rows) < fetch_size:
+            break
+        after_key, after_id = rows[-1][key], rows[-1][id_key]
+    if group:
+        yield current, group
+
+async def iter_due_reminders(today=None, fetch_size=REMINDER_FETCH_SIZE, debt_ids=None):
+    """Yield (telegram_id, rows) for every chat with due reminders, in telegram_id order;
+    with `debt_ids`, only for reminders of those debts"""
+    params = {'today': today or date.today()}
+    sql = DUE_REMINDERS_SQL
+    if debt_ids is not None:
+        params['debt_ids'] = json.dumps(sorted(debt_ids))
+        sql = DUE_DEBT_REMINDERS_SQL
+    async for telegram_id, rows in _iter_groups(sql, params, 'telegram_id', 'id', fetch_size):
+        yield telegram_id, _by_due_date(rows)
+
+# Driven the same way by idx_debts_active_due (only unpaid debts already past due),
+# paged on (user_id, debt id)
+OVERDUE_DEBTS_SQL = """
+    SELECT d.id, d.user_id, u.telegram_id, d.person_name, d.amount, d.currency, d.debt_type, d.due_date,
+           i.amount AS installment_amount, i.due_date AS installment_due
+    FROM debts d INDEXED BY idx_debts_active_due
+    CROSS JOIN users u ON u.id = d.user_id
+    LEFT JOIN installments i ON i.debt_id = d.id AND i.is_paid = 0 AND i.due_date = d.due_date
+    WHERE d.is_paid = 0 AND d.due_date < :today AND (d.user_id, d.id) > (:after_key, :after_id)
+    ORDER BY d.user_id, d.id
+    LIMIT :limit
+"""
+
+async def iter_overdue_debts(today=None, fetch_size=REMINDER_FETCH_SIZE):
+    """Yield (telegram_id, debts) per user with overdue debts, oldest due date first"""
+    params = {'today': today or date.today()}
+    async for _, rows in _iter_groups(OVERDUE_DEBTS_SQL, params, 'user_id', 'id', fetch_size):
+        yield rows[0]['telegram_id'], _by_due_date(rows)
+
+async def mark_reminders_sent(reminder_ids):
+    async with db_pool.writer() as db:
+        await db.executemany("UPDATE reminders SET is_sent = 1 WHERE id = ?", [(i,) for i in reminder_ids])
+        await db.commit()
+
+async def get_debt_totals(user_id, debt_type):
+    """Active totals per currency and overall count for one debt type, from rollups"""
+    async with db_pool.reader() as db:
         cursor = await db.execute("""
-            SELECT currency, SUM(amount) FROM daily_expenses WHERE user_id = ? AND strftime('%Y-%m', expense_date) = ? GROUP BY currency
-        """, (user_id, today.strftime('%Y-%m')))
-        stats['monthly_expenses'] = {row[0]: row[1] for row in await cursor.fetchall()}
-        
-        return stats
+            SELECT currency, total, count FROM (
+                SELECT currency,
+                       CASE :debt_type WHEN 'given' THEN given_total ELSE taken_total END AS total,
+                       CASE :debt_type WHEN 'given' THEN given_count ELSE taken_count END AS count
+                FROM user_rollups WHERE user_id = :user_id
+            ) WHERE count > 0
+        """, {'user_id': user_id, 'debt_type': debt_type})
+        rows = await cursor.fetchall()
+    return {row[0]: row[1] for row in rows}, sum(row[2] for row in rows)
+
+# ---- Currency rates ----
+def _rates_from_json(data):
+    """{currency: UZS rate} from {"USD": 12700} or the CBU feed's [{"Ccy": "USD", "Rate": "12700.5"}, ...]"""
+    if isinstance(data, list):
+        data = {item['Ccy']: item['Rate'] for item in data}
+    return {currency: float(data[currency]) for currency in CURRENCIES if currency in data}
+
+class FixedRateProvider:
+    async def fetch(self):
+        return {'USD': USD_TO_UZS_RATE}
+
+class FileRateProvider:
+    def __init__(self, path):
+        self.path = path
+
+    def _read(self):
+        with open(self.path, encoding='utf-8') as f:
+            return json.load(f)
+
+    async def fetch(self):
+        return _rates_from_json(await asyncio.to_thread(self._read))
+
+class HttpRateProvider:
+    def __init__(self, url, timeout=10):
+        self.url = url
+        self.timeout = timeout
+
+    async def fetch(self):
+        async with httpx.AsyncClient(timeout=self.timeout) as client:
+            response = await client.get(self.url)
+            response.raise_for_status()
+            return _rates_from_json(response.json())
+
+RATE_PROVIDERS = {
+    'fixed': lambda: FixedRateProvider(),
+    'file': lambda: FileRateProvider(RATES_FILE),
+    'http': lambda: HttpRateProvider(RATES_URL),
+}
+
+def make_rate_provider(name):
+    """A misspelled RATE_PROVIDER stops startup instead of silently serving fixed rates"""
+    if name not in RATE_PROVIDERS:
+        raise ValueError(f"Unknown RATE_PROVIDER {name!r}, expected one of: {', '.join(RATE_PROVIDERS)}")
+    return RATE_PROVIDERS[name]()
+
+# Used for any currency neither the provider nor the history has a rate for
+FALLBACK_RATES = {'UZS': 1.0, 'USD': USD_TO_UZS_RATE}
+
+LATEST_RATES_SQL = """
+    SELECT c.currency, c.rate FROM currency_rates c
+    WHERE c.rate_date = (SELECT MAX(rate_date) FROM currency_rates WHERE currency = c.currency)
+"""
+
+class RateService:
+    """Currency rates (UZS per unit) from a provider, kept in memory for `ttl` seconds.
+
+    Every refresh records the fetched rates in currency_rates, which base-currency
+    totals join against and which stands in while the provider is unreachable.
+    UZS is stored at 1 so every currency converts the same way. FALLBACK_RATES are
+    only served from memory, never written to the history as if they were fetched.
+    """
+
+    def __init__(self, pool, provider, ttl=RATE_TTL):
+        self.pool = pool
+        self.provider = provider
+        self.ttl = ttl
+        self._rates = None
+        self._expires = 0
+        self._lock = asyncio.Lock()
+
+    async def rates(self):
+        """{currency: UZS rate}; callers waiting on an expired cache share one refresh"""
+        if self._rates is None or time.monotonic() >= self._expires:
+            async with self._lock:
+                if self._rates is None or time.monotonic() >= self._expires:
+                    self._rates = await self._refresh()
+                    self._expires = time.monotonic() + self.ttl
+        return self._rates
+
+    async def convert(self, amount, from_currency, to_currency):
+        if from_currency == to_currency:
+            return amount
+        rates = await self.rates()
+        return round(amount * rates[from_currency] / rates[to_currency], 2)
+
+    async def latest(self):
+        """Newest stored rate per currency"""
+        async with self.pool.reader() as db:
+            cursor = await db.execute(LATEST_RATES_SQL)
+            return {row[0]: row[1] for row in await cursor.fetchall()}
+
+    async def _refresh(self):
+        try:
+            fetched = await self.provider.fetch()
+        except Exception as e:
+            logger.warning(f"Currency rates not refreshed, using the last known ones: {e}")
+            fetched = {}
+        stored = await self.latest()
+        rates = {**FALLBACK_RATES, **stored, **fetched}
+        # Record only what was fetched, plus the UZS identity rate the history needs once
+        recorded = {**fetched, **({} if 'UZS' in stored else {'UZS': 1.0})}
+        fresh = [(currency, date.today(), rate, datetime.now()) for currency, rate in recorded.items()]
+        if fresh:
+            async with self.pool.writer() as db:
+                await db.executemany("""
+                    INSERT INTO currency_rates (currency, rate_date, rate, fetched_at) VALUES (?, ?, ?, ?)
+                    ON CONFLICT(currency, rate_date) DO UPDATE SET rate = excluded.rate, fetched_at = excluded.fetched_at
+                """, fresh)
+                await db.commit()
+        return rates
+
+rate_service = RateService(db_pool, make_rate_provider(RATE_PROVIDER))
+
+def _latest_rate_sql(currency):
+    # Newest rate of one currency: a reverse seek on the (currency, rate_date) primary key
+    return f"(SELECT rate FROM currency_rates WHERE currency = {currency} ORDER BY rate_date DESC LIMIT 1)"
+
+# Rollups of all the user's currencies converted at the latest rates, in one pass.
+# Currencies with no rate drop out of the sums and are listed in the fourth column.
+BASE_TOTALS_SQL = f"""
+    SELECT u.base_currency, u.rate, COUNT(r.rate),
+           GROUP_CONCAT(CASE WHEN r.rate IS NULL THEN r.currency END),
+           SUM(r.given_total * r.rate) / u.rate,
+           SUM(r.taken_total * r.rate) / u.rate,
+           SUM(CASE WHEN r.day_key = :today THEN r.day_total ELSE 0 END * r.rate) / u.rate,
+           SUM(CASE WHEN r.month_key = :month_start THEN r.month_total ELSE 0 END * r.rate) / u.rate
+    FROM (SELECT base_currency, {_latest_rate_sql('users.base_currency')} AS rate
+          FROM users WHERE id = :user_id) u
+    LEFT JOIN (SELECT currency, given_total, taken_total, day_key, day_total, month_key, month_total,
+                      {_latest_rate_sql('user_rollups.currency')} AS rate
+               FROM user_rollups WHERE user_id = :user_id) r
+"""
+
+async def get_base_totals(user_id):
+    """Active debts and today's/this month's expenses in the user's base currency.
+
+    None when the user is unknown or there is no rate for their base currency.
+    Currencies without a rate are left out of the totals and listed under 'unpriced'.
+    """
+    await rate_service.rates()  # refreshes currency_rates when the cache has expired
+    today = current_date()
+    async with db_pool.reader() as db:
+        cursor = await db.execute(BASE_TOTALS_SQL, {'user_id': user_id, 'today': today, 'month_start': today.replace(day=1)})
+        row = await cursor.fetchone()
+    if row is None or row[0] is None:
+        return None
+    currency, rate, count, unpriced, given, taken, day, month = row
+    if rate is None:
+        logger.warning(f"No {currency} rate for user {user_id}'s base currency totals")
+        return None
+    unpriced = sorted(set(unpriced.split(','))) if unpriced else []
+    if unpriced:
+        logger.warning(f"Base totals for user {user_id} leave out {', '.join(unpriced)}: no rate")
+    return {'currency': currency, 'rate': rate, 'currencies': count, 'unpriced': unpriced,
+            'given': given or 0, 'taken': taken or 0, 'net': (given or 0) - (taken or 0),
+            'today': day or 0, 'month': month or 0}
+
+async def set_base_currency(user, currency):
+    async with db_pool.writer() as db:
+        await db.execute("UPDATE users SET base_currency = ? WHERE id = ?", (currency, user['id']))
+        await db.commit()
+    user_cache.pop(user['telegram_id'])
+
+# ---- Excel export ----
+# (sheet title, column headers and widths, query); each query takes user_id and is read in chunks
+EXPORT_SHEETS = [
+    ("Qarzlar", [("ID", 8), ("Ism", 24), ("Telefon", 16), ("Summa", 14), ("Valyuta", 9), ("Turi", 10),
+                 ("To'lov turi", 13), ("Berilgan", 12), ("Muddat", 12), ("Holat", 12)], """
+        SELECT id, person_name, phone_number, amount, currency,
+               CASE debt_type WHEN 'given' THEN 'Berdim' ELSE 'Oldim' END,
+               CASE payment_type WHEN 'installment' THEN 'Bo''lib' ELSE 'Bir martalik' END,
+               given_date, due_date, CASE WHEN is_paid THEN 'To''langan' ELSE 'Faol' END
+        FROM debts WHERE user_id = ? ORDER BY created_at, id
+    """),
+    ("Bo'lib to'lash", [("Qarz ID", 8), ("Ism", 24), ("Summa", 14), ("Valyuta", 9), ("Muddat", 12),
+                        ("Holat", 12), ("To'langan sana", 15)], """
+        SELECT i.debt_id, d.person_name, i.amount, d.currency, i.due_date,
+               CASE WHEN i.is_paid THEN 'To''langan' ELSE 'Kutilmoqda' END, i.paid_date
+        FROM installments i JOIN debts d ON d.id = i.debt_id
+        WHERE d.user_id = ? ORDER BY i.debt_id, i.due_date, i.id
+    """),
+    ("Harajatlar", [("Sana", 12), ("Tavsif", 32), ("Summa", 14), ("Valyuta", 9), ("Kategoriya", 14)], """
+        SELECT expense_date, description, amount, currency, category
+        FROM daily_expenses WHERE user_id = ? ORDER BY expense_date, id
+    """),
+]
+
+def build_export(path, user_id, fetch_size=EXPORT_FETCH_SIZE, progress=None):
+    """Write a user's debts, installments and expenses to an .xlsx file at `path`.
+
+    Blocking; run it on report_pool. Uses its own read-only connection and a
+    write-only workbook fed from fetchmany(), so memory stays flat however many
+    rows the user has. `progress(rows)` is called after every chunk. Returns the
+    number of rows written.
+    """
+    db = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True, detect_types=sqlite3.PARSE_DECLTYPES)
+    try:
+        db.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+        wb = Workbook(write_only=True)
+        bold = Font(bold=True)
+        total = 0
+        for title, columns, sql in EXPORT_SHEETS:
+            ws = wb.create_sheet(title)
+            for i, (_, width) in enumerate(columns):
+                ws.column_dimensions[get_column_letter(i + 1)].width = width
+            header = []
+            for name, _ in columns:
+                cell = WriteOnlyCell(ws, value=name)
+                cell.font = bold
+                header.append(cell)
+            ws.append(header)
+            cursor = db.execute(sql, (user_id,))
+            while True:
+                rows = cursor.fetchmany(fetch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    ws.append(row)
+                total += len(rows)
+                if progress:
+                    progress(total)
+        wb.save(path)
+        return total
+    finally:
+        db.close()
+
+# ============== REPORTS ==============
+class ReportBusy(Exception):
+    """Raised by ReportPool.submit when the user or the whole queue is at capacity"""
+
+class ReportCancelled(Exception):
+    """Raised inside a thread job's progress callback once the job was cancelled"""
+
+class ReportJob:
+    def __init__(self, owner, kind, func, args, on_progress, on_discard, cancelled):
+        self.owner = owner
+        self.kind = kind
+        self.func = func
+        self.args = args
+        self.on_progress = on_progress
+        self.on_discard = on_discard
+        self.future = asyncio.get_running_loop().create_future()
+        self.cancelled = cancelled
+        self.call = None
+
+class ProcessProgress:
+    """`progress` callback for process jobs, pickled into the child along with the job.
+
+    Records the latest value in a manager-shared Value for the pool to poll, and
+    raises ReportCancelled once the parent has set the shared cancel event.
+    """
+
+    def __init__(self, value, cancelled):
+        self.value = value
+        self.cancelled = cancelled
+
+    def __call__(self, value):
+        if self.cancelled.is_set():
+            raise ReportCancelled()
+        self.value.value = value
+
+class ReportPool:
+    """Runs blocking report jobs off the event loop.
+
+    'thread' jobs run on a thread pool; 'process' jobs run on a process pool, so
+    CPU-heavy builds cannot hold the GIL the bot's loop needs. Both get a `progress`
+    callback that raises ReportCancelled after cancel() (process jobs share the
+    cancel flag and their progress through a multiprocessing manager). Jobs wait in
+    a bounded queue, each user may have REPORT_USER_LIMIT jobs queued or running,
+    and submit() raises ReportBusy instead of letting the backlog grow. A cancelled
+    job keeps its worker and its owner's slot until its work has really stopped;
+    then its `on_discard` runs, so it can clean up files the job was still writing.
+    """
+
+    def __init__(self, threads=REPORT_THREADS, processes=REPORT_PROCESSES,
+                 queue_size=REPORT_QUEUE_SIZE, user_limit=REPORT_USER_LIMIT):
+        self.threads = max(1, threads)
+        self.processes = processes
+        self.queue_size = queue_size
+        self.user_limit = user_limit
+        self._executors = {}
+        self._queues = {}
+        self._workers = []
+        self._jobs = {}
+        self._manager = None
+        self._pollers = set()
+
+    def start(self):
+        self._executors['thread'] = ThreadPoolExecutor(self.threads, thread_name_prefix="report")
+        self._queues['thread'] = asyncio.Queue(self.queue_size)
+        self._workers += [asyncio.create_task(self._worker('thread')) for _ in range(self.threads)]
+        if self.processes > 0:
+            self._manager = multiprocessing.get_context('spawn').Manager()
+            self._executors['process'] = self._process_executor()
+            self._queues['process'] = asyncio.Queue(self.queue_size)
+            self._workers += [asyncio.create_task(self._worker('process')) for _ in range(self.processes)]
+        logger.info(f"Report pool started: {self.threads} threads, {max(self.processes, 0)} processes")
+
+    async def close(self):
+        for job in [job for jobs in self._jobs.values() for job in jobs]:
+            self._cancel(job)
+        for task in [*self._workers, *self._pollers]:
+            task.cancel()
+        await asyncio.gather(*self._workers, *self._pollers, return_exceptions=True)
+        self._workers = []
+        for executor in self._executors.values():
+            executor.shutdown(wait=False, cancel_futures=True)
+        self._executors = {}
+        if self._manager is not None:
+            self._manager.shutdown()
+            self._manager = None
+
+    def _process_executor(self):
+        # spawn: forking a process that holds sqlite and executor threads is unsafe
+        return ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context('spawn'))
+
+    def submit(self, owner, kind, func, *args, on_progress=None, on_discard=None):
+        """Queue `func(*args)`; returns a future for its result. Callbacks run on the loop."""
+        if kind == 'process' and 'process' not in self._executors:
+            kind = 'thread'
+        jobs = self._jobs.setdefault(owner, set())
+        if len(jobs) >= self.user_limit:
+            raise ReportBusy("user limit")
+        if self._queues[kind].full():
+            raise ReportBusy("queue full")
+        cancelled = self._manager.Event() if kind == 'process' else threading.Event()
+        job = ReportJob(owner, kind, func, args, on_progress, on_discard, cancelled)
+        self._queues[kind].put_nowait(job)
+        jobs.add(job)
+        # A job cancelled while queued frees its slot at once; a started one when its work ends
+        job.future.add_done_callback(lambda _: job.call is None and self._release(job))
+        return job.future
+
+    def cancel(self, owner):
+        """Cancel the owner's jobs; returns how many there were"""
+        jobs = list(self._jobs.get(owner, ()))
+        for job in jobs:
+            self._cancel(job)
+        return len(jobs)
+
+    def _cancel(self, job):
+        job.cancelled.set()
+        job.future.cancel()
+
+    def _discard(self, job, call=None):
+        if call is not None and not call.cancelled():
+            call.exception()  # retrieved, so a failed dropped job does not log "never retrieved"
+        if job.on_discard:
+            job.on_discard()
+
+    def _release(self, job):
+        jobs = self._jobs.get(job.owner)
+        if jobs is not None:
+            jobs.discard(job)
+            if not jobs:
+                del self._jobs[job.owner]
+
+    def _call(self, job):
+        loop = asyncio.get_running_loop()
+        if job.kind == 'process':
+            value = self._manager.Value('q', -1)
+            progress = ProcessProgress(value, job.cancelled)
+            call = loop.run_in_executor(self._executors['process'], partial(job.func, *job.args, progress=progress))
+            if job.on_progress:
+                poller = loop.create_task(self._poll_progress(job, call, value))
+                self._pollers.add(poller)
+                poller.add_done_callback(self._pollers.discard)
+            return call
+
+        def progress(value):
+            if job.cancelled.is_set():
+                raise ReportCancelled()
+            if job.on_progress:
+                loop.call_soon_threadsafe(job.on_progress, value)
+
+        return loop.run_in_executor(self._executors['thread'], lambda: job.func(*job.args, progress=progress))
+
+    async def _poll_progress(self, job, call, value):
+        last = -1
+        while not call.done():
+            await asyncio.wait([call], timeout=REPORT_PROGRESS_SECONDS)
+            try:
+                current = await asyncio.to_thread(lambda: value.value)
+            except Exception:
+                return  # manager gone: the pool is closing
+            if current != last and current >= 0 and not job.future.done():
+                job.on_progress(current)
+                last = current
+
+    async def _worker(self, kind):
+        queue = self._queues[kind]
+        while True:
+            job = await queue.get()
+            try:
+                if job.future.done():
+                    self._discard(job)  # cancelled while queued
+                    continue
+                job.call = call = self._call(job)
+                await asyncio.wait([call, job.future], return_when=asyncio.FIRST_COMPLETED)
+                if job.future.done():
+                    # Cancelled: the job stops at its next progress call; hold this worker until it has
+                    call.add_done_callback(lambda f, job=job: self._discard(job, f))
+                    await asyncio.wait([call])
+                    continue
+                try:
+                    job.future.set_result(call.result())
+                except Exception as e:
+                    job.future.set_exception(e)
+                    if isinstance(e, BrokenProcessPool):
+                        logger.error("Report process pool broke, starting a new one")
+                        self._executors['process'] = self._process_executor()
+            finally:
+                if job.call is not None:
+                    self._release(job)
+                queue.task_done()
+
+report_pool = ReportPool()
+
+class ReportProgress:
+    """Edits a status message while a report job runs, at most every REPORT_PROGRESS_SECONDS"""
+
+    def __init__(self, message, label):
+        self.message = message
+        self.label = label
+        self.rows = None
+        self._text = message.text
+
+    def update(self, rows):
+        self.rows = rows
+
+    async def follow(self, job):
+        """Wait for `job`, editing progress into the status message; returns when it is done"""
+        started = time.monotonic()
+        while not job.done():
+            await asyncio.wait([job], timeout=REPORT_PROGRESS_SECONDS)
+            if job.done():
+                break
+            elapsed = int(time.monotonic() - started)
+            rows = f", {self.rows:,} qator" if self.rows is not None else ""
+            await self.edit(f"{self.label}... {elapsed} s{rows}", report_cancel_keyboard())
+
+    async def edit(self, text, reply_markup=None):
+        if text == self._text:
+            return
+        self._text = text
+        try:
+            await self.message.edit_text(text, reply_markup=reply_markup)
+        except BadRequest as e:
+            logger.debug(f"Progress edit skipped: {e}")
 
 # ============== HANDLERS ==============
+async def safe_edit(query, text, reply_markup=None, parse_mode='HTML'):
+    """Edit the callback's message in place, skipping the API call when nothing would change"""
+    message = query.message
+    if message and message.reply_markup == reply_markup:
+        # text_html escapes the ' in almost every Uzbek word as &#x27;, so compare unescaped
+        current = html.unescape(message.text_html) if parse_mode == 'HTML' else message.text
+        new = html.unescape(text.strip()) if parse_mode == 'HTML' else text.strip()
+        if current == new:
+            return
+    try:
+        await query.edit_message_text(text, parse_mode=parse_mode, reply_markup=reply_markup)
+    except BadRequest as e:
+        # Double taps can still race past the check above
+        if "not modified" not in str(e).lower():
+            raise
+
 WELCOME_MESSAGE = """
 🎉 <b>Assalomu alaykum, {name}!</b>
 
@@ -412,7 +2559,8 @@ def previous_contacts_keyboard(contacts):
     keyboard = []
     for name, phone in contacts:
         phone_text = f" ({phone})" if phone else ""
-        keyboard.append([InlineKeyboardButton(f"👤 {name}{phone_text}", callback_data=f"contact_{name}|{phone or ''}")])
+        token = callback_store.put({'name': name, 'phone': phone})
+        keyboard.append([InlineKeyboardButton(f"👤 {name}{phone_text}", callback_data=f"contact_{token}")])
     keyboard.append([InlineKeyboardButton("➕ Yangi kontakt", callback_data="contact_new")])
     return InlineKeyboardMarkup(keyboard)
 
@@ -458,25 +2606,25 @@ async def debt_select_contact_callback(update: Update, context: ContextTypes.DEF
     query = update.callback_query
     await query.answer()
     
-    if query.data == "contact_new":
+    entry = None if query.data == "contact_new" else await callback_store.get(query.data.replace("contact_", ""))
+    if entry is None:
+        # "New contact", or a contact button whose token has expired
         debt_type = context.user_data['debt_type']
         if debt_type == 'given':
-            await query.edit_message_text("💰 <b>Qarz berdim</b>\n\nQarz oluvchining <b>ismini</b> kiriting:", parse_mode='HTML')
+            await safe_edit(query, "💰 <b>Qarz berdim</b>\n\nQarz oluvchining <b>ismini</b> kiriting:", parse_mode='HTML')
         else:
-            await query.edit_message_text("💸 <b>Qarz oldim</b>\n\nQarz beruvchining <b>ismini</b> kiriting:", parse_mode='HTML')
+            await safe_edit(query, "💸 <b>Qarz oldim</b>\n\nQarz beruvchining <b>ismini</b> kiriting:", parse_mode='HTML')
         return DEBT_NAME
     
-    # Parse selected contact
-    data = query.data.replace("contact_", "")
-    parts = data.split("|")
-    name = parts[0]
-    phone = parts[1] if len(parts) > 1 and parts[1] else None
+    contact = entry[0]
+    name = contact['name']
+    phone = contact['phone'] or None
     
     context.user_data['debt_data']['person_name'] = name
     context.user_data['debt_data']['phone_number'] = phone
     
     phone_text = phone if phone else "Raqam yo'q"
-    await query.edit_message_text(
+    await safe_edit(query, 
         f"👤 <b>{name}</b>\n📱 {phone_text}\n\nSummani kiriting:\n<i>Masalan: 100 USD, 500000</i>",
         parse_mode='HTML'
     )
@@ -531,17 +2679,18 @@ async def debt_payment_type_callback(update: Update, context: ContextTypes.DEFAU
     query = update.callback_query
     await query.answer()
     context.user_data['debt_data']['payment_type'] = 'one_time' if query.data == "payment_one_time" else 'installment'
-    await query.edit_message_text("Qarz berilgan sanani tanlang:", reply_markup=date_keyboard())
+    await safe_edit(query, "Qarz berilgan sanani tanlang:", reply_markup=date_keyboard())
     return DEBT_GIVEN_DATE
 
 async def debt_given_date_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     if query.data == "date_today":
-        context.user_data['debt_data']['given_date'] = date.today()
-        await query.edit_message_text(f"📅 Berilgan: {format_date(date.today())}\n\nQaytarish muddatini kiriting:\n<i>Masalan: 25.02.2026</i>", parse_mode='HTML')
+        today = current_date()
+        context.user_data['debt_data']['given_date'] = today
+        await safe_edit(query, f"📅 Berilgan: {format_date(today)}\n\nQaytarish muddatini kiriting:\n<i>Masalan: 25.02.2026, ertaga, 2 haftadan keyin</i>", parse_mode='HTML')
         return DEBT_DUE_DATE
-    await query.edit_message_text("Berilgan sanani kiriting:\n<i>Masalan: 17.01.2026</i>", parse_mode='HTML')
+    await safe_edit(query, "Berilgan sanani kiriting:\n<i>Masalan: 17.01.2026, kecha, 3 kun oldin</i>", parse_mode='HTML')
     return DEBT_GIVEN_DATE
 
 async def debt_given_date_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -550,7 +2699,7 @@ async def debt_given_date_text(update: Update, context: ContextTypes.DEFAULT_TYP
         await update.message.reply_text("❌ Sanani to'g'ri kiriting!")
         return DEBT_GIVEN_DATE
     context.user_data['debt_data']['given_date'] = parsed
-    await update.message.reply_text(f"📅 Berilgan: {format_date(parsed)}\n\nQaytarish muddatini kiriting:", parse_mode='HTML')
+    await update.message.reply_text(f"📅 Berilgan: {format_date(parsed)}\n\nQaytarish muddatini kiriting:\n<i>Masalan: 25.02.2026, ertaga, 2 haftadan keyin</i>", parse_mode='HTML')
     return DEBT_DUE_DATE
 
 async def debt_due_date_received(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -561,7 +2710,8 @@ async def debt_due_date_received(update: Update, context: ContextTypes.DEFAULT_T
     context.user_data['debt_data']['due_date'] = parsed
     
     if context.user_data['debt_data']['payment_type'] == 'installment':
-        await update.message.reply_text("Necha oyga bo'lib to'lanadi?", reply_markup=installment_count_keyboard())
+        await update.message.reply_text(f"Necha oyga bo'lib to'lanadi?\n<i>Birinchi to'lov: {format_date(parsed)}</i>",
+                                        parse_mode='HTML', reply_markup=installment_count_keyboard())
         return DEBT_INSTALLMENTS
     
     return await show_debt_confirmation(update, context)
@@ -587,35 +2737,40 @@ async def show_debt_confirmation(update: Update, context: ContextTypes.DEFAULT_T
 💵 <b>Summa:</b> {format_money(data['amount'], data['currency'])}
 📅 <b>Berilgan:</b> {format_date(data['given_date'])}
 ⏰ <b>Muddat:</b> {format_date(data['due_date'])}
-
-<b>Tasdiqlaysizmi?</b>
 """
+    months = data.get('installment_months')
+    if data['payment_type'] == 'installment' and months:
+        schedule = installment_schedule(data['amount'], months, data['due_date'])
+        text += (f"🗓 <b>Bo'lib to'lash:</b> {months} oy, har oy {format_money(schedule[0][1], data['currency'])}\n"
+                 f"🏁 <b>Oxirgi to'lov:</b> {format_date(schedule[-1][0])}\n")
+    text += "\n<b>Tasdiqlaysizmi?</b>\n"
     if is_callback:
-        await update.callback_query.edit_message_text(text, parse_mode='HTML', reply_markup=confirm_keyboard())
+        await safe_edit(update.callback_query, text, parse_mode='HTML', reply_markup=confirm_keyboard())
     else:
         await update.message.reply_text(text, parse_mode='HTML', reply_markup=confirm_keyboard())
     return DEBT_CONFIRM
 
 async def debt_confirm_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # The main menu is a persistent reply keyboard, so no follow-up message is needed
     query = update.callback_query
-    await query.answer()
     
     if query.data == "confirm_no":
         context.user_data.clear()
-        await query.edit_message_text("❌ Bekor qilindi.")
-        await query.message.reply_text("Asosiy menyu:", reply_markup=main_menu_keyboard())
+        await query.answer("❌ Bekor qilindi")
+        await safe_edit(query, "❌ Bekor qilindi.")
         return ConversationHandler.END
     
     user = update.effective_user
     db_user = await get_or_create_user(user.id, user.full_name, user.username)
     data = context.user_data['debt_data']
     
+    months = data.get('installment_months') if data['payment_type'] == 'installment' else None
     await add_debt(db_user['id'], data['person_name'], data.get('phone_number'), data['amount'], data['currency'],
-                   context.user_data['debt_type'], data['payment_type'], data['given_date'], data['due_date'])
+                   context.user_data['debt_type'], data['payment_type'], data['given_date'], data['due_date'], months)
     
     context.user_data.clear()
-    await query.edit_message_text("✅ <b>Saqlandi!</b>", parse_mode='HTML')
-    await query.message.reply_text("Asosiy menyu:", reply_markup=main_menu_keyboard())
+    await query.answer("✅ Saqlandi!")
+    await safe_edit(query, "✅ <b>Saqlandi!</b>")
     return ConversationHandler.END
 
 # EXPENSE HANDLERS
@@ -641,7 +2796,6 @@ async def expense_amount_received(update: Update, context: ContextTypes.DEFAULT_
 
 async def expense_category_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
     
     user = update.effective_user
     db_user = await get_or_create_user(user.id, user.full_name, user.username)
@@ -651,14 +2805,56 @@ async def expense_category_callback(update: Update, context: ContextTypes.DEFAUL
     await add_expense(db_user['id'], data['description'], data['amount'], data['currency'], category)
     context.user_data.clear()
     
-    await query.edit_message_text(f"✅ <b>Saqlandi!</b>\n\n📝 {data['description']}\n💵 {format_money(data['amount'], data['currency'])}", parse_mode='HTML')
-    await query.message.reply_text("Asosiy menyu:", reply_markup=main_menu_keyboard())
+    await query.answer("✅ Saqlandi!")
+    await safe_edit(query, f"✅ <b>Saqlandi!</b>\n\n📝 {data['description']}\n💵 {format_money(data['amount'], data['currency'])}")
     return ConversationHandler.END
 
 # VIEW HANDLERS
 async def my_debts_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("📋 <b>Mening qarzlarim</b>", parse_mode='HTML', reply_markup=my_debts_keyboard())
 
+def format_page_data(direction, key, row_id):
+    """'<n|p>_<key>_<id>'; a NULL key (a debt with no due date) is an empty field"""
+    return f"{direction}_{'' if key is None else key}_{row_id}"
+
+def parse_page_data(data):
+    """'<n|p>_<key>_<id>' -> (seek, before)"""
+    direction, rest = data.split('_', 1)
+    key, row_id = rest.rsplit('_', 1)
+    return (key or None, int(row_id)), direction == 'p'
+
+async def render_debt_list(user_id, debt_type, seek=None, before=False):
+    """Text and keyboard for one page of active debts; totals come from rollups"""
+    title = "💰 Bergan qarzlarim" if debt_type == 'given' else "💸 Olgan qarzlarim"
+    debts, has_more = await get_debts_page(user_id, debt_type, seek, before)
+    if seek and not debts:
+        # Rows around the cursor were paid or deleted meanwhile - start over
+        seek, before = None, False
+        debts, has_more = await get_debts_page(user_id, debt_type)
+    
+    if not debts:
+        return f"{title}\n\n📭 Qarz yo'q.", my_debts_keyboard()
+    
+    totals, count = await get_debt_totals(user_id, debt_type)
+    total_usd = totals.get('USD')
+    total_uzs = totals.get('UZS')
+    
+    text = f"<b>{title}</b>\n\n"
+    if total_usd: text += f"💵 USD: {format_money(total_usd, 'USD')}\n"
+    if total_uzs: text += f"💵 UZS: {format_money(total_uzs, 'UZS')}\n"
+    if len(totals) > 1:
+        base = await get_base_totals(user_id)
+        if base:
+            text += f"💱 Jami: ≈ {format_money(base[debt_type], base['currency'])}{unpriced_note(base)}\n"
+    text += f"\n📌 {count} ta qarz"
+    
+    first, last = debts[0], debts[-1]
+    has_prev = has_more if before else seek is not None
+    has_next = True if before else has_more
+    prev_data = f"dpage_{debt_type}_{format_page_data('p', first['due_date'], first['id'])}" if has_prev else None
+    next_data = f"dpage_{debt_type}_{format_page_data('n', last['due_date'], last['id'])}" if has_next else None
+    return text, debt_list_keyboard(debts, prev_data, next_data)
+
 async def view_debts_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -667,38 +2863,44 @@ async def view_debts_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
     db_user = await get_or_create_user(user.id, user.full_name, user.username)
     
     debt_type = 'given' if query.data == "view_given" else 'taken'
-    title = "💰 Bergan qarzlarim" if debt_type == 'given' else "💸 Olgan qarzlarim"
     context.user_data['current_debt_type'] = debt_type
     
-    debts = await get_debts_by_type(db_user['id'], debt_type)
-    
-    if not debts:
-        await query.edit_message_text(f"{title}\n\n📭 Qarz yo'q.", reply_markup=my_debts_keyboard())
-        return
+    text, markup = await render_debt_list(db_user['id'], debt_type)
+    await safe_edit(query, text, markup)
+
+async def debt_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
     
-    total_usd = sum(d['amount'] for d in debts if d['currency'] == 'USD')
-    total_uzs = sum(d['amount'] for d in debts if d['currency'] == 'UZS')
+    user = update.effective_user
+    db_user = await get_or_create_user(user.id, user.full_name, user.username)
     
-    text = f"<b>{title}</b>\n\n"
-    if total_usd: text += f"💵 USD: {format_money(total_usd, 'USD')}\n"
-    if total_uzs: text += f"💵 UZS: {format_money(total_uzs, 'UZS')}\n"
-    text += f"\n📌 {len(debts)} ta qarz"
+    debt_type, page_data = query.data.replace("dpage_", "", 1).split('_', 1)
+    if debt_type not in ('given', 'taken'):
+        return
+    seek, before = parse_page_data(page_data)
+    context.user_data['current_debt_type'] = debt_type
     
-    await query.edit_message_text(text, parse_mode='HTML', reply_markup=debt_list_keyboard(debts))
+    text, markup = await render_debt_list(db_user['id'], debt_type, seek, before)
+    await safe_edit(query, text, markup)
 
 async def view_debt_detail_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    debt_id = int(query.data.replace("debt_", ""))
-    debt = await get_debt_by_id(debt_id)
+    debt = await debt_from_token(query.data.replace("debt_", ""))
     
     if not debt:
-        await query.edit_message_text("❌ Qarz topilmadi.")
+        await safe_edit(query, "❌ Qarz topilmadi.")
         return
     
     days = days_until(debt['due_date'])
-    status = "✅ To'langan" if debt['is_paid'] else f"📆 {days} kun qoldi" if days >= 0 else f"🔴 {abs(days)} kun o'tdi"
+    if debt['is_paid']:
+        status = "✅ To'langan"
+    elif days is None:
+        status = "♾ Muddatsiz"
+    else:
+        status = f"📆 {days} kun qoldi" if days >= 0 else f"🔴 {abs(days)} kun o'tdi"
     phone_display = debt.get('phone_number') or "Kiritilmagan"
     
     text = f"""
@@ -706,61 +2908,74 @@ async def view_debt_detail_callback(update: Update, context: ContextTypes.DEFAUL
 📱 Telefon: {phone_display}
 💰 {format_money(debt['amount'], debt['currency'])}
 📅 Berilgan: {format_date(debt['given_date'])}
-⏰ Muddat: {format_date(debt['due_date'])}
+⏰ Muddat: {format_date(debt['due_date']) if debt['due_date'] else 'muddatsiz'}
 {status}
 """
-    await query.edit_message_text(text, parse_mode='HTML', reply_markup=debt_action_keyboard(debt_id, debt['debt_type'], debt['is_paid']))
+    if debt['payment_type'] == 'installment' and not debt['is_paid']:
+        installment = await get_next_installment(debt['id'])
+        if installment:
+            text += (f"📅 Navbatdagi to'lov: {format_money(installment['amount'], debt['currency'])}"
+                     f" ({installment['remaining']} ta qoldi)\n")
+    await safe_edit(query, text, debt_action_keyboard(debt_token(debt), debt['debt_type'], debt['is_paid']))
 
 async def mark_debt_paid_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Result goes in the callback answer; the message moves back to the refreshed list
     query = update.callback_query
-    await query.answer()
-    debt_id = int(query.data.replace("mark_paid_", ""))
-    await mark_debt_paid(debt_id)
-    await query.edit_message_text("✅ <b>To'langan deb belgilandi!</b>", parse_mode='HTML')
-    await query.message.reply_text("Asosiy menyu:", reply_markup=main_menu_keyboard())
+    debt = await debt_from_token(query.data.replace("mark_paid_", ""))
+    if not debt:
+        await query.answer()
+        await safe_edit(query, "❌ Qarz topilmadi.")
+        return
+    await mark_debt_paid(debt['id'])
+    await query.answer("✅ To'langan deb belgilandi!")
+    text, markup = await render_debt_list(debt['user_id'], debt['debt_type'])
+    await safe_edit(query, text, markup)
 
 async def delete_debt_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    debt_id = int(query.data.replace("delete_debt_", ""))
-    debt = await get_debt_by_id(debt_id)
+    token = query.data.replace("delete_debt_", "")
+    debt = await debt_from_token(token)
     if not debt:
-        await query.edit_message_text("❌ Qarz topilmadi.")
+        await safe_edit(query, "❌ Qarz topilmadi.")
         return
-    await query.edit_message_text(
+    await safe_edit(query, 
         f"⚠️ <b>O'chirishni tasdiqlang</b>\n\n👤 {debt['person_name']}\n💰 {format_money(debt['amount'], debt['currency'])}\n\nRostdan ham o'chirmoqchimisiz?",
         parse_mode='HTML',
-        reply_markup=delete_confirm_keyboard(debt_id)
+        reply_markup=delete_confirm_keyboard(token)
     )
 
 async def confirm_delete_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
-    debt_id = int(query.data.replace("confirm_delete_", ""))
-    await delete_debt(debt_id)
-    await query.edit_message_text("🗑 <b>O'chirildi!</b>", parse_mode='HTML')
-    await query.message.reply_text("Asosiy menyu:", reply_markup=main_menu_keyboard())
+    debt = await debt_from_token(query.data.replace("confirm_delete_", ""))
+    if not debt:
+        await query.answer()
+        await safe_edit(query, "❌ Qarz topilmadi.")
+        return
+    await delete_debt(debt['id'])
+    await query.answer("🗑 O'chirildi!")
+    text, markup = await render_debt_list(debt['user_id'], debt['debt_type'])
+    await safe_edit(query, text, markup)
 
 # REPAYMENT HANDLERS
 async def repay_debt_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    debt_id = int(query.data.replace("repay_", ""))
-    debt = await get_debt_by_id(debt_id)
+    debt = await debt_from_token(query.data.replace("repay_", ""))
     
     if not debt:
-        await query.edit_message_text("❌ Qarz topilmadi.")
+        await safe_edit(query, "❌ Qarz topilmadi.")
         return
     
-    context.user_data['repay_debt_id'] = debt_id
+    context.user_data['repay_debt_id'] = debt['id']
     context.user_data['repay_debt'] = debt
     
-    await query.edit_message_text(
+    await safe_edit(query, 
         f"💵 <b>Qarzdorlikni so'ndirish</b>\n\n"
         f"👤 {debt['person_name']}\n"
         f"💰 Jami qarz: {format_money(debt['amount'], debt['currency'])}\n\n"
         f"Qancha to'landi? Summani kiriting:\n"
-        f"<i>Masalan: 50000 yoki 100 USD</i>\n\n"
+        f"<i>Masalan: 50000 yoki 100 USD (boshqa valyuta kurs bo'yicha hisoblanadi)</i>\n\n"
         f"<i>To'liq to'landi bo'lsa, summa o'rniga 'hammasi' yozing</i>",
         parse_mode='HTML'
     )
@@ -786,24 +3001,54 @@ async def repay_amount_received(update: Update, context: ContextTypes.DEFAULT_TY
         )
         return ConversationHandler.END
     
-    paid_amount, currency = parse_amount(text)
+    # A bare number is in the debt's currency; one in another currency is converted at today's rate
+    paid_amount, currency = parse_amount(text, debt['currency'])
     if paid_amount is None or paid_amount <= 0:
         await update.message.reply_text("❌ Summani to'g'ri kiriting!")
         return DEBT_PARTIAL_PAYMENT
     
-    # Check if currencies match or convert
-    if currency != debt['currency']:
-        await update.message.reply_text(f"❌ Valyuta mos emas! Qarz {debt['currency']} da.")
+    decimal = ambiguous_usd_amount(text, currency)
+    if decimal is not None:
+        # "1.500" against a dollar debt: 1,500 or 1.5? Recording the wrong one may close the debt
+        context.user_data['repay_choices'] = [paid_amount, decimal, currency]
+        await update.message.reply_text(
+            f"❓ <b>{text}</b> qancha: {format_money(paid_amount, currency)} yoki {format_money(decimal, currency)}?",
+            parse_mode='HTML',
+            reply_markup=amount_choice_keyboard([paid_amount, decimal], currency)
+        )
         return DEBT_PARTIAL_PAYMENT
     
+    return await apply_repayment(update.message, context, debt, paid_amount, currency)
+
+async def repay_amount_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    debt = context.user_data.get('repay_debt')
+    choices = context.user_data.pop('repay_choices', None)
+    if not debt or not choices:
+        await safe_edit(query, "❌ Xatolik yuz berdi.")
+        return ConversationHandler.END
+    paid_amount = choices[int(query.data.replace("rpamt_", ""))]
+    await safe_edit(query, f"✅ {format_money(paid_amount, choices[2])}")
+    return await apply_repayment(query.message, context, debt, paid_amount, choices[2])
+
+async def apply_repayment(message, context, debt, paid_amount, currency):
+    """Record a payment of paid_amount `currency` against `debt` and reply under `message`"""
+    debt_id = debt['id']
+    conversion = ""
+    if currency != debt['currency']:
+        converted = await rate_service.convert(paid_amount, currency, debt['currency'])
+        conversion = f"💱 {format_money(paid_amount, currency)} = {format_money(converted, debt['currency'])}\n"
+        paid_amount, currency = converted, debt['currency']
+    
     remaining = debt['amount'] - paid_amount
     
     if remaining <= 0:
         # Full payment
         await mark_debt_paid(debt_id)
         context.user_data.clear()
-        await update.message.reply_text(
-            f"✅ <b>To'liq to'landi!</b>\n\n👤 {debt['person_name']}\n💰 {format_money(debt['amount'], debt['currency'])}",
+        await message.reply_text(
+            f"✅ <b>To'liq to'landi!</b>\n\n👤 {debt['person_name']}\n{conversion}💰 {format_money(debt['amount'], debt['currency'])}",
             parse_mode='HTML',
             reply_markup=main_menu_keyboard()
         )
@@ -811,9 +3056,10 @@ async def repay_amount_received(update: Update, context: ContextTypes.DEFAULT_TY
         # Partial payment
         await update_debt_amount(debt_id, remaining)
         context.user_data.clear()
-        await update.message.reply_text(
+        await message.reply_text(
             f"✅ <b>To'lov qabul qilindi!</b>\n\n"
             f"👤 {debt['person_name']}\n"
+            f"{conversion}"
             f"💵 To'langan: {format_money(paid_amount, currency)}\n"
             f"💰 Qolgan qarz: {format_money(remaining, currency)}",
             parse_mode='HTML',
@@ -825,14 +3071,14 @@ async def repay_amount_received(update: Update, context: ContextTypes.DEFAULT_TY
 async def edit_debt_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    debt_id = int(query.data.replace("edit_debt_", ""))
-    debt = await get_debt_by_id(debt_id)
+    token = query.data.replace("edit_debt_", "")
+    debt = await debt_from_token(token)
     
     if not debt:
-        await query.edit_message_text("❌ Qarz topilmadi.")
+        await safe_edit(query, "❌ Qarz topilmadi.")
         return
     
-    await query.edit_message_text(
+    await safe_edit(query, 
         f"✏️ <b>Tahrirlash</b>\n\n"
         f"👤 {debt['person_name']}\n"
         f"📱 {debt.get('phone_number') or 'Kiritilmagan'}\n"
@@ -840,7 +3086,7 @@ async def edit_debt_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
         f"⏰ {format_date(debt['due_date'])}\n\n"
         f"Nimani o'zgartirmoqchisiz?",
         parse_mode='HTML',
-        reply_markup=debt_edit_keyboard(debt_id)
+        reply_markup=debt_edit_keyboard(token)
     )
 
 async def edit_field_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -848,10 +3094,13 @@ async def edit_field_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
     await query.answer()
     
     data = query.data.replace("editfield_", "")
-    field, debt_id = data.rsplit("_", 1)
-    debt_id = int(debt_id)
+    field, token = data.rsplit("_", 1)
+    entry = await callback_store.get(token)
+    if entry is None:
+        await safe_edit(query, "❌ Qarz topilmadi.")
+        return ConversationHandler.END
     
-    context.user_data['edit_debt_id'] = debt_id
+    context.user_data['edit_debt_id'] = entry[0]['debt_id']
     context.user_data['edit_field'] = field
     
     field_names = {
@@ -864,7 +3113,7 @@ async def edit_field_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
     prompt, db_field = field_names.get(field, ('Yangi qiymatni kiriting:', field))
     context.user_data['edit_db_field'] = db_field
     
-    await query.edit_message_text(prompt, parse_mode='HTML')
+    await safe_edit(query, prompt, parse_mode='HTML')
     return DEBT_EDIT_VALUE
 
 async def edit_value_received(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -901,10 +3150,12 @@ async def edit_value_received(update: Update, context: ContextTypes.DEFAULT_TYPE
     await update.message.reply_text("✅ <b>O'zgartirildi!</b>", parse_mode='HTML', reply_markup=main_menu_keyboard())
     return ConversationHandler.END
 
-async def statistics_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
-    db_user = await get_or_create_user(user.id, user.full_name, user.username)
-    stats = await get_statistics(db_user['id'])
+def unpriced_note(base):
+    return f" <i>({', '.join(base['unpriced'])} kursi yo'q)</i>" if base['unpriced'] else ""
+
+async def render_statistics(user_id):
+    stats = await get_statistics(user_id)
+    base = await get_base_totals(user_id)
     
     text = "📊 <b>STATISTIKA</b>\n\n"
     text += "💰 <b>Bergan qarzlar:</b>\n"
@@ -931,39 +3182,149 @@ async def statistics_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
     else:
         text += "   Yo'q\n"
     
-    await update.message.reply_html(text)
+    if base:
+        currency, net = base['currency'], base['net']
+        text += f"\n💱 <b>Jami ({currency} hisobida):</b>{unpriced_note(base)}\n"
+        text += f"   💰 Bergan: {format_money(base['given'], currency)}\n"
+        text += f"   💸 Olgan: {format_money(base['taken'], currency)}\n"
+        text += f"   ⚖️ Sof: {'−' if net < 0 else ''}{format_money(abs(net), currency)}\n"
+        text += f"   🗓 Oylik harajat: {format_money(base['month'], currency)}\n"
+    else:
+        currency = None
+        text += "\n💱 <i>Jami hisoblab bo'lmadi: valyuta kursi yo'q.</i>\n"
+    rates = await rate_service.rates()
+    if 'USD' in rates:
+        text += f"\n<i>1 USD = {format_money(rates['USD'], 'UZS')}</i>"
+    return text, base_currency_keyboard(currency)
+
+async def statistics_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    db_user = await get_or_create_user(user.id, user.full_name, user.username)
+    text, markup = await render_statistics(db_user['id'])
+    await update.message.reply_html(text, reply_markup=markup)
+
+async def base_currency_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    user = update.effective_user
+    db_user = await get_or_create_user(user.id, user.full_name, user.username)
+    currency = query.data.replace("base_", "")
+    if currency not in CURRENCIES:
+        return
+    await set_base_currency(db_user, currency)
+    text, markup = await render_statistics(db_user['id'])
+    await safe_edit(query, text, markup)
+
+async def export_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    db_user = await get_or_create_user(user.id, user.full_name, user.username)
+    status = await update.message.reply_text("⏳ Excel fayl navbatga qo'yildi...", reply_markup=report_cancel_keyboard())
+    progress = ReportProgress(status, "⏳ Excel fayl tayyorlanmoqda")
+    fd, path = tempfile.mkstemp(prefix="hisobchi_", suffix=".xlsx")
+    os.close(fd)
+    try:
+        job = report_pool.submit(user.id, 'process', build_export, path, db_user['id'],
+                                 on_progress=progress.update, on_discard=lambda: remove_file(path))
+    except ReportBusy:
+        remove_file(path)
+        await progress.edit("⏳ Hisobot allaqachon tayyorlanmoqda yoki navbat to'la. Birozdan keyin urinib ko'ring.")
+        return
+    # Follow the job in the background so this chat's next updates are not held up behind it
+    context.application.create_task(deliver_export(update, job, progress, path, db_user['id']), update=update)
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+async def deliver_export(update, job, progress, path, user_id):
+    started = time.perf_counter()
+    try:
+        await progress.follow(job)
+        if job.cancelled():
+            # report_pool removes the file once the job has stopped writing it
+            await progress.edit("❌ Eksport bekor qilindi.")
+            return
+        try:
+            rows = job.result()
+            logger.info(f"Export for user {user_id}: {rows} rows, {os.path.getsize(path)} bytes "
+                        f"in {time.perf_counter() - started:.2f}s")
+            await progress.edit(f"✅ Tayyor: {rows:,} qator")
+            with open(path, 'rb') as f:
+                await update.message.reply_document(
+                    document=f,
+                    filename=f"hisobchi_{date.today().strftime('%Y%m%d')}.xlsx",
+                    caption="📤 Barcha qarzlar va harajatlar",
+                    write_timeout=120
+                )
+        finally:
+            remove_file(path)
+    except Exception as e:
+        logger.error(f"Export for user {user_id} failed: {e}")
+        await progress.edit("❌ Eksportda xatolik yuz berdi. Keyinroq urinib ko'ring.")
+
+async def report_cancel_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    if report_pool.cancel(query.from_user.id):
+        await query.answer("❌ Bekor qilindi")
+    else:
+        await query.answer("Faol hisobot yo'q")
+        await safe_edit(query, query.message.text_html)
 
 async def back_main_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    await query.edit_message_text("✅")
-    await query.message.reply_text("Asosiy menyu:", reply_markup=main_menu_keyboard())
+    # The reply keyboard with the main menu is always there; just close the inline screen
+    await safe_edit(query, "🏠 Asosiy menyu")
 
 async def back_debts_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    await query.edit_message_text("📋 <b>Mening qarzlarim</b>", parse_mode='HTML', reply_markup=my_debts_keyboard())
+    await safe_edit(query, "📋 <b>Mening qarzlarim</b>", my_debts_keyboard())
 
 # EXPENSE HISTORY HANDLERS
-async def expense_history_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
-    db_user = await get_or_create_user(user.id, user.full_name, user.username)
-    expenses = await get_expenses(db_user['id'])
+async def render_expense_history(user_id, seek=None, before=False):
+    """Text and keyboard for one page of expenses, newest first"""
+    expenses, has_more = await get_expenses_page(user_id, seek, before)
+    if seek and not expenses:
+        seek, before = None, False
+        expenses, has_more = await get_expenses_page(user_id)
     
     if not expenses:
-        await update.message.reply_text("📋 <b>Harajatlar tarixi</b>\n\n📭 Harajat topilmadi.", parse_mode='HTML')
-        return
+        return "📋 <b>Harajatlar tarixi</b>\n\n📭 Harajat topilmadi.", None
     
-    # Calculate totals
-    total_uzs = sum(e['amount'] for e in expenses if e['currency'] == 'UZS')
-    total_usd = sum(e['amount'] for e in expenses if e['currency'] == 'USD')
+    totals, count = await get_expense_totals(user_id)
+    total_uzs = totals.get('UZS')
+    total_usd = totals.get('USD')
     
     text = "📋 <b>Harajatlar tarixi</b>\n\n"
     if total_uzs: text += f"💵 Jami UZS: {format_money(total_uzs, 'UZS')}\n"
     if total_usd: text += f"💵 Jami USD: {format_money(total_usd, 'USD')}\n"
-    text += f"\n📌 {len(expenses)} ta harajat"
+    text += f"\n📌 {count} ta harajat"
+    
+    first, last = expenses[0], expenses[-1]
+    has_prev = has_more if before else seek is not None
+    has_next = True if before else has_more
+    prev_data = f"epage_{format_page_data('p', first['expense_date'], first['id'])}" if has_prev else None
+    next_data = f"epage_{format_page_data('n', last['expense_date'], last['id'])}" if has_next else None
+    return text, expense_list_keyboard(expenses, prev_data, next_data)
+
+async def expense_history_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    db_user = await get_or_create_user(user.id, user.full_name, user.username)
+    text, markup = await render_expense_history(db_user['id'])
+    await update.message.reply_text(text, parse_mode='HTML', reply_markup=markup)
+
+async def expense_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
     
-    await update.message.reply_text(text, parse_mode='HTML', reply_markup=expense_list_keyboard(expenses))
+    user = update.effective_user
+    db_user = await get_or_create_user(user.id, user.full_name, user.username)
+    seek, before = parse_page_data(query.data.replace("epage_", "", 1))
+    text, markup = await render_expense_history(db_user['id'], seek, before)
+    await safe_edit(query, text, markup)
 
 async def view_expense_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -973,13 +3334,13 @@ async def view_expense_callback(update: Update, context: ContextTypes.DEFAULT_TY
     expense = await get_expense_by_id(expense_id)
     
     if not expense:
-        await query.edit_message_text("❌ Harajat topilmadi.")
+        await safe_edit(query, "❌ Harajat topilmadi.")
         return
     
     category_names = {'food': 'Oziq-ovqat', 'transport': 'Transport', 'home': 'Uy-joy', 
                       'clothes': 'Kiyim', 'health': "Sog'liq", 'other': 'Boshqa'}
-    cat_name = category_names.get(expense.get('category', 'other'), 'Boshqa')
-    exp_date = expense['expense_date'][:10] if expense.get('expense_date') else "Noma'lum"
+    cat_name = category_names.get(expense['category'], 'Boshqa')
+    exp_date = format_date(expense['expense_date']) if expense['expense_date'] else "Noma'lum"
     
     text = f"""
 📝 <b>Harajat</b>
@@ -989,7 +3350,7 @@ async def view_expense_callback(update: Update, context: ContextTypes.DEFAULT_TY
 💰 <b>Summa:</b> {format_money(expense['amount'], expense['currency'])}
 📅 <b>Sana:</b> {exp_date}
 """
-    await query.edit_message_text(text, parse_mode='HTML', reply_markup=expense_action_keyboard(expense_id))
+    await safe_edit(query, text, expense_action_keyboard(expense_id))
 
 async def delete_expense_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -999,10 +3360,10 @@ async def delete_expense_callback(update: Update, context: ContextTypes.DEFAULT_
     expense = await get_expense_by_id(expense_id)
     
     if not expense:
-        await query.edit_message_text("❌ Harajat topilmadi.")
+        await safe_edit(query, "❌ Harajat topilmadi.")
         return
     
-    await query.edit_message_text(
+    await safe_edit(query, 
         f"⚠️ <b>O'chirishni tasdiqlang</b>\n\n📄 {expense['description']}\n💰 {format_money(expense['amount'], expense['currency'])}\n\nRostdan ham o'chirmoqchimisiz?",
         parse_mode='HTML',
         reply_markup=expense_delete_confirm_keyboard(expense_id)
@@ -1010,12 +3371,17 @@ async def delete_expense_callback(update: Update, context: ContextTypes.DEFAULT_
 
 async def confirm_delete_expense_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
     
     expense_id = int(query.data.replace("confirm_del_exp_", ""))
+    expense = await get_expense_by_id(expense_id)
+    if not expense:
+        await query.answer()
+        await safe_edit(query, "❌ Harajat topilmadi.")
+        return
     await delete_expense(expense_id)
-    await query.edit_message_text("🗑 <b>O'chirildi!</b>", parse_mode='HTML')
-    await query.message.reply_text("Asosiy menyu:", reply_markup=main_menu_keyboard())
+    await query.answer("🗑 O'chirildi!")
+    text, markup = await render_expense_history(expense['user_id'])
+    await safe_edit(query, text, markup)
 
 async def back_expenses_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -1023,25 +3389,434 @@ async def back_expenses_callback(update: Update, context: ContextTypes.DEFAULT_T
     
     user = update.effective_user
     db_user = await get_or_create_user(user.id, user.full_name, user.username)
-    expenses = await get_expenses(db_user['id'])
-    
-    if not expenses:
-        await query.edit_message_text("📋 <b>Harajatlar tarixi</b>\n\n📭 Harajat topilmadi.", parse_mode='HTML')
-        return
-    
-    total_uzs = sum(e['amount'] for e in expenses if e['currency'] == 'UZS')
-    total_usd = sum(e['amount'] for e in expenses if e['currency'] == 'USD')
-    
-    text = "📋 <b>Harajatlar tarixi</b>\n\n"
-    if total_uzs: text += f"💵 Jami UZS: {format_money(total_uzs, 'UZS')}\n"
-    if total_usd: text += f"💵 Jami USD: {format_money(total_usd, 'USD')}\n"
-    text += f"\n📌 {len(expenses)} ta harajat"
-    
-    await query.edit_message_text(text, parse_mode='HTML', reply_markup=expense_list_keyboard(expenses))
+    text, markup = await render_expense_history(db_user['id'])
+    await safe_edit(query, text, markup)
+
+# ============== REMINDERS ==============
+def pack_message(header, blocks, footer="", limit=4000):
+    """Join text blocks into as few parts as fit a Telegram message each"""
+    parts, text = [], header
+    for block in blocks + ([footer] if footer else []):
+        if len(text) + len(block) > limit:
+            parts.append(text)
+            text = ""
+        text += block
+    parts.append(text)
+    return parts
+
+def debt_reminder_block(row, today):
+    due_date = row['installment_due'] or row['due_date']
+    days = days_until(due_date, today)
+    when = "bugun" if days == 0 else f"{days} kun qoldi" if days > 0 else f"{abs(days)} kun o'tdi"
+    if row['debt_type'] == 'given':
+        line = f"\n💰 <b>{row['person_name']}</b> sizga qaytarishi kerak: {format_money(row['amount'], row['currency'])}"
+    else:
+        line = f"\n💸 <b>{row['person_name']}</b>ga qaytarishingiz kerak: {format_money(row['amount'], row['currency'])}"
+    if row['installment_amount'] is not None:
+        line += f"\n📅 Navbatdagi to'lov: {format_money(row['installment_amount'], row['currency'])}"
+    return line + f"\n⏰ {format_date(due_date)} ({when})\n"
+
+def reminder_messages(rows):
+    """Reminder text for one chat"""
+    blocks, seen, today = [], set(), current_date()
+    for row in rows:
+        # Missed sweeps can leave several reminders for one debt; mention it once
+        if row['debt_id'] in seen:
+            continue
+        seen.add(row['debt_id'])
+        blocks.append(debt_reminder_block(row, today))
+    return pack_message("🔔 <b>Eslatma</b>\n", blocks)
+
+def overdue_messages(rows):
+    """Overdue digest for one user: debts oldest first, then totals per side and currency"""
+    totals = {'given': {}, 'taken': {}}
+    for row in rows:
+        side = totals[row['debt_type']]
+        side[row['currency']] = side.get(row['currency'], 0) + row['amount']
+    footer = "\n<b>Jami:</b>\n"
+    for currency, total in totals['given'].items():
+        footer += f"💰 Sizga qaytarilishi kerak: {format_money(total, currency)}\n"
+    for currency, total in totals['taken'].items():
+        footer += f"💸 Siz qaytarishingiz kerak: {format_money(total, currency)}\n"
+    header = f"🔴 <b>Muddati o'tgan qarzlar: {len(rows)} ta</b>\n"
+    today = current_date()
+    return pack_message(header, [debt_reminder_block(row, today) for row in rows], footer)
+
+class ChatDispatcher:
+    """Sends one message per chat for a stream of (telegram_id, rows) groups.
+
+    Workers pull groups from a bounded queue and send at PRIORITY_BULK, so the
+    bot's BotRateLimiter paces them and lets interactive replies go first.
+    Rows of chats that got their message, or that blocked the bot or no longer
+    exist, are passed to `on_delivered` in batches; chats whose send still failed
+    after the limiter's retries are left for the next sweep.
+    """
+
+    def __init__(self, bot, render, on_delivered=None, name="Broadcast",
+                 workers=REMINDER_WORKERS, flush_size=500):
+        self.bot = bot
+        self.render = render
+        self.on_delivered = on_delivered
+        self.name = name
+        self.workers = workers
+        self.flush_size = flush_size
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+        self._delivered = []
+
+    async def run(self, groups):
+        started = time.monotonic()
+        queue = asyncio.Queue(self.workers * 2)
+        workers = [asyncio.create_task(self._worker(queue)) for _ in range(self.workers)]
+        try:
+            async for telegram_id, rows in groups:
+                await self._put(queue, (telegram_id, rows), workers)
+            for _ in workers:
+                await self._put(queue, None, workers)
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await self._flush()
+        logger.info(f"{self.name}: {self.sent} chats sent, {self.dropped} unreachable, {self.failed} failed "
+                    f"in {time.monotonic() - started:.1f}s")
+
+    async def _put(self, queue, item, workers):
+        """queue.put() that stops waiting, and re-raises, if a worker ended early -
+        with no one left to drain the queue the put would block forever"""
+        put = asyncio.ensure_future(queue.put(item))
+        done, _ = await asyncio.wait([put, *workers], return_when=asyncio.FIRST_COMPLETED)
+        if put in done:
+            return
+        put.cancel()
+        for worker in done:
+            worker.result()
+        raise RuntimeError(f"{self.name}: a worker exited before the queue was drained")
+
+    async def _worker(self, queue):
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            telegram_id, rows = item
+            status = await self._send_chat(telegram_id, rows)
+            if status == 'failed':
+                self.failed += 1
+                continue
+            if status == 'sent':
+                self.sent += 1
+            else:
+                self.dropped += 1
+            if self.on_delivered:
+                self._delivered.extend(rows)
+                if len(self._delivered) >= self.flush_size:
+                    await self._flush()
+
+    async def _flush(self):
+        rows, self._delivered = self._delivered, []
+        if rows:
+            await self.on_delivered(rows)
+
+    async def _send_chat(self, chat_id, rows):
+        # Whatever goes wrong with one chat must not take its worker down with it
+        try:
+            for text in self.render(rows):
+                await self.bot.send_message(chat_id, text, parse_mode='HTML',
+                                            rate_limit_args={'priority': PRIORITY_BULK})
+        except (Forbidden, BadRequest) as e:
+            logger.info(f"{self.name}: message to {chat_id} dropped: {e}")
+            return 'dropped'
+        except (RetryAfter, NetworkError) as e:
+            logger.warning(f"{self.name}: message to {chat_id} failed: {e}")
+            return 'failed'
+        except Exception:
+            logger.exception(f"{self.name}: message to {chat_id} failed")
+            return 'failed'
+        return 'sent'
+
+async def send_due_reminders(bot, debt_ids=None):
+    """One sweep of due reminders (only those of `debt_ids`, if given); False if some
+    were left unsent and need another sweep"""
+    async def mark_sent(rows):
+        await mark_reminders_sent([row['id'] for row in rows])
+    dispatcher = ChatDispatcher(bot, reminder_messages, mark_sent, name="Reminders")
+    try:
+        await dispatcher.run(iter_due_reminders(debt_ids=debt_ids))
+    except Exception as e:
+        logger.error(f"Reminder dispatch failed: {e}")
+        return False
+    return dispatcher.failed == 0
+
+async def send_overdue_digest(bot):
+    await ChatDispatcher(bot, overdue_messages, name="Overdue digest").run(iter_overdue_debts())
+
+# Bot used by durable jobs, which are pickled and so only reference module-level functions
+scheduled_bot = None
+
+async def overdue_digest_job():
+    await run_once_per_day('overdue_digest', lambda: send_overdue_digest(scheduled_bot))
+
+def reminder_instant(day):
+    return datetime(day.year, day.month, day.day, REMINDER_HOUR)
+
+class DueScheduler:
+    """Min-heap of upcoming reminder instants; the task sleeps until the earliest one.
+
+    Entries are (instant, debt_id, version). Rescheduling or discarding a debt bumps
+    or drops its version, so its old entries are skipped when they surface instead
+    of being searched for in the heap. Each wake calls on_due(debt_ids) with just the
+    debts whose entries surfaced, or None (sweep everything due) when there are more
+    than REMINDER_FETCH_SIZE of them. A sweep that left reminders unsent (on_due()
+    returned False or raised) has its debts retried with exponential backoff.
+    """
+
+    # Wake at least this often so wall-clock jumps (suspend, NTP) are noticed
+    MAX_SLEEP = 3600
+
+    def __init__(self):
+        self._heap = []
+        self._versions = {}
+        self._wakeup = None
+        self._task = None
+        self._retry_at = None
+        self._retry_ids = set()
+        self._retry_delay = 0
+
+    @property
+    def running(self):
+        return self._task is not None
+
+    async def start(self, on_due):
+        """Load pending reminders and start waking `on_due(debt_ids)` whenever some come due"""
+        self._wakeup = asyncio.Event()
+        async with db_pool.reader() as db:
+            cursor = await db.execute("""
+                SELECT r.debt_id, r.remind_date FROM reminders r
+                JOIN debts d ON d.id = r.debt_id
+                WHERE r.is_sent = 0 AND d.is_paid = 0
+            """)
+            rows = await cursor.fetchall()
+        for debt_id, remind_date in rows:
+            self._versions[debt_id] = 1
+            self._heap.append((reminder_instant(remind_date), debt_id, 1))
+        heapq.heapify(self._heap)
+        self._task = asyncio.create_task(self._run(on_due))
+        logger.info(f"Due scheduler loaded {len(self._heap)} reminders for {len(self._versions)} debts")
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def schedule(self, debt_id, *due_dates):
+        """(Re)schedule a debt's reminders after it was added or its due date changed;
+        installment debts pass every installment's due date"""
+        if not self.running:
+            return
+        version = self._versions.get(debt_id, 0) + 1
+        self._versions[debt_id] = version
+        for day in {day for due_date in due_dates for day in reminder_dates(due_date)}:
+            heapq.heappush(self._heap, (reminder_instant(day), debt_id, version))
+        self._wakeup.set()
+
+    def discard(self, debt_id):
+        """Forget a debt that was repaid or deleted"""
+        if self._versions.pop(debt_id, None) is not None and len(self._heap) > 2 * len(self._versions) + 64:
+            # Mostly stale entries left - rebuild rather than let them pile up
+            self._heap = [entry for entry in self._heap if self._versions.get(entry[1]) == entry[2]]
+            heapq.heapify(self._heap)
+
+    def _pop_stale(self):
+        while self._heap and self._versions.get(self._heap[0][1]) != self._heap[0][2]:
+            heapq.heappop(self._heap)
+
+    def _next_instant(self):
+        self._pop_stale()
+        instants = [self._heap[0][0]] if self._heap else []
+        if self._retry_at:
+            instants.append(self._retry_at)
+        return min(instants, default=None)
+
+    async def _run(self, on_due):
+        while True:
+            self._wakeup.clear()
+            instant = self._next_instant()
+            if instant is None:
+                await self._wakeup.wait()
+                continue
+            delay = (instant - datetime.now()).total_seconds()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), min(delay, self.MAX_SLEEP))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            # The debts due so far go out in one sweep; the database decides what is pending
+            now = datetime.now()
+            debt_ids = set()
+            while self._heap and self._heap[0][0] <= now:
+                _, debt_id, version = heapq.heappop(self._heap)
+                if self._versions.get(debt_id) == version:
+                    debt_ids.add(debt_id)
+            if self._retry_at and self._retry_at <= now:
+                debt_ids = None if self._retry_ids is None else debt_ids | self._retry_ids
+                self._retry_at, self._retry_ids = None, set()
+            if debt_ids is not None and not debt_ids:
+                continue  # only stale entries surfaced
+            if debt_ids is not None and len(debt_ids) > REMINDER_FETCH_SIZE:
+                debt_ids = None
+            try:
+                complete = await on_due(debt_ids)
+            except Exception as e:
+                logger.error(f"Reminder sweep failed: {e}")
+                complete = False
+            if complete is False:
+                self._retry_ids = None if debt_ids is None or self._retry_ids is None else self._retry_ids | debt_ids
+                self._retry_delay = min(self._retry_delay * 2 or REMINDER_RETRY_SECONDS, self.MAX_SLEEP)
+                self._retry_at = datetime.now() + timedelta(seconds=self._retry_delay)
+                logger.info(f"Unsent reminders retried in {self._retry_delay}s")
+            elif not self._retry_at:
+                self._retry_delay = 0
+
+due_scheduler = DueScheduler()
 
 # ============== MAIN ==============
+class BotRateLimiter(BaseRateLimiter):
+    """Central limiter for every Bot API call the application makes.
+
+    A call takes a token from its chat's bucket (slower for groups), then from the
+    global one. Calls run at PRIORITY_INTERACTIVE unless they pass
+    rate_limit_args={'priority': ...}, so bulk sends only get tokens no handler is
+    waiting for. RetryAfter on a call to one chat pauses only that chat's bucket;
+    the global bucket is paused for calls without a chat, or once global_flood_chats
+    chats are under RetryAfter at the same time. The call is then retried. Other
+    network errors are retried with exponential backoff, except a timed-out send*,
+    which may already have been delivered.
+    """
+
+    def __init__(self, rate=API_RATE, chat_rate=API_CHAT_RATE, chat_burst=API_CHAT_BURST,
+                 group_rate=API_GROUP_RATE, max_retries=API_MAX_RETRIES, global_flood_chats=API_GLOBAL_FLOOD_CHATS):
+        self.overall = TokenBucket(rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.global_flood_chats = max(1, global_flood_chats)
+        self._chats = {}
+        self._flooded = {}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= 10000:
+                self._chats = {key: b for key, b in self._chats.items() if not b.idle}
+            # Groups and channels have negative ids (or an @username)
+            if isinstance(chat_id, str) or chat_id < 0:
+                bucket = TokenBucket(self.group_rate, 20)
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    def _flood(self, chat_id, chat, retry_after):
+        """Pause what a RetryAfter on `chat_id` (None: a call without a chat) points at"""
+        if chat is None:
+            self.overall.pause(retry_after)
+            return
+        chat.pause(retry_after)
+        now = time.monotonic()
+        self._flooded = {key: until for key, until in self._flooded.items() if until > now}
+        self._flooded[chat_id] = now + retry_after
+        if len(self._flooded) >= self.global_flood_chats:
+            logger.warning(f"Flood control on {len(self._flooded)} chats at once, pausing all calls")
+            self.overall.pause(retry_after)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = (rate_limit_args or {}).get('priority', PRIORITY_INTERACTIVE)
+        chat_id = data.get('chat_id')
+        chat = self._chat_bucket(chat_id) if chat_id is not None else None
+        for attempt in range(self.max_retries + 1):
+            if chat:
+                await chat.acquire(priority)
+            await self.overall.acquire(priority)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                logger.warning(f"Flood control on {endpoint}, retrying in {e.retry_after}s")
+                self._flood(chat_id, chat, e.retry_after)
+            except BadRequest:
+                raise
+            except NetworkError as e:
+                if attempt == self.max_retries or (isinstance(e, TimedOut) and endpoint.startswith('send')):
+                    raise
+                logger.warning(f"{endpoint} failed ({e}), retry {attempt + 1}")
+                await asyncio.sleep(0.5 * 2 ** attempt)
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Runs up to `concurrency` updates at once, serialised per chat.
+
+    Conversation steps of one chat arrive in order and must not overlap, so each chat
+    gets an asyncio.Lock (FIFO) for as long as any of its updates is in flight. The
+    base class's limit (max_concurrent_updates) only bounds how many updates are
+    admitted; the `concurrency` slots are taken after the chat lock, so updates
+    waiting behind their chat hold none and one busy chat cannot starve the others.
+    """
+
+    def __init__(self, concurrency, backlog=UPDATE_BACKLOG):
+        super().__init__(max(concurrency, backlog))
+        self.concurrency = concurrency
+        self._slots = asyncio.BoundedSemaphore(concurrency)
+        self._locks = {}
+
+    async def do_process_update(self, update, coroutine):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            async with self._slots:
+                await self._run(coroutine)
+            return
+        entry = self._locks.setdefault(chat.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0], self._slots:
+                await self._run(coroutine)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[chat.id]
+
+    async def _run(self, coroutine):
+        request_date.set(date.today())
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
 def main():
-    application = Application.builder().token(BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(PerChatUpdateProcessor(UPDATE_CONCURRENCY))
+        .rate_limiter(BotRateLimiter())
+        .persistence(persistence)
+        .build()
+    )
     
     # Debt given handler
     debt_given_handler = ConversationHandler(
@@ -1061,7 +3836,9 @@ def main():
             DEBT_CONFIRM: [CallbackQueryHandler(debt_confirm_callback, pattern=r'^confirm_')]
         },
         fallbacks=[CommandHandler('cancel', cancel_command), CommandHandler('start', start_command)],
-        allow_reentry=True
+        allow_reentry=True,
+        name='debt_given',
+        persistent=True
     )
     
     # Debt taken handler
@@ -1082,7 +3859,9 @@ def main():
             DEBT_CONFIRM: [CallbackQueryHandler(debt_confirm_callback, pattern=r'^confirm_')]
         },
         fallbacks=[CommandHandler('cancel', cancel_command), CommandHandler('start', start_command)],
-        allow_reentry=True
+        allow_reentry=True,
+        name='debt_taken',
+        persistent=True
     )
     
     # Expense handler
@@ -1094,17 +3873,22 @@ def main():
             EXPENSE_CATEGORY: [CallbackQueryHandler(expense_category_callback, pattern=r'^cat_')]
         },
         fallbacks=[CommandHandler('cancel', cancel_command), CommandHandler('start', start_command)],
-        allow_reentry=True
+        allow_reentry=True,
+        name='expense',
+        persistent=True
     )
     
     # Repayment handler
     repay_handler = ConversationHandler(
         entry_points=[CallbackQueryHandler(repay_debt_callback, pattern=r'^repay_')],
         states={
-            DEBT_PARTIAL_PAYMENT: [MessageHandler(filters.TEXT & ~filters.COMMAND, repay_amount_received)]
+            DEBT_PARTIAL_PAYMENT: [MessageHandler(filters.TEXT & ~filters.COMMAND, repay_amount_received),
+                                   CallbackQueryHandler(repay_amount_choice, pattern=r'^rpamt_[01]$')]
         },
         fallbacks=[CommandHandler('cancel', cancel_command), CommandHandler('start', start_command)],
-        allow_reentry=True
+        allow_reentry=True,
+        name='repay',
+        persistent=True
     )
     
     # Edit handler
@@ -1114,7 +3898,9 @@ def main():
             DEBT_EDIT_VALUE: [MessageHandler(filters.TEXT & ~filters.COMMAND, edit_value_received)]
         },
         fallbacks=[CommandHandler('cancel', cancel_command), CommandHandler('start', start_command)],
-        allow_reentry=True
+        allow_reentry=True,
+        name='edit_debt',
+        persistent=True
     )
     
     # Add handlers
@@ -1126,10 +3912,14 @@ def main():
     application.add_handler(repay_handler)
     application.add_handler(edit_handler)
     application.add_handler(MessageHandler(filters.Regex(r'^📊 Statistika$'), statistics_handler))
+    application.add_handler(CallbackQueryHandler(base_currency_callback, pattern=r'^base_[A-Z]+$'))
+    application.add_handler(MessageHandler(filters.Regex(r'^📤 Excel eksport$'), export_handler))
+    application.add_handler(CallbackQueryHandler(report_cancel_callback, pattern=r'^report_cancel$'))
     application.add_handler(MessageHandler(filters.Regex(r'^📋 Mening qarzlarim$'), my_debts_handler))
     application.add_handler(MessageHandler(filters.Regex(r'^📋 Harajatlar tarixi$'), expense_history_handler))
     application.add_handler(CallbackQueryHandler(view_debts_callback, pattern=r'^view_'))
-    application.add_handler(CallbackQueryHandler(view_debt_detail_callback, pattern=r'^debt_\d+$'))
+    application.add_handler(CallbackQueryHandler(debt_page_callback, pattern=r'^dpage_'))
+    application.add_handler(CallbackQueryHandler(view_debt_detail_callback, pattern=r'^debt_[0-9a-f]+$'))
     application.add_handler(CallbackQueryHandler(mark_debt_paid_callback, pattern=r'^mark_paid_'))
     application.add_handler(CallbackQueryHandler(delete_debt_callback, pattern=r'^delete_debt_'))
     application.add_handler(CallbackQueryHandler(confirm_delete_callback, pattern=r'^confirm_delete_'))
@@ -1138,18 +3928,64 @@ def main():
     application.add_handler(CallbackQueryHandler(delete_expense_callback, pattern=r'^delete_expense_'))
     application.add_handler(CallbackQueryHandler(confirm_delete_expense_callback, pattern=r'^confirm_del_exp_'))
     application.add_handler(CallbackQueryHandler(back_expenses_callback, pattern=r'^back_expenses$'))
+    application.add_handler(CallbackQueryHandler(expense_page_callback, pattern=r'^epage_'))
     application.add_handler(CallbackQueryHandler(back_main_callback, pattern=r'^back_main$'))
     application.add_handler(CallbackQueryHandler(back_debts_callback, pattern=r'^back_debts$'))
     
+    scheduler = AsyncIOScheduler(job_defaults={'coalesce': True, 'misfire_grace_time': JOB_MISFIRE_GRACE})
+    scheduler.add_jobstore(job_store, 'durable')
+    
     # Initialize DB
     async def post_init(app):
+        global scheduled_bot
+        scheduled_bot = app.bot
+        await db_pool.open()
         await init_db()
+        await job_store.load()
         logger.info("Database ready!")
+        if DB_JOURNAL_MODE.upper() == 'WAL':
+            scheduler.add_job(wal_checkpoint, 'interval', minutes=DB_CHECKPOINT_MINUTES)
+        scheduler.add_job(callback_store.purge, 'interval', hours=6)
+        scheduler.start()
+        ensure_job(scheduler, overdue_digest_job, CronTrigger(day=OVERDUE_DIGEST_DAY, hour=OVERDUE_DIGEST_HOUR),
+                   'overdue_digest')
+        await due_scheduler.start(lambda debt_ids: send_due_reminders(app.bot, debt_ids))
+        if WRITE_BEHIND:
+            write_behind.start()
+        report_pool.start()
+    
+    async def post_shutdown(app):
+        if scheduler.running:
+            scheduler.shutdown(wait=False)
+        await due_scheduler.stop()
+        await report_pool.close()
+        await write_behind.close()
+        await job_store.flush()
+        await callback_store.flush()
+        logger.info(f"User cache: {user_cache.hits} hits, {user_cache.misses} misses, {len(user_cache)} entries")
+        await db_pool.close()
+        logger.info("Database closed")
     
     application.post_init = post_init
-    
-    logger.info("Hisobchi Bot started!")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    application.post_shutdown = post_shutdown
+    
+    if WEBHOOK_URL:
+        logger.info(f"Hisobchi Bot started! Webhook on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}")
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET or None,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=ALLOWED_UPDATES,
+        )
+    else:
+        logger.info("Hisobchi Bot started!")
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 if __name__ == '__main__':
-    main()
+    if '--verify-rollups' in sys.argv or '--rebuild-rollups' in sys.argv:
+        asyncio.run(rollups_command(rebuild='--rebuild-rollups' in sys.argv))
+    else:
+        main()
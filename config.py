@@ -1,11 +1,37 @@
+import hashlib
 import os
 
 # Hisobchi Bot Configuration
 # Railway'da BOT_TOKEN environment variable sifatida o'rnatiladi
 BOT_TOKEN = os.getenv("BOT_TOKEN", "8450831935:AAGhmhvWFmQH-4AOrOUFyDfiv_ufJYvXztw")
 
+# Bot qabul qiladigan update turlari (handlerlar faqat shularni ishlatadi)
+ALLOWED_UPDATES = ["message", "callback_query"]
+
+# Webhook rejimi: WEBHOOK_URL (ommaviy https manzil) berilsa, polling o'rniga webhook ishlaydi
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("PORT", "8443"))
+# Taxmin qilib bo'lmaydigan yo'l - berilmasa tokendan hosil qilinadi
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH") or hashlib.sha256(BOT_TOKEN.encode()).hexdigest()[:32]
+# Telegram har so'rovda X-Telegram-Bot-Api-Secret-Token sarlavhasida qaytaradi
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+
 # Eslatma kunlari (muddatdan necha kun oldin)
 REMINDER_DAYS = [3, 1, 0]
 
 # Valyuta kurslari (UZS uchun)
 USD_TO_UZS_RATE = 12700
+
+# Ma'lumotlar bazasi ulanishlari puli
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+
+# SQLite saqlash profili
+DB_JOURNAL_MODE = os.getenv("DB_JOURNAL_MODE", "WAL")
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "16384"))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(64 * 1024 * 1024)))
+DB_TEMP_STORE = os.getenv("DB_TEMP_STORE", "MEMORY")
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_CHECKPOINT_MINUTES = int(os.getenv("DB_CHECKPOINT_MINUTES", "10"))
@@ -1,103 +1,294 @@
 import aiosqlite
+import asyncio
+import logging
 import os
-from datetime import datetime, date
+import sqlite3
+from contextlib import asynccontextmanager
+from datetime import datetime, date, timedelta
+
+from config import (
+    DB_POOL_SIZE, DB_JOURNAL_MODE, DB_SYNCHRONOUS, DB_CACHE_SIZE_KB,
+    DB_MMAP_SIZE, DB_TEMP_STORE, DB_BUSY_TIMEOUT_MS
+)
+from utils import month_range
 
 DB_PATH = os.path.join(os.path.dirname(__file__), "hisobchi.db")
+# bot.py ning schema_version jadvali bilan to'qnashmasligi uchun
+SCHEMA_VERSION_TABLE = "schema_version_modular"
 
+# Har bir ulanish ochilganda bir marta qo'llaniladi
+CONNECTION_PRAGMAS = [
+    f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}",
+    f"PRAGMA synchronous = {DB_SYNCHRONOUS}",
+    f"PRAGMA cache_size = -{DB_CACHE_SIZE_KB}",
+    f"PRAGMA mmap_size = {DB_MMAP_SIZE}",
+    f"PRAGMA temp_store = {DB_TEMP_STORE}",
+]
 
-async def init_db():
-    """Ma'lumotlar bazasini yaratish"""
-    async with aiosqlite.connect(DB_PATH) as db:
+logger = logging.getLogger(__name__)
+
+
+# Sanalar ISO matn sifatida yoziladi, DATE/TIMESTAMP ustunlar esa date/datetime bo'lib qaytadi
+def _convert_date(value: bytes):
+    try:
+        return date.fromisoformat(value[:10].decode())
+    except ValueError:
+        return value.decode()
+
+
+def _convert_timestamp(value: bytes):
+    try:
+        return datetime.fromisoformat(value.decode())
+    except ValueError:
+        return value.decode()
+
+
+sqlite3.register_adapter(date, date.isoformat)
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(" "))
+sqlite3.register_converter("DATE", _convert_date)
+sqlite3.register_converter("TIMESTAMP", _convert_timestamp)
+
+
+class ConnectionPool:
+    """Ilova darajasidagi ulanishlar puli: bitta yozuvchi va bir nechta o'quvchi ulanish"""
+    
+    def __init__(self, path: str, size: int = DB_POOL_SIZE):
+        self.path = path
+        self.size = max(1, size)
+        self._writer = None
+        self._readers = None
+        self._write_lock = asyncio.Lock()
+        self._open_lock = asyncio.Lock()
+    
+    async def _connect(self, readonly: bool = False):
+        connector = aiosqlite.connect(self.path, detect_types=sqlite3.PARSE_DECLTYPES)
+        # Pul oqimlari jarayon tugashiga to'sqinlik qilmasligi uchun
+        connector.daemon = True
+        db = await connector
+        db.row_factory = aiosqlite.Row
+        for pragma in CONNECTION_PRAGMAS:
+            await db.execute(pragma)
+        if readonly:
+            await db.execute("PRAGMA query_only = ON")
+        return db
+    
+    async def open(self):
+        """Ulanishlarni ochish (post_init da chaqiriladi)"""
+        async with self._open_lock:
+            if self._writer is not None:
+                return
+            self._writer = await self._connect()
+            # journal_mode faylda saqlanadi, shuning uchun o'quvchilardan oldin o'rnatiladi
+            cursor = await self._writer.execute(f"PRAGMA journal_mode = {DB_JOURNAL_MODE}")
+            journal_mode = (await cursor.fetchone())[0]
+            self._readers = asyncio.Queue()
+            for _ in range(self.size):
+                self._readers.put_nowait(await self._connect(readonly=True))
+            logger.info(f"DB pool ochildi: 1 yozuvchi, {self.size} o'quvchi, journal_mode={journal_mode}")
+    
+    async def close(self):
+        """Barcha ulanishlarni yopish"""
+        async with self._open_lock:
+            if self._writer is None:
+                return
+            while not self._readers.empty():
+                await self._readers.get_nowait().close()
+            await self._writer.close()
+            self._writer = None
+            self._readers = None
+    
+    @asynccontextmanager
+    async def reader(self):
+        """O'qish uchun ulanish olish"""
+        if self._writer is None:
+            await self.open()
+        db = await self._readers.get()
+        try:
+            yield db
+        finally:
+            self._readers.put_nowait(db)
+    
+    @asynccontextmanager
+    async def writer(self):
+        """Yozuvchi ulanishni eksklyuziv olish; xatoda rollback qilinadi"""
+        if self._writer is None:
+            await self.open()
+        async with self._write_lock:
+            try:
+                yield self._writer
+            except BaseException:
+                await self._writer.rollback()
+                raise
+
+
+db_pool = ConnectionPool(DB_PATH)
+
+
+# (versiya, tavsif, qadamlar). Qadam - SQL yoki ulanishni qabul qiluvchi async funksiya.
+# Yangi migratsiyalar faqat oxiriga qo'shiladi; chiqarilganlari o'zgartirilmaydi.
+MIGRATIONS = [
+    (1, "asosiy sxema", [
         # Foydalanuvchilar jadvali
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                telegram_id INTEGER UNIQUE NOT NULL,
-                full_name TEXT,
-                username TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id INTEGER UNIQUE NOT NULL,
+            full_name TEXT,
+            username TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
         # Qarzlar jadvali
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS debts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                person_name TEXT NOT NULL,
-                amount REAL NOT NULL,
-                currency TEXT DEFAULT 'UZS',
-                debt_type TEXT NOT NULL,
-                payment_type TEXT DEFAULT 'one_time',
-                given_date DATE,
-                due_date DATE,
-                is_paid INTEGER DEFAULT 0,
-                notes TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )
-        """)
-        
+        """
+        CREATE TABLE IF NOT EXISTS debts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            person_name TEXT NOT NULL,
+            amount REAL NOT NULL,
+            currency TEXT DEFAULT 'UZS',
+            debt_type TEXT NOT NULL,
+            payment_type TEXT DEFAULT 'one_time',
+            given_date DATE,
+            due_date DATE,
+            is_paid INTEGER DEFAULT 0,
+            notes TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        """,
         # Bo'lib to'lashlar jadvali
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS installments (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                debt_id INTEGER NOT NULL,
-                amount REAL NOT NULL,
-                due_date DATE,
-                is_paid INTEGER DEFAULT 0,
-                paid_date DATE,
-                FOREIGN KEY (debt_id) REFERENCES debts (id)
-            )
-        """)
-        
+        """
+        CREATE TABLE IF NOT EXISTS installments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            debt_id INTEGER NOT NULL,
+            amount REAL NOT NULL,
+            due_date DATE,
+            is_paid INTEGER DEFAULT 0,
+            paid_date DATE,
+            FOREIGN KEY (debt_id) REFERENCES debts (id)
+        )
+        """,
         # Kunlik harajatlar jadvali
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS daily_expenses (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                description TEXT,
-                amount REAL NOT NULL,
-                currency TEXT DEFAULT 'UZS',
-                category TEXT,
-                expense_date DATE DEFAULT CURRENT_DATE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )
-        """)
-        
+        """
+        CREATE TABLE IF NOT EXISTS daily_expenses (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            description TEXT,
+            amount REAL NOT NULL,
+            currency TEXT DEFAULT 'UZS',
+            category TEXT,
+            expense_date DATE DEFAULT CURRENT_DATE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        """,
         # Eslatmalar jadvali
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS reminders (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                debt_id INTEGER NOT NULL,
-                remind_date DATE,
-                is_sent INTEGER DEFAULT 0,
-                FOREIGN KEY (debt_id) REFERENCES debts (id)
-            )
-        """)
-        
+        """
+        CREATE TABLE IF NOT EXISTS reminders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            debt_id INTEGER NOT NULL,
+            remind_date DATE,
+            is_sent INTEGER DEFAULT 0,
+            FOREIGN KEY (debt_id) REFERENCES debts (id)
+        )
+        """,
+    ]),
+    (2, "tez-tez ishlatiladigan so'rovlar uchun indekslar", [
+        # get_debts_by_type, get_statistics: user_id, debt_type, is_paid, due_date bo'yicha
+        "CREATE INDEX IF NOT EXISTS idx_debts_user_type ON debts (user_id, debt_type, is_paid, due_date)",
+        # get_all_active_debts: user_id = ? AND is_paid = 0 ORDER BY due_date
+        "CREATE INDEX IF NOT EXISTS idx_debts_active_user_due ON debts (user_id, due_date) WHERE is_paid = 0",
+        # get_overdue_debts: due_date < ? AND is_paid = 0
+        "CREATE INDEX IF NOT EXISTS idx_debts_active_due ON debts (due_date) WHERE is_paid = 0",
+        # get_expenses_by_date, get_expenses_by_month, get_statistics
+        "CREATE INDEX IF NOT EXISTS idx_expenses_user_date ON daily_expenses (user_id, expense_date)",
+        # get_installments, delete_debt
+        "CREATE INDEX IF NOT EXISTS idx_installments_debt_due ON installments (debt_id, due_date)",
+        # get_pending_reminders: remind_date = ? AND is_sent = 0
+        "CREATE INDEX IF NOT EXISTS idx_reminders_pending ON reminders (remind_date) WHERE is_sent = 0",
+        # delete_debt
+        "CREATE INDEX IF NOT EXISTS idx_reminders_debt ON reminders (debt_id)",
+    ]),
+    (3, "navbatdagi to'lov uchun indeks", [
+        # get_next_installment: debt_id = ? AND is_paid = 0 ORDER BY due_date
+        "CREATE INDEX IF NOT EXISTS idx_installments_debt_next ON installments (debt_id, is_paid, due_date)",
+    ]),
+]
+
+
+async def run_migrations(db, migrations: list):
+    """Kutilayotgan migratsiyalarni tartib bilan, har birini alohida tranzaksiyada bajarish
+    
+    bot.py ham shu hisobchi.db ni ishlatadi va schema_version jadvaliga o'zining boshqa
+    migratsiyalarini yozadi, shuning uchun bu versiyalar alohida jadvalda saqlanadi.
+    """
+    await db.execute(f"""
+        CREATE TABLE IF NOT EXISTS {SCHEMA_VERSION_TABLE} (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cursor = await db.execute(f"SELECT COALESCE(MAX(version), 0) FROM {SCHEMA_VERSION_TABLE}")
+    current = (await cursor.fetchone())[0]
+    for version, description, steps in migrations:
+        if version <= current:
+            continue
+        await db.execute("BEGIN")
+        for step in steps:
+            if callable(step):
+                await step(db)
+            else:
+                await db.execute(step)
+        await db.execute(
+            f"INSERT INTO {SCHEMA_VERSION_TABLE} (version, description) VALUES (?, ?)",
+            (version, description)
+        )
         await db.commit()
+        logger.info(f"Migratsiya {version} bajarildi: {description}")
+
+
+async def init_db():
+    """Ma'lumotlar bazasini yaratish va migratsiyalarni qo'llash"""
+    async with db_pool.writer() as db:
+        await run_migrations(db, MIGRATIONS)
+
+
+async def close_db():
+    """Ulanishlar pulini yopish"""
+    await db_pool.close()
+
+
+async def wal_checkpoint():
+    """WAL faylini asosiy bazaga ko'chirish va qisqartirish"""
+    async with db_pool.writer() as db:
+        cursor = await db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        busy, log_pages, checkpointed = await cursor.fetchone()
+    if busy:
+        logger.warning(f"WAL checkpoint to'liq emas: {checkpointed}/{log_pages} sahifa")
+    else:
+        logger.debug(f"WAL checkpoint: {checkpointed} sahifa")
 
 
 class Database:
     def __init__(self):
         self.db_path = DB_PATH
+        self.pool = db_pool
     
     async def get_or_create_user(self, telegram_id: int, full_name: str, username: str = None):
         """Foydalanuvchini olish yoki yaratish"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.pool.reader() as db:
             cursor = await db.execute(
                 "SELECT * FROM users WHERE telegram_id = ?", (telegram_id,)
             )
             user = await cursor.fetchone()
-            
-            if user:
-                return dict(user)
-            
+        
+        if user:
+            return dict(user)
+        
+        async with self.pool.writer() as db:
             await db.execute(
-                "INSERT INTO users (telegram_id, full_name, username) VALUES (?, ?, ?)",
+                "INSERT OR IGNORE INTO users (telegram_id, full_name, username) VALUES (?, ?, ?)",
                 (telegram_id, full_name, username)
             )
             await db.commit()
@@ -111,7 +302,7 @@ class Database:
                        currency: str, debt_type: str, payment_type: str,
                        given_date: date, due_date: date, notes: str = None):
         """Yangi qarz qo'shish"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.writer() as db:
             cursor = await db.execute("""
                 INSERT INTO debts (user_id, person_name, amount, currency, 
                                    debt_type, payment_type, given_date, due_date, notes)
@@ -124,16 +315,25 @@ class Database:
     
     async def add_installment(self, debt_id: int, amount: float, due_date: date):
         """Bo'lib to'lash qo'shish"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.writer() as db:
             await db.execute("""
                 INSERT INTO installments (debt_id, amount, due_date)
                 VALUES (?, ?, ?)
             """, (debt_id, amount, due_date))
             await db.commit()
     
+    async def add_installments(self, debt_id: int, schedule: list):
+        """calculate_installments() jadvalini bitta executemany bilan yozish"""
+        async with self.pool.writer() as db:
+            await db.executemany("""
+                INSERT INTO installments (debt_id, amount, due_date)
+                VALUES (?, ?, ?)
+            """, [(debt_id, item['amount'], item['due_date']) for item in schedule])
+            await db.commit()
+    
     async def add_reminder(self, debt_id: int, remind_date: date):
         """Eslatma qo'shish"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.writer() as db:
             await db.execute("""
                 INSERT INTO reminders (debt_id, remind_date)
                 VALUES (?, ?)
@@ -142,8 +342,7 @@ class Database:
     
     async def get_debts_by_type(self, user_id: int, debt_type: str, include_paid: bool = False):
         """Foydalanuvchining qarzlarini olish"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.pool.reader() as db:
             if include_paid:
                 cursor = await db.execute("""
                     SELECT * FROM debts WHERE user_id = ? AND debt_type = ?
@@ -158,8 +357,7 @@ class Database:
     
     async def get_all_active_debts(self, user_id: int):
         """Barcha faol qarzlarni olish"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.pool.reader() as db:
             cursor = await db.execute("""
                 SELECT * FROM debts WHERE user_id = ? AND is_paid = 0
                 ORDER BY due_date ASC
@@ -168,7 +366,7 @@ class Database:
     
     async def mark_debt_paid(self, debt_id: int):
         """Qarzni to'langan deb belgilash"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.writer() as db:
             await db.execute(
                 "UPDATE debts SET is_paid = 1 WHERE id = ?", (debt_id,)
             )
@@ -176,7 +374,7 @@ class Database:
     
     async def delete_debt(self, debt_id: int):
         """Qarzni o'chirish"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.writer() as db:
             await db.execute("DELETE FROM installments WHERE debt_id = ?", (debt_id,))
             await db.execute("DELETE FROM reminders WHERE debt_id = ?", (debt_id,))
             await db.execute("DELETE FROM debts WHERE id = ?", (debt_id,))
@@ -187,7 +385,7 @@ class Database:
         """Kunlik harajat qo'shish"""
         if expense_date is None:
             expense_date = date.today()
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.writer() as db:
             await db.execute("""
                 INSERT INTO daily_expenses (user_id, description, amount, currency, category, expense_date)
                 VALUES (?, ?, ?, ?, ?, ?)
@@ -196,8 +394,7 @@ class Database:
     
     async def get_expenses_by_date(self, user_id: int, expense_date: date):
         """Sana bo'yicha harajatlarni olish"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.pool.reader() as db:
             cursor = await db.execute("""
                 SELECT * FROM daily_expenses WHERE user_id = ? AND expense_date = ?
                 ORDER BY created_at DESC
@@ -206,71 +403,51 @@ class Database:
     
     async def get_expenses_by_month(self, user_id: int, year: int, month: int):
         """Oy bo'yicha harajatlarni olish"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.pool.reader() as db:
+            month_start, next_month = month_range(date(year, month, 1))
             cursor = await db.execute("""
                 SELECT * FROM daily_expenses 
-                WHERE user_id = ? AND strftime('%Y', expense_date) = ? AND strftime('%m', expense_date) = ?
+                WHERE user_id = ? AND expense_date >= ? AND expense_date < ?
                 ORDER BY expense_date DESC
-            """, (user_id, str(year), str(month).zfill(2)))
+            """, (user_id, month_start, next_month))
             return [dict(row) for row in await cursor.fetchall()]
     
     async def get_statistics(self, user_id: int):
-        """Umumiy statistika olish"""
-        async with aiosqlite.connect(self.db_path) as db:
-            stats = {}
-            
-            # Bergan qarzlar (faol)
-            cursor = await db.execute("""
-                SELECT currency, SUM(amount) as total FROM debts 
-                WHERE user_id = ? AND debt_type = 'given' AND is_paid = 0
-                GROUP BY currency
-            """, (user_id,))
-            stats['given_active'] = {row[0]: row[1] for row in await cursor.fetchall()}
-            
-            # Olgan qarzlar (faol)
+        """Umumiy statistika olish (ikki so'rovda, shartli agregatsiya bilan)"""
+        stats = {'given_active': {}, 'taken_active': {}, 'given_count': 0, 'taken_count': 0,
+                 'monthly_expenses': {}, 'today_expenses': {}}
+        today = date.today()
+        month_start, next_month = month_range(today)
+        async with self.pool.reader() as db:
+            # Faol qarzlar: summa va soni, tur va valyuta bo'yicha
             cursor = await db.execute("""
-                SELECT currency, SUM(amount) as total FROM debts 
-                WHERE user_id = ? AND debt_type = 'taken' AND is_paid = 0
-                GROUP BY currency
+                SELECT debt_type, currency, SUM(amount), COUNT(*) FROM debts
+                WHERE user_id = ? AND debt_type IN ('given', 'taken') AND is_paid = 0
+                GROUP BY debt_type, currency
             """, (user_id,))
-            stats['taken_active'] = {row[0]: row[1] for row in await cursor.fetchall()}
-            
-            # Bergan qarzlar soni
-            cursor = await db.execute("""
-                SELECT COUNT(*) FROM debts WHERE user_id = ? AND debt_type = 'given' AND is_paid = 0
-            """, (user_id,))
-            stats['given_count'] = (await cursor.fetchone())[0]
-            
-            # Olgan qarzlar soni
-            cursor = await db.execute("""
-                SELECT COUNT(*) FROM debts WHERE user_id = ? AND debt_type = 'taken' AND is_paid = 0
-            """, (user_id,))
-            stats['taken_count'] = (await cursor.fetchone())[0]
-            
-            # Shu oylik harajatlar
-            today = date.today()
-            cursor = await db.execute("""
-                SELECT currency, SUM(amount) as total FROM daily_expenses 
-                WHERE user_id = ? AND strftime('%Y-%m', expense_date) = ?
-                GROUP BY currency
-            """, (user_id, today.strftime('%Y-%m')))
-            stats['monthly_expenses'] = {row[0]: row[1] for row in await cursor.fetchall()}
+            for debt_type, currency, total, count in await cursor.fetchall():
+                stats[f'{debt_type}_active'][currency] = total
+                stats[f'{debt_type}_count'] += count
             
-            # Bugungi harajatlar
+            # Shu oylik va bugungi harajatlar
             cursor = await db.execute("""
-                SELECT currency, SUM(amount) as total FROM daily_expenses 
-                WHERE user_id = ? AND expense_date = ?
+                SELECT currency,
+                       SUM(CASE WHEN expense_date >= ? AND expense_date < ? THEN amount END),
+                       SUM(amount)
+                FROM daily_expenses
+                WHERE user_id = ? AND expense_date >= ? AND expense_date < ?
                 GROUP BY currency
-            """, (user_id, today))
-            stats['today_expenses'] = {row[0]: row[1] for row in await cursor.fetchall()}
-            
-            return stats
+            """, (today, today + timedelta(days=1), user_id, month_start, next_month))
+            for currency, today_total, month_total in await cursor.fetchall():
+                if today_total is not None:
+                    stats['today_expenses'][currency] = today_total
+                stats['monthly_expenses'][currency] = month_total
+        
+        return stats
     
     async def get_pending_reminders(self, target_date: date):
         """Yuborilishi kerak bo'lgan eslatmalarni olish"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.pool.reader() as db:
             cursor = await db.execute("""
                 SELECT r.*, d.person_name, d.amount, d.currency, d.debt_type, d.due_date, u.telegram_id
                 FROM reminders r
@@ -282,7 +459,7 @@ class Database:
     
     async def mark_reminder_sent(self, reminder_id: int):
         """Eslatmani yuborilgan deb belgilash"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.writer() as db:
             await db.execute(
                 "UPDATE reminders SET is_sent = 1 WHERE id = ?", (reminder_id,)
             )
@@ -290,8 +467,7 @@ class Database:
     
     async def get_overdue_debts(self):
         """Muddati o'tgan qarzlarni olish"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.pool.reader() as db:
             today = date.today()
             cursor = await db.execute("""
                 SELECT d.*, u.telegram_id FROM debts d
@@ -303,8 +479,7 @@ class Database:
     
     async def get_debt_by_id(self, debt_id: int):
         """ID bo'yicha qarzni olish"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.pool.reader() as db:
             cursor = await db.execute(
                 "SELECT * FROM debts WHERE id = ?", (debt_id,)
             )
@@ -313,17 +488,26 @@ class Database:
     
     async def get_installments(self, debt_id: int):
         """Qarz bo'yicha bo'lib to'lashlarni olish"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.pool.reader() as db:
             cursor = await db.execute("""
                 SELECT * FROM installments WHERE debt_id = ?
                 ORDER BY due_date ASC
             """, (debt_id,))
             return [dict(row) for row in await cursor.fetchall()]
     
+    async def get_next_installment(self, debt_id: int):
+        """Navbatdagi to'lanmagan to'lov (idx_installments_debt_next bo'yicha)"""
+        async with self.pool.reader() as db:
+            cursor = await db.execute("""
+                SELECT * FROM installments WHERE debt_id = ? AND is_paid = 0
+                ORDER BY due_date, id LIMIT 1
+            """, (debt_id,))
+            row = await cursor.fetchone()
+            return dict(row) if row else None
+    
     async def mark_installment_paid(self, installment_id: int):
         """Bo'lib to'lashni to'langan deb belgilash"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.writer() as db:
             await db.execute("""
                 UPDATE installments SET is_paid = 1, paid_date = ? WHERE id = ?
             """, (date.today(), installment_id))
@@ -331,6 +515,6 @@ class Database:
     
     async def delete_expense(self, expense_id: int):
         """Harajatni o'chirish"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.writer() as db:
             await db.execute("DELETE FROM daily_expenses WHERE id = ?", (expense_id,))
             await db.commit()
@@ -1,15 +1,17 @@
 import asyncio
 import logging
 from datetime import time
-from telegram import Update
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, CallbackQueryHandler,
     ConversationHandler, filters
 )
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
-from config import BOT_TOKEN
-from database import init_db
+from config import (
+    BOT_TOKEN, DB_JOURNAL_MODE, DB_CHECKPOINT_MINUTES, ALLOWED_UPDATES,
+    WEBHOOK_URL, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_MAX_CONNECTIONS
+)
+from database import init_db, db_pool, close_db, wal_checkpoint
 
 # Handlers
 from handlers.start import start_command, help_command, stats_command, cancel_command
@@ -148,10 +150,16 @@ def main():
     
     # Ma'lumotlar bazasini yaratish
     async def post_init(application):
+        await db_pool.open()
         await init_db()
         logger.info("Ma'lumotlar bazasi tayyor")
     
+    async def post_shutdown(application):
+        await close_db()
+        logger.info("Ma'lumotlar bazasi yopildi")
+    
     application.post_init = post_init
+    application.post_shutdown = post_shutdown
     
     # Scheduler - eslatmalar uchun
     scheduler = AsyncIOScheduler()
@@ -176,11 +184,27 @@ def main():
     # Har 3 kunda muddati o'tgan qarzlar haqida
     scheduler.add_job(run_overdue_check, 'cron', day='*/3', hour=10, minute=0)
     
+    # WAL faylini muntazam qisqartirish
+    if DB_JOURNAL_MODE.upper() == 'WAL':
+        scheduler.add_job(wal_checkpoint, 'interval', minutes=DB_CHECKPOINT_MINUTES)
+    
     scheduler.start()
     
     # Botni ishga tushirish
-    logger.info("Hisobchi Bot ishga tushdi!")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if WEBHOOK_URL:
+        logger.info(f"Hisobchi Bot ishga tushdi! Webhook: {WEBHOOK_LISTEN}:{WEBHOOK_PORT}")
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET or None,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=ALLOWED_UPDATES,
+        )
+    else:
+        logger.info("Hisobchi Bot ishga tushdi!")
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,170 @@
+"""Table-driven checks for the amount and date parsers in bot.py and utils.py"""
+from datetime import date
+
+import pytest
+
+import bot
+import utils
+
+PARSERS = [pytest.param(bot, id="bot"), pytest.param(utils, id="utils")]
+
+AMOUNT_CASES = [
+    # bare numbers and thousand separators
+    ("500000", (500000.0, 'UZS')),
+    ("  12 000  ", (12000.0, 'UZS')),
+    ("1.500.000", (1500000.0, 'UZS')),
+    ("1 500 000", (1500000.0, 'UZS')),
+    ("1,500,000", (1500000.0, 'UZS')),
+    ("500 000 so‘m", (500000.0, 'UZS')),
+    ("100 200", (100200.0, 'UZS')),
+    ("1.500", (1500.0, 'UZS')),
+    ("1.500,000", (1500.0, 'UZS')),
+    # decimal point or comma
+    ("1.5", (1.5, 'UZS')),
+    ("100,50", (100.5, 'UZS')),
+    ("1 500,5", (1500.5, 'UZS')),
+    ("1,500.75 usd", (1500.75, 'USD')),
+    ("1.500,75 $", (1500.75, 'USD')),
+    # currency before or after the number
+    ("$100", (100.0, 'USD')),
+    ("100$", (100.0, 'USD')),
+    ("USD 20", (20.0, 'USD')),
+    ("100 USD", (100.0, 'USD')),
+    ("100 dollar", (100.0, 'USD')),
+    ("$100 usd", (100.0, 'USD')),
+    ("500000 UZS", (500000.0, 'UZS')),
+    ("500000 сум", (500000.0, 'UZS')),
+    # shorthands
+    ("300k", (300000.0, 'UZS')),
+    ("300 ming", (300000.0, 'UZS')),
+    ("300 ming so'm", (300000.0, 'UZS')),
+    ("USD 5 Ming", (5000.0, 'USD')),
+    ("1.5 mln", (1500000.0, 'UZS')),
+    ("1,5 mln so'm", (1500000.0, 'UZS')),
+    ("1.500 mln", (1500000.0, 'UZS')),
+    ("2 mlrd", (2e9, 'UZS')),
+    # rejects
+    ("", (None, None)),
+    ("abc", (None, None)),
+    ("hammasi", (None, None)),
+    ("100 somsa", (None, None)),
+    ("-100", (None, None)),
+    ("1.500.00", (None, None)),
+    ("1..5", (None, None)),
+    ("$100 so'm", (None, None)),
+]
+
+
+@pytest.mark.parametrize("module", PARSERS)
+@pytest.mark.parametrize("text, expected", AMOUNT_CASES)
+def test_parse_amount(module, text, expected):
+    assert module.parse_amount(text) == expected
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("50", (50.0, 'USD')),
+    ("50 so'm", (50.0, 'UZS')),
+    ("1.5 mln", (1500000.0, 'USD')),
+])
+def test_parse_amount_default_currency(text, expected):
+    assert bot.parse_amount(text, 'USD') == expected
+
+
+# Friday, so weekday names and "keyingi hafta" land in the following week
+TODAY = date(2026, 1, 30)
+
+DATE_CASES = [
+    # numeric forms
+    ("25.02.2026", date(2026, 2, 25)),
+    ("25/02/2026", date(2026, 2, 25)),
+    ("25-02-2026", date(2026, 2, 25)),
+    ("2026-02-25", date(2026, 2, 25)),
+    ("5.3.2026", date(2026, 3, 5)),
+    (" 25.02.2026 ", date(2026, 2, 25)),
+    ("25.02", date(2026, 2, 25)),
+    ("29.02.2028", date(2028, 2, 29)),
+    # 2-digit years follow strptime's %y: 69-99 -> 19xx, 00-68 -> 20xx
+    ("25.02.26", date(2026, 2, 25)),
+    ("1.1.99", date(1999, 1, 1)),
+    ("01.01.70", date(1970, 1, 1)),
+    ("25.02.69", date(1969, 2, 25)),
+    # day words
+    ("bugun", TODAY),
+    ("BUGUN", TODAY),
+    ("Ertaga", date(2026, 1, 31)),
+    ("indinga", date(2026, 2, 1)),
+    ("kecha", date(2026, 1, 29)),
+    # relative offsets
+    ("3 kundan keyin", date(2026, 2, 2)),
+    ("3 kun keyin", date(2026, 2, 2)),
+    ("2 haftadan keyin", date(2026, 2, 13)),
+    ("1 oydan keyin", date(2026, 2, 28)),
+    ("1 yildan so'ng", date(2027, 1, 30)),
+    ("3 kun oldin", date(2026, 1, 27)),
+    ("keyingi hafta", date(2026, 2, 6)),
+    ("keyingi oy", date(2026, 2, 28)),
+    ("keyingi yil", date(2027, 1, 30)),
+    # weekdays: always the next one, never today
+    ("juma", date(2026, 2, 6)),
+    ("keyingi juma", date(2026, 2, 6)),
+    ("shanba", date(2026, 1, 31)),
+    ("dushanba", date(2026, 2, 2)),
+    ("keyingi yakshanba", date(2026, 2, 1)),
+    # invalid days and rejects
+    ("31.02.2026", None),
+    ("29.02.2026", None),
+    ("32.01.2026", None),
+    ("00.01.2026", None),
+    ("15.13.2026", None),
+    ("25.02/2026", None),
+    ("2026/02/25", None),
+    ("abc", None),
+    ("", None),
+]
+
+
+@pytest.mark.parametrize("module", PARSERS)
+@pytest.mark.parametrize("text, expected", DATE_CASES)
+def test_parse_date(module, text, expected):
+    assert module.parse_date(text, TODAY) == expected
+
+
+def test_parse_date_uses_request_date():
+    token = bot.request_date.set(TODAY)
+    try:
+        assert bot.parse_date("ertaga") == date(2026, 1, 31)
+    finally:
+        bot.request_date.reset(token)
+
+
+@pytest.mark.parametrize("key", [date(2026, 2, 25), None])
+@pytest.mark.parametrize("direction, before", [("n", False), ("p", True)])
+def test_page_data_round_trip(key, direction, before):
+    data = bot.format_page_data(direction, key, 42)
+    assert bot.parse_page_data(data) == ((None if key is None else str(key), 42), before)
+
+
+# (text, default currency, decimal reading the repay flow offers next to parse_amount's)
+AMBIGUOUS_CASES = [
+    ("1.500", 'USD', 1.5),
+    ("12.345", 'USD', 12.345),
+    ("1.500 usd", 'UZS', 1.5),
+    ("$1.500", 'UZS', 1.5),
+    # unambiguous: so'm amounts, other separators, more groups, multipliers, decimals
+    ("1.500", 'UZS', None),
+    ("1.500 so'm", 'USD', None),
+    ("1,500", 'USD', None),
+    ("1 500", 'USD', None),
+    ("1.500.000", 'USD', None),
+    ("1.500 mln", 'USD', None),
+    ("1.500,50", 'USD', None),
+    ("1.5", 'USD', None),
+    ("1500", 'USD', None),
+]
+
+
+@pytest.mark.parametrize("text, default, expected", AMBIGUOUS_CASES)
+def test_ambiguous_usd_amount(text, default, expected):
+    amount, currency = bot.parse_amount(text, default)
+    assert amount is not None
+    assert bot.ambiguous_usd_amount(text, currency) == expected
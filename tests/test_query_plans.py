@@ -0,0 +1,115 @@
+"""The hot list and sweep queries must be served by their indexes, not table scans.
+
+Runs the migrations on a temporary database, captures the SQL the real query
+functions send (with bound values, via the trace callback) and checks what
+EXPLAIN QUERY PLAN reports for it.
+"""
+import asyncio
+from datetime import date
+
+import pytest
+
+import bot
+
+TODAY = date(2026, 1, 30)
+
+
+def _query_plans(path, run):
+    """EXPLAIN QUERY PLAN detail lines for each SELECT issued on a reader while `run` executes"""
+
+    async def main():
+        pool = bot.ConnectionPool(str(path), size=1)
+        try:
+            async with pool.writer() as db:
+                await bot.run_migrations(db, bot.MIGRATIONS)
+            statements = []
+            async with pool.reader() as db:
+                await db.set_trace_callback(statements.append)
+            old_pool, bot.db_pool = bot.db_pool, pool
+            old_rates, bot.rate_service = bot.rate_service, bot.RateService(pool, bot.FixedRateProvider())
+            try:
+                await run()
+            finally:
+                bot.db_pool, bot.rate_service = old_pool, old_rates
+            async with pool.reader() as db:
+                await db.set_trace_callback(None)
+                plans = []
+                for sql in statements:
+                    if sql.lstrip().upper().startswith(("SELECT", "WITH")):
+                        cursor = await db.execute(f"EXPLAIN QUERY PLAN {sql}")
+                        plans.append([row[3] for row in await cursor.fetchall()])
+                return plans
+        finally:
+            await pool.close()
+
+    plans = asyncio.run(main())
+    assert plans, "no SELECT was traced"
+    return plans
+
+
+async def _drain(rows):
+    async for _ in rows:
+        pass
+
+
+def _assert_plan(plan, indexes, sorted_ok=False):
+    """Each table alias in `indexes` is searched through its index, and no table is scanned.
+
+    Unless `sorted_ok`, the result is never sorted whole either; a temp B-tree for the
+    RIGHT PART of ORDER BY only sorts rows within one outer key.
+    """
+    for alias, index in indexes.items():
+        assert any(line.startswith(f"SEARCH {alias} ") and f" {index} " in line for line in plan), plan
+    assert not any(line.startswith("SCAN ") and "VIRTUAL TABLE" not in line for line in plan), plan
+    if not sorted_ok:
+        assert "USE TEMP B-TREE FOR ORDER BY" not in plan, plan
+
+
+def test_debt_list_uses_index(tmp_path):
+    async def run():
+        await bot.get_debts_page(1, 'given')
+        await bot.get_debts_page(1, 'given', seek=(TODAY, 10))
+        await bot.get_debts_page(1, 'given', seek=(TODAY, 10), before=True)
+        await bot.get_debts_page(1, 'given', seek=(None, 10))
+        await bot.get_debts_page(1, 'given', seek=(None, 10), before=True)
+
+    for plan in _query_plans(tmp_path / "plans.db", run):
+        _assert_plan(plan, {'debts': "idx_debts_active_by_type"})
+
+
+# The sweeps start from the partial index of what is due, so they only touch due rows;
+# sorting that reduced set for the (chat, id) keyset is expected.
+@pytest.mark.parametrize("sweep, driver, indexes", [
+    pytest.param(bot.iter_due_reminders, "SEARCH r USING INDEX idx_reminders_pending ",
+                 {'r': "idx_reminders_pending"}, id="due-reminders"),
+    pytest.param(lambda today: bot.iter_due_reminders(today, debt_ids={1, 2, 3}), "SCAN j VIRTUAL TABLE",
+                 {'r': "idx_reminders_debt"}, id="due-reminders-of-debts"),
+    pytest.param(bot.iter_overdue_debts, "SEARCH d USING INDEX idx_debts_active_due ",
+                 {'d': "idx_debts_active_due", 'i': "idx_installments_debt_next"}, id="overdue"),
+])
+def test_sweep_uses_index(tmp_path, sweep, driver, indexes):
+    for plan in _query_plans(tmp_path / "plans.db", lambda: _drain(sweep(TODAY))):
+        assert plan[0].startswith(driver), plan
+        _assert_plan(plan, indexes, sorted_ok=True)
+
+
+# The read under test is the last statement; get_base_totals first reloads the rate
+# cache, which reads every currency's latest rate on purpose.
+@pytest.mark.parametrize("read, indexes", [
+    pytest.param(lambda: bot.get_expenses_page(1), {'daily_expenses': "idx_expenses_user_date"},
+                 id="expenses-first-page"),
+    pytest.param(lambda: bot.get_expenses_page(1, seek=(TODAY, 5)), {'daily_expenses': "idx_expenses_user_date"},
+                 id="expenses-next-page"),
+    pytest.param(lambda: bot.get_expense_totals(1), {'daily_expenses': "idx_expenses_user_date"},
+                 id="expense-totals"),
+    pytest.param(lambda: bot.get_previous_contacts(1), {'debts': "idx_debts_user_created"}, id="contacts"),
+    pytest.param(lambda: bot.get_next_installment(1), {'installments': "idx_installments_debt_next"},
+                 id="next-installment"),
+    pytest.param(lambda: bot.get_statistics(1), {'user_rollups': "PRIMARY KEY"}, id="statistics"),
+    pytest.param(lambda: bot.get_debt_totals(1, 'given'), {'user_rollups': "PRIMARY KEY"}, id="debt-totals"),
+    pytest.param(lambda: bot.get_base_totals(1),
+                 {'users': "INTEGER PRIMARY KEY", 'user_rollups': "PRIMARY KEY", 'currency_rates': "PRIMARY KEY"},
+                 id="base-totals"),
+])
+def test_read_uses_index(tmp_path, read, indexes):
+    _assert_plan(_query_plans(tmp_path / "plans.db", read)[-1], indexes)
@@ -1,5 +1,6 @@
 from datetime import datetime, date, timedelta
 import re
+from typing import Optional
 
 
 def format_money(amount: float, currency: str) -> str:
@@ -9,56 +10,136 @@ def format_money(amount: float, currency: str) -> str:
     return f"${amount:,.2f}"
 
 
+# Summa atrofida qabul qilinadigan so'zlar (kichik harfda); valyuta raqamdan oldin yoki keyin bo'lishi mumkin
+CURRENCY_WORDS = {
+    '$': 'USD', 'usd': 'USD', 'dollar': 'USD', 'dollor': 'USD',
+    'uzs': 'UZS', "so'm": 'UZS', 'soʻm': 'UZS', 'so’m': 'UZS', 'so‘m': 'UZS', 'so`m': 'UZS',
+    'som': 'UZS', 'sum': 'UZS', 'сўм': 'UZS', 'сум': 'UZS',
+}
+AMOUNT_MULTIPLIERS = {'k': 1e3, 'ming': 1e3, 'mln': 1e6, 'million': 1e6, 'mlrd': 1e9, 'milliard': 1e9}
+
+
+def _word_pattern(words) -> str:
+    # Uzunlari birinchi, aks holda qisqa so'z uzunining boshini "yeb" qo'yadi
+    return '|'.join(re.escape(w) for w in sorted(words, key=len, reverse=True))
+
+
+# Kichik harfga o'tkazilgan matn bitta to'liq moslik bilan o'qiladi:
+# [valyuta] raqam [ko'paytuvchi] [valyuta].
+# Raqam - uchtalab bitta ajratgich bilan guruhlangan (1.500.000, 1 500 000, 1,500,000)
+# va ixtiyoriy kasr qismi (boshqa ajratgich bilan), yoki oddiy raqam (1500, 1.5, 100,50).
+AMOUNT_RE = re.compile(rf"""
+    \s*(?P<pre>{_word_pattern(CURRENCY_WORDS)})?\s*
+    (?:
+        (?P<head>\d{{1,3}})(?P<sep>[ .,'\u00a0\u202f])(?P<groups>\d{{3}}(?:(?P=sep)\d{{3}})*)
+            (?:(?!(?P=sep))[.,](?P<gfrac>\d+))?
+      | (?P<int>\d+)(?:[.,](?P<frac>\d+))?
+    )
+    \s*(?P<mult>{_word_pattern(AMOUNT_MULTIPLIERS)})?
+    \s*(?P<post>{_word_pattern(CURRENCY_WORDS)})?\s*
+""", re.VERBOSE)
+
+
 def parse_amount(text: str) -> tuple:
     """Summa va valyutani ajratib olish
-    Masalan: '100 USD', '500000 UZS', '100$', '500000'
+    Masalan: '500000', '1.500.000', '100$', 'usd 20,5', "1.5 mln so'm", '300k'
+    Noto'g'ri matn uchun (None, None)
     """
-    text = text.strip().upper()
-    
-    # $ belgisi bilan
-    if '$' in text:
-        amount = re.sub(r'[^\d.]', '', text)
-        return float(amount), 'USD'
+    if text.isdigit() and text.isascii():
+        return float(text), 'UZS'  # eng ko'p uchraydigan holat: faqat raqam
+    m = AMOUNT_RE.fullmatch(text.lower())
+    if not m:
+        return None, None
+    pre, head, sep, groups, gfrac, whole, frac, mult, post = m.groups()
+    currency = CURRENCY_WORDS[pre or post] if pre or post else 'UZS'
+    if pre and post and CURRENCY_WORDS[post] != currency:
+        return None, None
     
-    # USD yoki UZS yozilgan
-    if 'USD' in text:
-        amount = re.sub(r'[^\d.]', '', text.replace('USD', ''))
-        return float(amount), 'USD'
-    
-    if 'UZS' in text or "SO'M" in text or "SOM" in text or "SUM" in text:
-        amount = re.sub(r'[^\d.]', '', text.replace('UZS', '').replace("SO'M", '').replace('SOM', '').replace('SUM', ''))
-        return float(amount), 'UZS'
-    
-    # Faqat raqam - UZS deb hisoblaymiz
-    amount = re.sub(r'[^\d.]', '', text)
-    if amount:
-        return float(amount), 'UZS'
+    if whole is not None:
+        amount = float(f"{whole}.{frac}") if frac else float(whole)
+    elif mult and sep in '.,' and len(groups) == 3 and gfrac is None:
+        # "1.500 mln" - 1.5 million, 1500 million emas
+        amount = float(f"{head}.{groups}")
+    else:
+        amount = float(f"{head}{groups.replace(sep, '')}.{gfrac or 0}")
     
-    return None, None
+    if mult:
+        amount = round(amount * AMOUNT_MULTIPLIERS[mult], 2)
+    return amount, currency
+
+
+def add_months(d: date, months: int) -> date:
+    """`months` oy keyingi (yoki oldingi) shu kun; qisqa oylarda oyning oxirgi kuniga tushadi"""
+    month = d.month - 1 + months
+    year, month = d.year + month // 12, month % 12 + 1
+    last = (date(year + month // 12, month % 12 + 1, 1) - timedelta(days=1)).day
+    return date(year, month, min(d.day, last))
+
+
+WEEKDAYS = {'dushanba': 0, 'seshanba': 1, 'chorshanba': 2, 'payshanba': 3, 'juma': 4, 'shanba': 5, 'yakshanba': 6}
+DAY_WORDS = {'kecha': -1, 'bugun': 0, 'ertaga': 1, 'indinga': 2}
+_WEEKDAY_PATTERN = '|'.join(sorted(WEEKDAYS, key=len, reverse=True))
 
+# Bitta moslik formatni tanlaydi; qaysi guruh mos kelgani qaysi shakl ekanini bildiradi
+DATE_RE = re.compile(rf"""
+    \s*(?:
+        (?P<d>\d{{1,2}})(?P<sep>[./-])(?P<m>\d{{1,2}})(?:(?P=sep)(?P<y>\d{{4}}|\d{{2}}))?   # 25.02.2026, 25/02/26, 25.02
+      | (?P<iy>\d{{4}})-(?P<im>\d{{1,2}})-(?P<id>\d{{1,2}})                                  # 2026-02-25
+      | (?P<word>{'|'.join(DAY_WORDS)})                                                   # bugun, ertaga
+      | (?P<n>\d{{1,3}})\s*(?P<unit>kun|hafta|oy|yil)(?:dan)?\s+(?P<dir>keyin|so'ng|song|oldin)  # 3 kundan keyin
+      | keyingi\s+(?P<next>hafta|oy|yil|{_WEEKDAY_PATTERN})                                # keyingi oy
+      | (?P<weekday>{_WEEKDAY_PATTERN})                                                   # juma
+    )\s*
+""", re.VERBOSE)
 
-def parse_date(text: str) -> date:
+
+def _shift(d: date, n: int, unit: str) -> date:
+    if unit == 'kun':
+        return d + timedelta(days=n)
+    if unit == 'hafta':
+        return d + timedelta(weeks=n)
+    return add_months(d, n * 12 if unit == 'yil' else n)
+
+
+def _next_weekday(d: date, name: str) -> date:
+    # Har doim oldinda: juma kuni "juma" - keyingi juma
+    return d + timedelta(days=(WEEKDAYS[name] - d.weekday() - 1) % 7 + 1)
+
+
+def parse_date(text: str, today: date = None) -> date:
     """Sanani parse qilish
-    Formatlar: DD.MM.YYYY, DD/MM/YYYY, DD-MM-YYYY, YYYY-MM-DD
+    Formatlar: DD.MM.YYYY, DD/MM/YYYY, DD-MM-YYYY, DD.MM.YY, YYYY-MM-DD, DD.MM (joriy yil)
+    Nisbiy: bugun, ertaga, indinga, kecha, "3 kundan keyin", "2 haftadan keyin",
+    "1 oydan keyin", "3 kun oldin", "keyingi oy", hafta kunlari (juma, keyingi dushanba)
     """
-    text = text.strip()
-    
-    formats = [
-        '%d.%m.%Y',
-        '%d/%m/%Y',
-        '%d-%m-%Y',
-        '%Y-%m-%d',
-        '%d.%m.%y',
-        '%d/%m/%y',
-    ]
+    m = DATE_RE.fullmatch(text.lower())
+    if not m:
+        return None
+    today = today or date.today()
     
-    for fmt in formats:
-        try:
-            return datetime.strptime(text, fmt).date()
-        except ValueError:
-            continue
+    try:
+        if m['d']:
+            year = m['y']
+            if year is None:
+                year = today.year
+            elif len(year) == 2:
+                year = (1900 if int(year) >= 69 else 2000) + int(year)  # strptime %y chegarasi
+            return date(int(year), int(m['m']), int(m['d']))
+        if m['iy']:
+            return date(int(m['iy']), int(m['im']), int(m['id']))
+    except ValueError:
+        return None
     
-    return None
+    if m['word']:
+        return today + timedelta(days=DAY_WORDS[m['word']])
+    if m['n']:
+        n = int(m['n'])
+        return _shift(today, -n if m['dir'] == 'oldin' else n, m['unit'])
+    if m['next'] in WEEKDAYS:
+        return _next_weekday(today, m['next'])
+    if m['next']:
+        return _shift(today, 1, m['next'])
+    return _next_weekday(today, m['weekday'])
 
 
 def format_date(d: date) -> str:
@@ -70,22 +151,34 @@ def format_date(d: date) -> str:
     return d.strftime('%d.%m.%Y')
 
 
-def days_until(target_date) -> int:
-    """Sanagacha qolgan kunlar"""
+def month_range(d: date) -> tuple:
+    """Oyning yarim ochiq oralig'i: [oyning 1-kuni, keyingi oyning 1-kuni)
+    expense_date >= ? AND expense_date < ? ko'rinishidagi indeksli filtrlar uchun
+    """
+    start = d.replace(day=1)
+    return start, date(start.year + start.month // 12, start.month % 12 + 1, 1)
+
+
+def days_until(target_date, today: date = None) -> Optional[int]:
+    """Sanagacha qolgan kunlar (ro'yxat chizilganda today bir marta olinib uzatiladi).
+    Muddatsiz qarz uchun None"""
+    if target_date is None:
+        return None
     if isinstance(target_date, str):
         target_date = datetime.fromisoformat(target_date).date()
-    today = date.today()
-    return (target_date - today).days
+    return (target_date - (today or date.today())).days
 
 
-def get_debt_status_emoji(due_date, is_paid: bool) -> str:
+def get_debt_status_emoji(due_date, is_paid: bool, today: date = None) -> str:
     """Qarz holatiga emoji"""
     if is_paid:
         return "✅"
     
-    days = days_until(due_date)
+    days = days_until(due_date, today)
     
-    if days < 0:
+    if days is None:
+        return "♾"  # Muddatsiz
+    elif days < 0:
         return "🔴"  # Muddati o'tgan
     elif days <= 3:
         return "🟡"  # Yaqin
@@ -95,29 +188,16 @@ def get_debt_status_emoji(due_date, is_paid: bool) -> str:
 
 def calculate_installments(total_amount: float, num_installments: int, 
                           start_date: date) -> list:
-    """Bo'lib to'lash jadvalini hisoblash"""
-    amount_per_month = total_amount / num_installments
-    installments = []
-    
-    current_date = start_date
-    for i in range(num_installments):
-        # Keyingi oyga o'tish
-        if i > 0:
-            month = current_date.month + 1
-            year = current_date.year
-            if month > 12:
-                month = 1
-                year += 1
-            # Oyning oxirgi kunini hisobga olish
-            day = min(current_date.day, 28)  # Xavfsiz kun
-            current_date = date(year, month, day)
-        
-        installments.append({
-            'amount': round(amount_per_month, 2),
-            'due_date': current_date
-        })
-    
-    return installments
+    """Bo'lib to'lash jadvalini hisoblash
+    
+    Har bir sana start_date dan hisoblanadi (31-kun fevraldan keyin yana oy oxiriga qaytadi).
+    Summa tiyinlarda bo'linadi, qoldiq tiyinlar birinchi to'lovlarga qo'shiladi - jami aynan total_amount.
+    """
+    units, extra = divmod(round(total_amount * 100), num_installments)
+    return [
+        {'amount': (units + (i < extra)) / 100, 'due_date': add_months(start_date, i)}
+        for i in range(num_installments)
+    ]
 
 
 def get_reminder_dates(due_date, days_before: list = [3, 1, 0]) -> list:
@@ -137,7 +217,8 @@ def get_reminder_dates(due_date, days_before: list = [3, 1, 0]) -> list:
 def format_debt_info(debt: dict) -> str:
     """Qarz ma'lumotlarini formatlash"""
     debt_type = "Bergan qarz" if debt['debt_type'] == 'given' else "Olgan qarz"
-    status_emoji = get_debt_status_emoji(debt['due_date'], debt['is_paid'])
+    today = date.today()
+    status_emoji = get_debt_status_emoji(debt['due_date'], debt['is_paid'], today)
     
     text = f"""
 {status_emoji} <b>{debt_type}</b>
@@ -148,7 +229,7 @@ def format_debt_info(debt: dict) -> str:
 ⏰ <b>Qaytarish muddati:</b> {format_date(debt['due_date'])}
 """
     
-    days = days_until(debt['due_date'])
+    days = days_until(debt['due_date'], today)
     if not debt['is_paid']:
         if days < 0:
             text += f"⚠️ <b>Muddati {abs(days)} kun o'tgan!</b>\n"